@@ -3,23 +3,60 @@ Endeavor FDE MVP
 ----------------
 - Low-latency PDF upload & streaming parsing
 - Background thread-pool for extraction & match calls
-- SQLite persistence with migrations on startup
+- SQLite persistence with version-tracked migrations
 - Chunked CSV download with streaming
 - Structured JSON APIs for review UI
 - Env-based config & robust error handling
 """
 import os
+import queue
+import re
 import sqlite3
 import logging
 import json
-from typing import Any, Dict, List, Generator
-from concurrent.futures import ThreadPoolExecutor
+import math
+import multiprocessing
+import mmap
+import struct
+import sys
+import cProfile
+import contextvars
+import heapq
+import itertools
+import random
+import signal
+import socket
+import tempfile
+import time
+import hashlib
+import threading
+import zipfile
+import zlib
+from datetime import date
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Generator, Iterable, Optional, Sequence, Union
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
+try:
+    import fcntl
+except ImportError:  # Windows: concurrent snapshot builds are merely redundant
+    fcntl = None
+
+import click
 import requests
-from flask import Flask, request, render_template, redirect, url_for, Response
+from requests.adapters import HTTPAdapter
+from flask import Flask, request, render_template, redirect, url_for, Response, jsonify, g, has_app_context
 import csv
+import difflib
 import io
-from fuzzywuzzy import fuzz, process
+from fuzzywuzzy import fuzz
+from werkzeug.datastructures import Headers
+from werkzeug.sansio.multipart import (
+    Data, Epilogue, File, MultipartDecoder, MultipartEncoder, NeedData
+)
 
 # ---- CONFIG ----
 from logging.config import dictConfig
@@ -55,8 +92,77 @@ else:
 
 # App configuration
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4"))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# CSV exports are flushed to the client in chunks of roughly this size
+EXPORT_FLUSH_BYTES = 64 * 1024
+
+# Review rows rendered with the page / returned per API page (and the cap)
+REVIEW_PAGE_SIZE = int(os.getenv("REVIEW_PAGE_SIZE", "50"))
+REVIEW_PAGE_MAX = 500
+
+# Documents of one bulk upload processed at the same time (per batch)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "2"))
+
+# Durable job queue: lease length (the visibility timeout; renewed while a job
+# runs), how long (s) a handler may run before its lease is no longer renewed
+# (a hung one is then retried elsewhere), attempts before a job is
+# dead-lettered, base retry backoff (s) and how often idle consumers poll.
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_RUNTIME = float(os.getenv("JOB_MAX_RUNTIME", "1800"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", "5"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "0.5"))
+# Consumer threads inside each web process; set 0 when `flask worker`
+# processes consume the queue instead.
+EMBEDDED_WORKERS = int(os.getenv("EMBEDDED_WORKERS", str(MAX_WORKERS)))
+
+# Upper bound on concurrent match API calls (shared by all documents)
+MATCH_CONCURRENCY = int(os.getenv("MATCH_CONCURRENCY", "8"))
+
+# Hedged matching: when > 0, the local matcher runs alongside every match API
+# call and wins unless the API answers within this many milliseconds.
+HEDGE_DEADLINE_MS = float(os.getenv("HEDGE_DEADLINE_MS", "0"))
+
+# Outbound API resilience: read timeouts (s), retries after the first attempt,
+# and consecutive failures before a circuit opens / seconds until a probe.
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "3.05"))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "60"))
+MATCH_TIMEOUT = float(os.getenv("MATCH_TIMEOUT", "5"))
+EXTRACT_RETRIES = int(os.getenv("EXTRACT_RETRIES", "2"))
+MATCH_RETRIES = int(os.getenv("MATCH_RETRIES", "1"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+# Outbound scheduling per upstream: sustained requests/s and burst of a token
+# bucket (rate 0 = unlimited), concurrent requests, and how long (s) a call
+# may wait for admission before failing. Match concurrency is MATCH_CONCURRENCY.
+EXTRACT_RATE_LIMIT = float(os.getenv("EXTRACT_RATE_LIMIT", "0"))
+EXTRACT_BURST = int(os.getenv("EXTRACT_BURST", "5"))
+EXTRACT_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", str(MAX_WORKERS)))
+MATCH_RATE_LIMIT = float(os.getenv("MATCH_RATE_LIMIT", "0"))
+MATCH_BURST = int(os.getenv("MATCH_BURST", "20"))
+API_QUEUE_TIMEOUT = float(os.getenv("API_QUEUE_TIMEOUT", "10"))
+
+# Catalog matcher tuning: how many blocked candidates get a full fuzzy score,
+# and the minimum score (0-100) a candidate needs to be returned at all.
+MATCH_MAX_CANDIDATES = int(os.getenv("MATCH_MAX_CANDIDATES", "200"))
+MATCH_SCORE_CUTOFF = int(os.getenv("MATCH_SCORE_CUTOFF", "0"))
+
+# Match result cache: in-process LRU entries, SQLite tier row cap and TTL (s)
+MATCH_CACHE_SIZE = int(os.getenv("MATCH_CACHE_SIZE", "10000"))
+MATCH_CACHE_MAX_ROWS = int(os.getenv("MATCH_CACHE_MAX_ROWS", "200000"))
+MATCH_CACHE_TTL = int(os.getenv("MATCH_CACHE_TTL", str(7 * 24 * 3600)))
 UPLOAD_FOLDER = "uploads"
 
+# Catalog CSV (defaults to the bundled sample) and how often to check it for
+# changes; 0 disables hot reloading.
+CATALOG_PATH = os.getenv("CATALOG_PATH", "")
+CATALOG_POLL_SECONDS = float(os.getenv("CATALOG_POLL_SECONDS", "30"))
+# Directory for memory-mapped catalog/index snapshots shared by all worker
+# processes; empty keeps the catalog in process memory only.
+CATALOG_SNAPSHOT_DIR = os.getenv("CATALOG_SNAPSHOT_DIR", "catalog_snapshots")
+
 # Store default path but always look up env when connecting
 DEFAULT_DB_PATH = os.getenv("DB_PATH", "data.db")
 
@@ -64,6 +170,28 @@ def _current_db_path() -> str:
     """Return DB path from environment, falling back to default."""
     return os.getenv("DB_PATH", DEFAULT_DB_PATH)
 
+# SQLite tuning applied to every pooled connection
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# Apply pending schema migrations on a database's first connection. Disable
+# in production and run `flask --app app.py migrate` as a deploy step instead.
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "1") == "1"
+
+# Opt-in profiling: requests slower than this (ms) dump a cProfile file to
+# PROFILE_DIR; 0 disables profiling entirely.
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Stream /upload bodies to the extraction API while saving them (the API must
+# accept chunked request bodies). At most STREAM_EXTRACT_BUFFER chunks are
+# buffered; if the API side stalls for STREAM_EXTRACT_STALL_SECONDS the tee is
+# dropped and the stored upload is extracted by the job queue instead.
+STREAM_EXTRACT = os.getenv("STREAM_EXTRACT", "0") == "1"
+STREAM_EXTRACT_BUFFER = int(os.getenv("STREAM_EXTRACT_BUFFER", "16"))
+STREAM_EXTRACT_STALL_SECONDS = float(os.getenv("STREAM_EXTRACT_STALL_SECONDS", "5"))
+
 # Allow forcing synchronous parsing (useful for integration tests)
 SYNC_PARSE = os.getenv("SYNC_PARSE", "0") == "1"
 
@@ -71,20 +199,616 @@ SYNC_PARSE = os.getenv("SYNC_PARSE", "0") == "1"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 app = Flask(__name__)
-executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
+# ---- METRICS ----
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for k, v in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """Small thread-safe registry of counters, gauges and latency histograms,
+    rendered in the Prometheus text exposition format by ``/metrics``.
+
+    Metrics are declared once with ``describe`` and updated by name with a
+    label dict. Gauges that mirror live state (queue depth, cache size, ...)
+    are registered as callbacks and sampled at render time.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, tuple] = {}
+        self._values: Dict[str, Dict[tuple, Any]] = {}
+        self._callbacks: Dict[str, Callable[[], Dict[tuple, float]]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str,
+                 callback: Optional[Callable[[], Dict[tuple, float]]] = None) -> None:
+        self._meta[name] = (kind, help_text)
+        self._values.setdefault(name, {})
+        if callback:
+            self._callbacks[name] = callback
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1) -> None:
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            self._values[name][key] = value
+
+    def observe(self, name: str, seconds: float, labels: Optional[Dict[str, str]] = None) -> None:
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            series = self._values[name]
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[0][i] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    @contextmanager
+    def timed(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, labels)
+
+    def render(self) -> str:
+        sampled = {}
+        for name, callback in self._callbacks.items():
+            try:
+                sampled[name] = callback()
+            except Exception:
+                LOG.exception("Metric callback %s failed", name)
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in sorted(self._meta.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                series = sampled.get(name, self._values[name])
+                for key, value in sorted(series.items()):
+                    if kind != "histogram":
+                        lines.append(f"{name}{_format_labels(key)} {value}")
+                        continue
+                    buckets, total, count = value
+                    for bound, n in zip(self.BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', bound),))} {n}")
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                    lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe("http_request_duration_seconds", "histogram", "Flask request latency by endpoint.")
+METRICS.describe("http_requests_total", "counter", "Flask requests by endpoint and status.")
+METRICS.describe("api_request_duration_seconds", "histogram", "Upstream API call latency per attempt.")
+METRICS.describe("api_failures_total", "counter", "Failed upstream API attempts by reason.")
+METRICS.describe("api_retries_total", "counter", "Upstream API retries.")
+METRICS.describe("api_queue_wait_seconds", "histogram", "Time upstream calls waited for admission, by priority.")
+METRICS.describe("api_throttled_total", "counter", "Upstream 429s that paused all calls to an API.")
+METRICS.describe("custom_match_duration_seconds", "histogram", "Local catalog matcher latency.")
+METRICS.describe("match_fallbacks_total", "counter", "Line items matched locally instead of via the API.")
+METRICS.describe("match_hedge_total", "counter", "Hedged matches by winning source.")
+METRICS.describe("match_alias_hits_total", "counter", "Line items matched from confirmed aliases.")
+METRICS.describe("sqlite_query_duration_seconds", "histogram", "SQLite statement latency by verb.")
+METRICS.describe("pipeline_stage_duration_seconds", "histogram", "Document pipeline stage latency.")
+METRICS.describe("csv_export_duration_seconds", "histogram", "Time to stream a CSV export.")
+METRICS.describe("csv_export_rows_total", "counter", "Rows written by CSV exports.")
+METRICS.describe("executor_queued_tasks", "gauge", "Tasks waiting for a worker thread.")
+METRICS.describe("executor_active_tasks", "gauge", "Tasks currently running on a worker thread.")
+METRICS.describe("executor_task_failures_total", "counter", "Background tasks that raised.")
+METRICS.describe("job_duration_seconds", "histogram", "Pipeline job run time.")
+METRICS.describe("job_queue_wait_seconds", "histogram", "Time jobs were runnable before a lease.")
+METRICS.describe("jobs_total", "counter", "Finished job attempts by outcome (done/queued/dead).")
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that reports queue depth and active workers, and
+    logs exceptions instead of leaving them in futures nobody reads."""
+
+    def __init__(self, name: str, max_workers: int):
+        super().__init__(max_workers=max_workers, thread_name_prefix=name)
+        self.name = name
+        METRICS.set("executor_queued_tasks", 0, {"pool": name})
+        METRICS.set("executor_active_tasks", 0, {"pool": name})
+
+    def submit(self, fn, *args, **kwargs):
+        labels = {"pool": self.name}
+        METRICS.inc("executor_queued_tasks", labels)
+        # Tasks inherit the submitter's context (e.g. its API_PRIORITY)
+        context = contextvars.copy_context()
+
+        def run():
+            METRICS.inc("executor_queued_tasks", labels, -1)
+            METRICS.inc("executor_active_tasks", labels)
+            try:
+                return context.run(fn, *args, **kwargs)
+            except Exception:
+                METRICS.inc("executor_task_failures_total", labels)
+                LOG.exception("Background task %s failed", getattr(fn, "__name__", fn))
+                raise
+            finally:
+                METRICS.inc("executor_active_tasks", labels, -1)
+
+        return super().submit(run)
+
+
+match_executor = InstrumentedExecutor("match", MATCH_CONCURRENCY)
+# Remote halves of hedged matches; separate so match_executor tasks never
+# wait on their own pool.
+hedge_executor = InstrumentedExecutor("hedge", MATCH_CONCURRENCY)
+# Extraction API calls fed by uploads still in progress
+stream_executor = InstrumentedExecutor("stream", MAX_WORKERS)
+
+# One pooled keep-alive session for outbound API calls, sized so every match
+# worker can hold its own connection instead of re-handshaking per request.
+http = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4, pool_maxsize=max(MATCH_CONCURRENCY, MAX_WORKERS)
+)
+http.mount("http://", _adapter)
+http.mount("https://", _adapter)
+
+
+# ---- OUTBOUND API CLIENT ----
+
+class CircuitOpenError(requests.RequestException):
+    """Raised without touching the network while an upstream's circuit is open."""
+
+
+class AdmissionTimeoutError(requests.RequestException):
+    """Raised when a call waited API_QUEUE_TIMEOUT without being admitted."""
+
+
+# Priority class of outbound calls made by the current request or job:
+# "interactive" (someone is waiting on the result) goes ahead of "batch".
+API_PRIORITY: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "api_priority", default="interactive"
+)
+
+
+class RequestScheduler:
+    """Admission control for one upstream, shared by every thread.
+
+    A call is admitted once it is at the head of the wait queue, a token is
+    available (token bucket of ``rate``/s, up to ``burst``) and fewer than
+    ``concurrency`` calls are in flight. The queue is ordered by priority
+    class, then arrival, so interactive calls overtake queued batch calls.
+    ``pause`` holds every call back, e.g. after an upstream 429.
+
+    With ``shared`` and a ``rate`` the token bucket and the pause live in the
+    database's ``api_buckets`` table instead, so every process calling the
+    upstream (web server, ``flask worker --processes N``) draws on one
+    ``rate``; ``concurrency`` and the wait queue stay per process. Without a
+    rate the scheduler never touches the database.
+    """
+
+    PRIORITIES = ("interactive", "batch")
+
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int,
+                 max_wait: float = API_QUEUE_TIMEOUT, shared: bool = False):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.concurrency = max(1, concurrency)
+        self.max_wait = max_wait
+        self.shared = shared and rate > 0
+        self.tokens = float(self.burst)
+        self.active = 0
+        self.paused_until = 0.0
+        self._refilled = time.monotonic()
+        self._waiting: List[tuple] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._taking = False  # a caller is taking a shared token, outside _cond
+        self._db_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_key: Optional[tuple] = None
+
+    def _delay(self, now: float) -> Optional[float]:
+        """Seconds until a call could be admitted; None while all slots are busy."""
+        if self.active >= self.concurrency or self._taking:
+            return None
+        return max(0.0, self.paused_until - now)
+
+    def _take_local(self, now: float) -> float:
+        """Take a token from this process's bucket; returns 0, or the seconds
+        until one is available."""
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return 0.0
+
+    def _shared_conn(self) -> sqlite3.Connection:
+        """This process's connection for the shared bucket (under ``_db_lock``).
+
+        Kept apart from the request and thread connections so taking a token
+        never commits, or waits on, a caller's open transaction.
+        """
+        path = _current_db_path()
+        key = (os.getpid(), path)
+        if self._conn_key != key:
+            if self._conn is not None and self._conn_key[0] == key[0]:
+                self._conn.close()
+            ensure_db(path)
+            self._conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                                         isolation_level=None, check_same_thread=False)
+            self._conn_key = key
+        return self._conn
+
+    def _take_shared(self) -> Optional[tuple]:
+        """Take a token from the shared bucket (without holding ``_cond``).
+
+        Returns ``(delay, paused_for)``: 0 or the seconds to wait before
+        trying again, and how long the shared pause still lasts. None if the
+        database is unavailable, so the caller falls back to its own bucket.
+        """
+        now = time.time()
+        try:
+            with self._db_lock:
+                conn = self._shared_conn()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = conn.execute(
+                        "SELECT tokens, refilled_at, paused_until FROM api_buckets WHERE api=?",
+                        (self.name,),
+                    ).fetchone()
+                    tokens, refilled, paused = row or (float(self.burst), now, 0.0)
+                    tokens = min(self.burst, tokens + max(0.0, now - refilled) * self.rate)
+                    delay = max(0.0, paused - now)
+                    if tokens < 1:
+                        delay = max(delay, (1 - tokens) / self.rate)
+                    elif delay == 0:
+                        tokens -= 1
+                    conn.execute(
+                        """
+                        INSERT INTO api_buckets(api, tokens, refilled_at, paused_until)
+                        VALUES(?,?,?,?)
+                        ON CONFLICT(api) DO UPDATE
+                        SET tokens=excluded.tokens, refilled_at=excluded.refilled_at
+                        """,
+                        (self.name, tokens, now, paused),
+                    )
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            LOG.warning("Shared %s API rate limit unavailable (%s); limiting locally",
+                        self.name, e)
+            return None
+        return delay, max(0.0, paused - now)
+
+    def _acquire(self, priority: str) -> None:
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        ticket = (self.PRIORITIES.index(priority), next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._delay(now)
+                    if delay == 0 and self._waiting[0] == ticket:
+                        taken = None
+                        if self.shared:
+                            # Database I/O without the lock: a slow writer must
+                            # not hold up releases or the rest of the queue
+                            self._taking = True
+                            self._cond.release()
+                            try:
+                                taken = self._take_shared()
+                            finally:
+                                self._cond.acquire()
+                                self._taking = False
+                                self._cond.notify_all()
+                        if taken is None:
+                            delay = self._take_local(now)
+                        else:
+                            delay, paused_for = taken
+                            if paused_for:  # another process's pause holds us too
+                                self.paused_until = max(self.paused_until,
+                                                        time.monotonic() + paused_for)
+                        if delay == 0:
+                            break
+                    if now >= deadline:
+                        raise AdmissionTimeoutError(
+                            f"{self.name} API call not admitted within {self.max_wait:g}s"
+                        )
+                    self._cond.wait(min(deadline - now, delay or deadline - now))
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            # A higher-priority call may have queued while a shared token was taken
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            self.active += 1
+            self._cond.notify_all()  # the next in line may be admissible too
+        METRICS.observe("api_queue_wait_seconds", time.monotonic() - started,
+                        {"api": self.name, "priority": priority})
+
+    def _release(self) -> None:
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: str = "interactive"):
+        """Hold an admitted slot for the duration of one upstream request."""
+        self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def pause(self, seconds: float) -> None:
+        """Admit nothing for ``seconds``; extends, never shortens, a pause."""
+        with self._cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            if self.rate > 0:
+                self.tokens = 0.0  # restart gently once the pause ends
+        if not self.shared:
+            return
+        now = time.time()
+        try:
+            with self._db_lock:
+                self._shared_conn().execute(
+                    """
+                    INSERT INTO api_buckets(api, tokens, refilled_at, paused_until)
+                    VALUES(?, 0, ?, ?)
+                    ON CONFLICT(api) DO UPDATE
+                    SET tokens=0, refilled_at=excluded.refilled_at,
+                        paused_until=MAX(paused_until, excluded.paused_until)
+                    """,
+                    (self.name, now, now + seconds),
+                )
+        except sqlite3.Error as e:
+            LOG.warning("Could not share the %s API pause (%s)", self.name, e)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            waiting = Counter(self.PRIORITIES[rank] for rank, _ in self._waiting)
+            return {
+                "active": self.active,
+                "waiting": {p: waiting[p] for p in self.PRIORITIES},
+                "paused_for_seconds": round(max(0.0, self.paused_until - time.monotonic()), 1),
+            }
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    closed -> open after ``failure_threshold`` failures in a row; open ->
+    half_open after ``reset_seconds``, letting a single probe through; the
+    probe's outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURES,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.short_circuited = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                LOG.info("Circuit %s closed", self.name)
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def release(self) -> None:
+        """End an admitted call that produced no upstream outcome."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    LOG.warning("Circuit %s opened after %d failures", self.name, self.failures)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            retry_in = 0.0
+            if self.state == "open":
+                retry_in = max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "short_circuited": self.short_circuited,
+                "retry_in_seconds": round(retry_in, 1),
+            }
+
+
+class ApiClient:
+    """One upstream endpoint: per-endpoint timeout, jittered retries on
+    transient errors (connection errors, timeouts, 429 and 5xx), a
+    circuit breaker so a dead upstream fails fast instead of tying up
+    worker threads, and a ``RequestScheduler`` that rate limits attempts
+    in ``API_PRIORITY`` order. A 429 pauses every caller, not just the
+    one retrying.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    BACKOFF_BASE = 0.25
+    BACKOFF_CAP = 10.0
+
+    def __init__(self, name: str, method: str, url: str, timeout: float, retries: int,
+                 scheduler: RequestScheduler, session: requests.Session = http):
+        self.name = name
+        self.method = method
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.scheduler = scheduler
+        self.session = session
+        self.breaker = CircuitBreaker(name)
+
+    def _backoff(self, attempt: int, resp: Optional[requests.Response]) -> float:
+        retry_after = resp.headers.get("Retry-After") if resp is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.BACKOFF_CAP)
+        # "Full jitter": spreads retries from many workers apart
+        return random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt))
+
+    def call(self, retry: bool = True, **kwargs) -> requests.Response:
+        """Send the request; returns a 2xx response or raises.
+
+        Pass ``retry=False`` for bodies that cannot be replayed (streams).
+        """
+        if not self.breaker.allow():
+            METRICS.inc("api_failures_total", {"api": self.name, "reason": "circuit_open"})
+            raise CircuitOpenError(f"{self.name} API circuit is open")
+        retries = self.retries if retry else 0
+        for attempt in range(retries + 1):
+            resp = None
+            for _, fileobj, *_ in (kwargs.get("files") or {}).values():
+                fileobj.seek(0)  # a retried upload must resend from the start
+            try:
+                with self.scheduler.slot(API_PRIORITY.get()), \
+                        METRICS.timed("api_request_duration_seconds", api=self.name):
+                    resp = self.session.request(
+                        self.method, self.url, timeout=(API_CONNECT_TIMEOUT, self.timeout),
+                        **kwargs
+                    )
+                if resp.status_code not in self.RETRY_STATUSES:
+                    resp.raise_for_status()  # other 4xx: our fault, not retried
+                    self.breaker.record_success()
+                    return resp
+                error: Exception = requests.HTTPError(
+                    f"{resp.status_code} from {self.name} API", response=resp
+                )
+            except requests.HTTPError:
+                METRICS.inc("api_failures_total", {"api": self.name, "reason": "client_error"})
+                self.breaker.record_success()  # the upstream is up and answering
+                raise
+            except AdmissionTimeoutError:
+                # Our own queue is backed up: that says nothing about the
+                # upstream, and a retry would only queue again
+                METRICS.inc("api_failures_total", {"api": self.name, "reason": "admission_timeout"})
+                self.breaker.release()
+                raise
+            except requests.RequestException as e:  # connection errors, timeouts, ...
+                error = e
+            except Exception:
+                # Aborted on our side (e.g. an abandoned upload stream): says
+                # nothing about the upstream, so it is neither a failure nor a retry
+                self.breaker.release()
+                raise
+            METRICS.inc("api_failures_total", {"api": self.name, "reason": type(error).__name__})
+            delay = self._backoff(attempt, resp)
+            if resp is not None and resp.status_code == 429:
+                # Back-pressure: everyone calling this upstream waits, not just us
+                METRICS.inc("api_throttled_total", {"api": self.name})
+                self.scheduler.pause(delay)
+            if attempt < retries:
+                METRICS.inc("api_retries_total", {"api": self.name})
+                LOG.warning("%s API attempt %d failed (%s); retrying in %.2fs",
+                            self.name, attempt + 1, error, delay)
+                time.sleep(delay)
+        self.breaker.record_failure()
+        raise error
+
+
+extract_api = ApiClient(
+    "extract", "POST", EXTRACT_ENDPOINT, EXTRACT_TIMEOUT, EXTRACT_RETRIES,
+    RequestScheduler("extract", EXTRACT_RATE_LIMIT, EXTRACT_BURST, EXTRACT_CONCURRENCY,
+                     shared=True),
+)
+match_api = ApiClient(
+    "match", "GET", MATCH_ENDPOINT, MATCH_TIMEOUT, MATCH_RETRIES,
+    RequestScheduler("match", MATCH_RATE_LIMIT, MATCH_BURST, MATCH_CONCURRENCY,
+                     shared=True),
+)
 
 
 # ---- DATABASE INIT ----
 
-def init_db() -> None:
-    """Initialize the SQLite database and run migrations if necessary."""
-    conn = sqlite3.connect(_current_db_path())
-    conn.executescript(
+def _add_column(conn: sqlite3.Connection, table: str, column: str, decl: str) -> bool:
+    """Add ``column`` to ``table`` unless it exists. Returns True if added."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column in existing:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+
+def _execute_script(conn: sqlite3.Connection, script: str) -> None:
+    """Run a multi-statement script inside the caller's transaction
+    (``executescript`` would commit it first)."""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ""
+
+
+def _migrate_base_schema(conn: sqlite3.Connection) -> None:
+    _execute_script(
+        conn,
         """
     CREATE TABLE IF NOT EXISTS documents (
         id           INTEGER PRIMARY KEY AUTOINCREMENT,
         name         TEXT UNIQUE,
-        uploaded_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        uploaded_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        status       TEXT DEFAULT 'queued',
+        error        TEXT,
+        updated_at   TIMESTAMP,
+        content_hash TEXT,
+        batch_id     INTEGER REFERENCES batches(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS batches (
+        id               INTEGER PRIMARY KEY AUTOINCREMENT,
+        max_concurrency  INTEGER,
+        created_at       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
 
     CREATE TABLE IF NOT EXISTS line_items (
@@ -100,289 +824,2942 @@ def init_db() -> None:
         line_item_id  INTEGER,
         choice_json   TEXT,
         confirmed_id  INTEGER,
+        catalog_version TEXT,
         FOREIGN KEY(line_item_id) REFERENCES line_items(id) ON DELETE CASCADE
     );
 
-    -- Ensure duplicates are removed so the unique constraint can be applied when
-    -- the code runs against an existing DB that already contains duplicates.
-    DELETE FROM line_items
-      WHERE id NOT IN (
-        SELECT MIN(id) FROM line_items GROUP BY document_id, raw_index
-      );
+    CREATE INDEX IF NOT EXISTS idx_matches_line_item ON matches(line_item_id);
+    """,
+    )
+    # Databases created before these columns existed. Their documents were
+    # processed inline, so treat them as finished.
+    if _add_column(conn, "documents", "status", "TEXT DEFAULT 'queued'"):
+        conn.execute("UPDATE documents SET status='done'")
+    _add_column(conn, "documents", "error", "TEXT")
+    _add_column(conn, "documents", "updated_at", "TIMESTAMP")
+    _add_column(conn, "documents", "content_hash", "TEXT")
+    _add_column(conn, "documents", "batch_id", "INTEGER REFERENCES batches(id)")
+    _add_column(conn, "matches", "catalog_version", "TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_batch ON documents(batch_id)")
+
 
-    CREATE UNIQUE INDEX IF NOT EXISTS idx_line_unique ON line_items(document_id, raw_index);
-    """
+def _migrate_unique_line_items(conn: sqlite3.Connection) -> None:
+    # Old databases may hold duplicates, which would block the unique index
+    conn.execute(
+        """
+        DELETE FROM line_items
+          WHERE id NOT IN (
+            SELECT MIN(id) FROM line_items GROUP BY document_id, raw_index
+          )
+        """
+    )
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_line_unique ON line_items(document_id, raw_index)"
     )
-    conn.commit()
-    conn.close()
 
-    # Log where the database file lives for easier debugging & to ensure we
-    # respect dynamic DB_PATH overrides (critical for the integration tests).
-    LOG.info("Database initialised at %s", _current_db_path())
 
+def _migrate_match_choices(conn: sqlite3.Connection) -> None:
+    _execute_script(
+        conn,
+        """
+    -- Candidate choices of a match; matches.confirmed_id is a rank in here.
+    -- (matches.choice_json is the legacy blob form, converted below.)
+    CREATE TABLE IF NOT EXISTS match_choices (
+        match_id  INTEGER NOT NULL REFERENCES matches(id) ON DELETE CASCADE,
+        rank      INTEGER NOT NULL,
+        name      TEXT NOT NULL,
+        score     REAL,
+        PRIMARY KEY (match_id, rank)
+    ) WITHOUT ROWID;
 
-# Flask 3 removed `before_first_request`. Initialize the DB eagerly.
-init_db()
-LOG.info("DB initialized.")
+    CREATE INDEX IF NOT EXISTS idx_match_choices_name ON match_choices(name);
+    """,
+    )
+    converted = conn.execute(
+        """
+        INSERT OR IGNORE INTO match_choices(match_id, rank, name, score)
+        SELECT m.id, CAST(j.key AS INTEGER),
+               json_extract(j.value, '$.name'), json_extract(j.value, '$.score')
+        FROM matches m, json_each(m.choice_json) j
+        WHERE m.choice_json IS NOT NULL
+        """
+    ).rowcount
+    conn.execute("UPDATE matches SET choice_json = NULL WHERE choice_json IS NOT NULL")
+    if converted > 0:
+        LOG.info("Migrated %d match choices out of choice_json", converted)
 
 
-# ---- UTILS ----
+def _migrate_confirmation_stats(conn: sqlite3.Connection) -> None:
+    has_stats = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='confirmation_stats'"
+    ).fetchone()
+    _execute_script(
+        conn,
+        """
+    -- Dashboard aggregates, kept current by the triggers below so reading
+    -- them never scans match history.
+    CREATE TABLE IF NOT EXISTS confirmation_stats (
+        id                    INTEGER PRIMARY KEY CHECK (id = 1),
+        matches_total         INTEGER NOT NULL DEFAULT 0,
+        confirmed_total       INTEGER NOT NULL DEFAULT 0,
+        top_choice_confirmed  INTEGER NOT NULL DEFAULT 0
+    );
 
-def db_conn() -> sqlite3.Connection:
-    """Return a SQLite connection with Row factory enabled."""
-    db_path = _current_db_path()
-    # Defensive: ensure parent directory exists when a user passes a nested path.
-    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
-    connection = sqlite3.connect(db_path)
-    connection.row_factory = sqlite3.Row
-    # Ensure ON DELETE CASCADE works and keep referential integrity
-    connection.execute("PRAGMA foreign_keys = ON;")
-    # In extremely verbose logging scenarios this can be useful, but avoid
-    # spamming output every query.  Toggle via LOG level if needed.
-    LOG.debug("Opened SQLite connection to %s", db_path)
-    return connection
+    CREATE TABLE IF NOT EXISTS sku_confirmations (
+        name           TEXT PRIMARY KEY,
+        confirmations  INTEGER NOT NULL DEFAULT 0
+    );
 
+    CREATE INDEX IF NOT EXISTS idx_sku_confirmations_count
+        ON sku_confirmations(confirmations DESC);
 
-def stream_csv(rows: List[Dict[str, Any]]) -> Generator[str, None, None]:
-    """Yield CSV rows one at a time for streaming response."""
-    yield "description,confirmed_choice\n"
-    for r in rows:
-        if r["confirmed_id"] is not None and r["choices"]:
-            # choices is a list of {"name": "...", "score": ...} objects
-            confirmed_choice = r["choices"][r["confirmed_id"]]["name"]
-        else:
-            confirmed_choice = ""
-        # Escape quotes in CSV data
-        description = r["description"].replace('"', '""')
-        confirmed_choice = confirmed_choice.replace('"', '""')
-        yield f'"{description}","{confirmed_choice}"\n'
+    CREATE TRIGGER IF NOT EXISTS trg_matches_insert AFTER INSERT ON matches BEGIN
+        UPDATE confirmation_stats
+        SET matches_total = matches_total + 1,
+            confirmed_total = confirmed_total + (NEW.confirmed_id IS NOT NULL),
+            top_choice_confirmed = top_choice_confirmed + (NEW.confirmed_id IS 0)
+        WHERE id = 1;
+    END;
 
+    CREATE TRIGGER IF NOT EXISTS trg_matches_confirm AFTER UPDATE OF confirmed_id ON matches
+    WHEN OLD.confirmed_id IS NOT NEW.confirmed_id BEGIN
+        UPDATE confirmation_stats
+        SET confirmed_total = confirmed_total
+                + (NEW.confirmed_id IS NOT NULL) - (OLD.confirmed_id IS NOT NULL),
+            top_choice_confirmed = top_choice_confirmed
+                + (NEW.confirmed_id IS 0) - (OLD.confirmed_id IS 0)
+        WHERE id = 1;
+        UPDATE sku_confirmations SET confirmations = confirmations - 1
+        WHERE name = (SELECT name FROM match_choices
+                      WHERE match_id = OLD.id AND rank = OLD.confirmed_id);
+        INSERT INTO sku_confirmations(name, confirmations)
+            SELECT name, 1 FROM match_choices
+            WHERE match_id = NEW.id AND rank = NEW.confirmed_id
+            ON CONFLICT(name) DO UPDATE SET confirmations = confirmations + 1;
+    END;
 
-def load_catalog():
-    """Load the product catalog for custom matching"""
-    catalog = []
-    try:
-        # Try to load from uploads directory first
-        catalog_path = os.path.join(UPLOAD_FOLDER, 'sample_docs', 'unique_fastener_catalog.csv')
-        if not os.path.exists(catalog_path):
-            # Fallback to current directory
-            catalog_path = 'unique_fastener_catalog.csv'
-        
-        if os.path.exists(catalog_path):
-            with open(catalog_path, 'r', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                next(reader)  # Skip header
-                for row in reader:
-                    if row:  # Skip empty rows
-                        catalog.append(row[0])  # Assuming product name is first column
-    except Exception as e:
-        LOG.error(f"Failed to load catalog: {e}")
-    
-    return catalog
+    -- BEFORE so the confirmed choice is still readable (choices cascade)
+    CREATE TRIGGER IF NOT EXISTS trg_matches_delete BEFORE DELETE ON matches BEGIN
+        UPDATE confirmation_stats
+        SET matches_total = matches_total - 1,
+            confirmed_total = confirmed_total - (OLD.confirmed_id IS NOT NULL),
+            top_choice_confirmed = top_choice_confirmed - (OLD.confirmed_id IS 0)
+        WHERE id = 1;
+        UPDATE sku_confirmations SET confirmations = confirmations - 1
+        WHERE name = (SELECT name FROM match_choices
+                      WHERE match_id = OLD.id AND rank = OLD.confirmed_id);
+    END;
+    """,
+    )
+    # Aggregates are maintained incrementally from here on; seed them once
+    if not has_stats:
+        conn.execute(
+            """
+            INSERT INTO confirmation_stats(id, matches_total, confirmed_total, top_choice_confirmed)
+            SELECT 1, COUNT(*), COUNT(confirmed_id), COALESCE(SUM(confirmed_id IS 0), 0)
+            FROM matches
+            """
+        )
+        conn.execute(
+            """
+            INSERT INTO sku_confirmations(name, confirmations)
+            SELECT mc.name, COUNT(*)
+            FROM matches m
+            JOIN match_choices mc ON mc.match_id = m.id AND mc.rank = m.confirmed_id
+            GROUP BY mc.name
+            """
+        )
 
-PRODUCT_CATALOG = load_catalog()
-LOG.info(f"Loaded {len(PRODUCT_CATALOG)} products into catalog")
 
-def custom_match(description: str, use_custom: bool = False) -> List[Dict[str, Any]]:
-    """
-    Custom matching algorithm using fuzzy string matching
-    Returns matches in the same format as the production API
-    """
-    if not use_custom or not PRODUCT_CATALOG:
-        return []
-    
-    try:
-        # Use fuzzy matching to find similar products
-        matches = process.extract(description, PRODUCT_CATALOG, 
-                                scorer=fuzz.token_sort_ratio, limit=10)
-        
-        # Convert to expected format
-        results = []
-        for match_text, score in matches:
-            results.append({
-                "name": match_text,
-                "score": score / 100.0  # Convert to 0-1 scale
-            })
-        
-        return results
-    except Exception as e:
-        LOG.error(f"Custom matching failed: {e}")
-        return []
+def _migrate_caches(conn: sqlite3.Connection) -> None:
+    _execute_script(
+        conn,
+        """
+    CREATE TABLE IF NOT EXISTS match_cache (
+        cache_key    TEXT PRIMARY KEY,
+        choice_json  TEXT NOT NULL,
+        created_at   REAL NOT NULL,
+        accessed_at  REAL NOT NULL
+    );
 
-# ---- ROUTES ----
-@app.route("/")
-def home():
-    """Landing page with upload form or review table."""
-    return render_template("index.html")
+    CREATE INDEX IF NOT EXISTS idx_match_cache_accessed ON match_cache(accessed_at);
 
+    -- Full-text index of catalog names for typeahead search; rebuilt when
+    -- catalog_meta.fts_version differs from the live catalog version.
+    CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5(
+        name, row_id UNINDEXED, tokenize = 'unicode61', prefix = '1 2 3'
+    );
 
-@app.route("/upload", methods=["POST"])
-def upload():
-    """Handle PDF upload, save file, create document record, and queue parsing."""
-    uploaded_file = request.files["file"]
-    path = os.path.join(UPLOAD_FOLDER, uploaded_file.filename)
-    uploaded_file.save(path)
+    CREATE TABLE IF NOT EXISTS catalog_meta (
+        key    TEXT PRIMARY KEY,
+        value  TEXT
+    );
 
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO documents(name) VALUES(?)", (uploaded_file.filename,))
-    conn.commit()
+    -- Extraction results per SHA-256 of the uploaded bytes
+    CREATE TABLE IF NOT EXISTS extractions (
+        content_hash  TEXT PRIMARY KEY,
+        items_json    TEXT NOT NULL,
+        created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    )
 
-    doc_id = c.execute(
-        "SELECT id FROM documents WHERE name=?", (uploaded_file.filename,)
-    ).fetchone()["id"]
 
-    # Parse document either synchronously or in a background thread
-    if SYNC_PARSE:
-        parse_and_store(doc_id, uploaded_file.filename)
-    else:
-        executor.submit(parse_and_store, doc_id, uploaded_file.filename)
+def _migrate_jobs(conn: sqlite3.Connection) -> None:
+    _execute_script(
+        conn,
+        """
+    -- Durable pipeline jobs. A job is 'queued' until run_at, 'leased' while a
+    -- worker holds it (an expired lease makes it leasable again) and 'dead'
+    -- once its attempts are exhausted. Finished jobs are deleted.
+    CREATE TABLE IF NOT EXISTS jobs (
+        id             INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind           TEXT NOT NULL,
+        payload        TEXT NOT NULL,
+        document_id    INTEGER REFERENCES documents(id),
+        batch_id       INTEGER REFERENCES batches(id),
+        state          TEXT NOT NULL DEFAULT 'queued',
+        attempts       INTEGER NOT NULL DEFAULT 0,
+        max_attempts   INTEGER NOT NULL,
+        run_at         REAL NOT NULL,
+        lease_owner    TEXT,
+        lease_expires  REAL,
+        last_error     TEXT,
+        created_at     REAL NOT NULL
+    );
 
-    return redirect(url_for("review", doc_id=doc_id))
+    CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(state, run_at);
+    CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs(batch_id, state);
+    """,
+    )
 
 
-# ---- INTERNAL TASKS ----
+def _migrate_match_aliases(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS match_aliases (
+            description_key  TEXT PRIMARY KEY,
+            name             TEXT NOT NULL,
+            confirmations    INTEGER NOT NULL DEFAULT 1,
+            updated_at       REAL NOT NULL
+        )
+        """
+    )
+    # Seed from past confirmations, oldest first so the latest one wins
+    confirmed = conn.execute(
+        """
+        SELECT li.description, mc.name
+        FROM matches m
+        JOIN line_items li ON li.id = m.line_item_id
+        JOIN match_choices mc ON mc.match_id = m.id AND mc.rank = m.confirmed_id
+        ORDER BY m.id
+        """
+    ).fetchall()
+    _upsert_aliases(conn, [(description, name) for description, name in confirmed])
 
-def parse_and_store(doc_id: int, filename: str) -> None:
-    """Call extract API, then persist line items for later review."""
-    LOG.info("Parsing doc %s", doc_id)
-    
-    # Upload file to extraction API using multipart form data
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
-    with open(file_path, 'rb') as f:
-        files = {'file': (filename, f, 'application/pdf')}
-        resp = requests.post(EXTRACT_ENDPOINT, files=files)
-    resp.raise_for_status()
-    
-    # API returns array of objects directly
-    items = resp.json()
-    # Convert the extraction API format to expected format
-    if items and isinstance(items[0], dict) and 'description' not in items[0]:
-        # API returns objects like {"Request Item": "...", "Amount": ..., ...}
-        # Convert to our expected format
-        formatted_items = []
-        for item in items:
-            request_item = item.get("Request Item", "")
-            amount = item.get("Amount", "")
-            # Create a description combining the key info
-            description = f"{request_item} (Qty: {amount})" if amount else request_item
-            formatted_items.append({"description": description})
-        items = formatted_items
 
-    conn = db_conn()
-    c = conn.cursor()
-    with conn:  # ensures atomic commit / rollback
-        # Clear out existing data for id to avoid stale rows
-        c.execute(
-            "DELETE FROM matches WHERE line_item_id IN (SELECT id FROM line_items WHERE document_id=?)",
-            (doc_id,))
-        c.execute("DELETE FROM line_items WHERE document_id=?", (doc_id,))
+def _migrate_match_source(conn: sqlite3.Connection) -> None:
+    _add_column(conn, "matches", "match_source", "TEXT")
 
-        for idx, itm in enumerate(items):
-            # Use UPSERT to guard against any race conditions if parse runs twice
-            c.execute(
-                """
-                INSERT INTO line_items(document_id, description, raw_index)
-                VALUES(?,?,?)
-                ON CONFLICT(document_id, raw_index) DO UPDATE SET description=excluded.description
-                """,
-                (doc_id, itm["description"], idx))
 
-    LOG.info("Stored %d items for doc %s", len(items), doc_id)
+def _migrate_documents_uploaded_index(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_documents_uploaded ON documents(uploaded_at)"
+    )
 
 
-@app.route("/review/<int:doc_id>")
-def review(doc_id: int):
-    """Display review UI for a specific document."""
-    conn = db_conn()
-    c = conn.cursor()
+def _migrate_api_buckets(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        -- Outbound token buckets and 429 pauses shared by every process
+        CREATE TABLE IF NOT EXISTS api_buckets (
+            api           TEXT PRIMARY KEY,
+            tokens        REAL NOT NULL,
+            refilled_at   REAL NOT NULL,
+            paused_until  REAL NOT NULL DEFAULT 0
+        )
+        """
+    )
 
-    items = c.execute(
-        "SELECT * FROM line_items WHERE document_id=?", (doc_id,)
-    ).fetchall()
 
-    # Ensure matches exist for each item
-    for itm in items:
-        if not c.execute(
-            "SELECT 1 FROM matches WHERE line_item_id=?", (itm["id"],)
-        ).fetchone():
-            # Try production API first
-            choices = []
-            try:
-                resp = requests.get(
-                    MATCH_ENDPOINT,
-                    params={"query": itm["description"], "limit": 5},
-                )
-                resp.raise_for_status()
-                matches = resp.json()
-                choices = [{"name": m["match"], "score": m["score"]} for m in matches]
-            except Exception as e:
-                LOG.error(f"API matching failed: {e}")
-            
-            # If API failed or returned no matches, use custom matching
-            if not choices:
-                LOG.info(f"Using custom matching for: {itm['description']}")
-                choices = custom_match(itm["description"], use_custom=True)
-                
-            c.execute(
-                "INSERT INTO matches(line_item_id, choice_json) VALUES(?,?)",
-                (itm["id"], json.dumps(choices)),
-            )
-    conn.commit()
+def _migrate_unique_matches(conn: sqlite3.Connection) -> None:
+    # Overlapping match stages could store a line item twice; keep its
+    # confirmed match if any, else the first, and drop the rest
+    duplicates = [row[0] for row in conn.execute(
+        """
+        SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY line_item_id ORDER BY confirmed_id IS NULL, id
+            ) AS n
+            FROM matches WHERE line_item_id IS NOT NULL
+        ) WHERE n > 1
+        """
+    )]
+    # Matches first: the delete trigger reads their confirmed choice
+    conn.executemany("DELETE FROM matches WHERE id=?", [(i,) for i in duplicates])
+    conn.executemany("DELETE FROM match_choices WHERE match_id=?", [(i,) for i in duplicates])
+    conn.execute("DROP INDEX IF EXISTS idx_matches_line_item")
+    conn.execute("CREATE UNIQUE INDEX idx_matches_line_item ON matches(line_item_id)")
 
-    payload: List[Dict[str, Any]] = []
-    for itm in items:
-        m = c.execute(
-            "SELECT * FROM matches WHERE line_item_id=?", (itm["id"],)
-        ).fetchone()
-        payload.append(
-            {
-                "match_id": m["id"],
-                "description": itm["description"],
-                "choices": json.loads(m["choice_json"]),
-                "confirmed": m["confirmed_id"],
-            }
-        )
 
-    return render_template(
-        "index.html", REVIEW_DATA={"doc_id": doc_id, "rows": payload}
+def _migrate_default_confirmations(conn: sqlite3.Connection) -> None:
+    # Rows confirm() fills in with the top choice nobody reviewed are flagged
+    # and left out of the dashboard aggregates, whose triggers are replaced
+    _add_column(conn, "matches", "confirmed_by_default", "INTEGER NOT NULL DEFAULT 0")
+    _execute_script(
+        conn,
+        """
+    DROP TRIGGER IF EXISTS trg_matches_insert;
+    DROP TRIGGER IF EXISTS trg_matches_confirm;
+    DROP TRIGGER IF EXISTS trg_matches_delete;
+
+    CREATE TRIGGER trg_matches_insert AFTER INSERT ON matches BEGIN
+        UPDATE confirmation_stats
+        SET matches_total = matches_total + 1,
+            confirmed_total = confirmed_total
+                + (NEW.confirmed_id IS NOT NULL AND NOT NEW.confirmed_by_default),
+            top_choice_confirmed = top_choice_confirmed
+                + (NEW.confirmed_id IS 0 AND NOT NEW.confirmed_by_default)
+        WHERE id = 1;
+    END;
+
+    CREATE TRIGGER trg_matches_confirm
+    AFTER UPDATE OF confirmed_id, confirmed_by_default ON matches
+    WHEN OLD.confirmed_id IS NOT NEW.confirmed_id
+      OR OLD.confirmed_by_default IS NOT NEW.confirmed_by_default BEGIN
+        UPDATE confirmation_stats
+        SET confirmed_total = confirmed_total
+                + (NEW.confirmed_id IS NOT NULL AND NOT NEW.confirmed_by_default)
+                - (OLD.confirmed_id IS NOT NULL AND NOT OLD.confirmed_by_default),
+            top_choice_confirmed = top_choice_confirmed
+                + (NEW.confirmed_id IS 0 AND NOT NEW.confirmed_by_default)
+                - (OLD.confirmed_id IS 0 AND NOT OLD.confirmed_by_default)
+        WHERE id = 1;
+        UPDATE sku_confirmations SET confirmations = confirmations - 1
+        WHERE NOT OLD.confirmed_by_default
+          AND name = (SELECT name FROM match_choices
+                      WHERE match_id = OLD.id AND rank = OLD.confirmed_id);
+        INSERT INTO sku_confirmations(name, confirmations)
+            SELECT name, 1 FROM match_choices
+            WHERE NOT NEW.confirmed_by_default
+              AND match_id = NEW.id AND rank = NEW.confirmed_id
+            ON CONFLICT(name) DO UPDATE SET confirmations = confirmations + 1;
+    END;
+
+    -- BEFORE so the confirmed choice is still readable (choices cascade)
+    CREATE TRIGGER trg_matches_delete BEFORE DELETE ON matches BEGIN
+        UPDATE confirmation_stats
+        SET matches_total = matches_total - 1,
+            confirmed_total = confirmed_total
+                - (OLD.confirmed_id IS NOT NULL AND NOT OLD.confirmed_by_default),
+            top_choice_confirmed = top_choice_confirmed
+                - (OLD.confirmed_id IS 0 AND NOT OLD.confirmed_by_default)
+        WHERE id = 1;
+        UPDATE sku_confirmations SET confirmations = confirmations - 1
+        WHERE NOT OLD.confirmed_by_default
+          AND name = (SELECT name FROM match_choices
+                      WHERE match_id = OLD.id AND rank = OLD.confirmed_id);
+    END;
+    """,
     )
 
 
-@app.route("/confirm/<int:doc_id>", methods=["POST"])
-def confirm(doc_id: int):
-    """Persist confirmed matches and return a CSV download."""
-    conn = db_conn()
-    c = conn.cursor()
+# Ordered schema history. Append new migrations; never edit applied ones.
+# The early steps are idempotent because databases created before migrations
+# were tracked already contain some of their tables.
+MIGRATIONS = [
+    (1, "base_schema", _migrate_base_schema),
+    (2, "unique_line_items", _migrate_unique_line_items),
+    (3, "match_choices", _migrate_match_choices),
+    (4, "confirmation_stats", _migrate_confirmation_stats),
+    (5, "caches", _migrate_caches),
+    (6, "jobs", _migrate_jobs),
+    (7, "match_aliases", _migrate_match_aliases),
+    (8, "match_source", _migrate_match_source),
+    (9, "documents_uploaded_index", _migrate_documents_uploaded_index),
+    (10, "api_buckets", _migrate_api_buckets),
+    (11, "unique_matches", _migrate_unique_matches),
+    (12, "default_confirmations", _migrate_default_confirmations),
+]
 
-    # Update confirmed IDs
-    for mid, sel in request.form.items():
-        c.execute("UPDATE matches SET confirmed_id=? WHERE id=?", (int(sel), int(mid)))
-    conn.commit()
+_migrated_dbs: set = set()
+_migrate_lock = threading.Lock()
 
-    # Fetch data for CSV
-    rows = [
-        {
-            "description": r["description"],
-            "confirmed_id": r["confirmed_id"],
-            "choices": json.loads(r["choice_json"]),
+
+def _applied_migrations(conn: sqlite3.Connection) -> set:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version     INTEGER PRIMARY KEY,
+            name        TEXT NOT NULL,
+            applied_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    return {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+
+
+def pending_migrations(db_path: Optional[str] = None) -> List[int]:
+    """Versions from MIGRATIONS not yet applied to the database."""
+    conn = sqlite3.connect(db_path or _current_db_path(), timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    try:
+        applied = _applied_migrations(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return [version for version, _, _ in MIGRATIONS if version not in applied]
+
+
+def migrate(db_path: Optional[str] = None) -> List[int]:
+    """Apply pending schema migrations; returns the versions applied.
+
+    Everything pending runs in one write-locked transaction, so concurrent
+    workers starting against a new database apply each step exactly once.
+    """
+    path = db_path or _current_db_path()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    applied: List[int] = []
+    try:
+        # WAL lets background writers and request readers proceed concurrently;
+        # the mode is persistent, so setting it once per database is enough.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            done = _applied_migrations(conn)
+            for version, name, step in MIGRATIONS:
+                if version in done:
+                    continue
+                step(conn)
+                conn.execute(
+                    "INSERT INTO schema_migrations(version, name) VALUES(?, ?)", (version, name)
+                )
+                applied.append(version)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    _migrated_dbs.add(path)
+    if applied:
+        LOG.info("Applied migrations %s to %s", applied, path)
+    return applied
+
+
+def init_db() -> None:
+    """Migrate the current DB_PATH to the latest schema (kept for callers
+    predating ``migrate``)."""
+    migrate()
+
+
+def ensure_db(db_path: str) -> None:
+    """Check a database's schema once per process, on its first connection.
+
+    Pending migrations are applied when AUTO_MIGRATE is on; otherwise this
+    fails loudly rather than running against an outdated schema.
+    """
+    if db_path in _migrated_dbs:
+        return
+    with _migrate_lock:
+        if db_path in _migrated_dbs:
+            return
+        pending = pending_migrations(db_path)
+        if pending and not AUTO_MIGRATE:
+            raise RuntimeError(
+                f"Database {db_path} is missing migrations {pending}; "
+                "run `flask --app app.py migrate`"
+            )
+        if pending:
+            migrate(db_path)
+        _migrated_dbs.add(db_path)
+
+
+@app.cli.command("migrate")
+def migrate_command() -> None:
+    """Apply pending schema migrations to DB_PATH."""
+    applied = migrate()
+    print(f"Applied migrations {applied}" if applied else "Database schema is up to date")
+
+
+# ---- UTILS ----
+
+_thread_conns = threading.local()
+
+
+def _statement_verb(sql: str) -> str:
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "EMPTY"
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording statement latency (until the first row is ready)."""
+
+    def execute(self, sql, parameters=()):
+        with METRICS.timed("sqlite_query_duration_seconds", op=_statement_verb(sql)):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with METRICS.timed("sqlite_query_duration_seconds", op=_statement_verb(sql)):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements, direct or via cursors, are timed."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _open_connection(db_path: str) -> sqlite3.Connection:
+    """Open a tuned SQLite connection with Row factory enabled."""
+    # Defensive: ensure parent directory exists when a user passes a nested path.
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    ensure_db(db_path)
+    connection = sqlite3.connect(
+        db_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, factory=TimedConnection
+    )
+    connection.row_factory = sqlite3.Row
+    # Ensure ON DELETE CASCADE works and keep referential integrity
+    connection.execute("PRAGMA foreign_keys = ON;")
+    connection.execute("PRAGMA journal_mode = WAL;")
+    connection.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS};")
+    connection.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS};")
+    connection.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_KB};")
+    connection.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE};")
+    connection.execute("PRAGMA temp_store = MEMORY;")
+    # In extremely verbose logging scenarios this can be useful, but avoid
+    # spamming output every query.  Toggle via LOG level if needed.
+    LOG.debug("Opened SQLite connection to %s", db_path)
+    return connection
+
+
+def db_conn() -> sqlite3.Connection:
+    """Return the SQLite connection for the current context.
+
+    Inside a Flask app context the connection lives on ``g`` and is closed
+    at teardown. Background threads (job consumers, match workers) keep one connection
+    per thread and database path for their whole lifetime instead of
+    opening a new one per task.
+    """
+    db_path = _current_db_path()
+    if has_app_context():
+        conns = g.setdefault("_db_conns", {})
+    else:
+        conns = getattr(_thread_conns, "conns", None)
+        if conns is None:
+            conns = _thread_conns.conns = {}
+    connection = conns.get(db_path)
+    if connection is None:
+        connection = conns[db_path] = _open_connection(db_path)
+    return connection
+
+
+@app.teardown_appcontext
+def close_db(exc: Optional[BaseException]) -> None:
+    """Close the connections opened during this app context."""
+    for connection in g.pop("_db_conns", {}).values():
+        connection.close()
+
+
+def close_thread_connections() -> None:
+    """Close the calling thread's pooled connections (outside app contexts);
+    job worker threads call it as they exit."""
+    for connection in getattr(_thread_conns, "conns", {}).values():
+        connection.close()
+    _thread_conns.conns = {}
+
+
+def upload_filename(filename: Optional[str]) -> str:
+    """Base name to store an uploaded file under; "" if nothing usable is left."""
+    name = os.path.basename((filename or "").replace("\\", "/")).strip()
+    return "" if name in (".", "..") else name
+
+
+def _upload_part(path: str):
+    """A new temporary file next to ``path``, unique per upload, so concurrent
+    uploads of one name never write into the same file."""
+    return tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path) or ".", prefix=".upload-", suffix=".part", delete=False
+    )
+
+
+def save_upload(stream, path: str) -> str:
+    """Stream a binary file object to ``path`` and return the SHA-256 of its bytes.
+
+    The digest is computed chunk by chunk while writing, so hashing costs no
+    extra pass over the file. The file is written under a temporary name and
+    moved into place, so readers never see a partial upload.
+    """
+    digest = hashlib.sha256()
+    out = _upload_part(path)
+    try:
+        with out:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                out.write(chunk)
+        os.replace(out.name, path)
+    except BaseException:
+        os.remove(out.name)
+        raise
+    return digest.hexdigest()
+
+
+# Name of the confirmed choice of match ``m`` (empty when unconfirmed)
+_CONFIRMED_CHOICE_SQL = (
+    "COALESCE((SELECT mc.name FROM match_choices mc "
+    "WHERE mc.match_id = m.id AND mc.rank = m.confirmed_id), '')"
+)
+
+# Matched rows of one document, in line order (served by idx_line_unique)
+_DOCUMENT_ROWS_SQL = f"""
+    SELECT li.description, {_CONFIRMED_CHOICE_SQL}
+    FROM line_items li JOIN matches m ON m.line_item_id = li.id
+    WHERE li.document_id=?
+    ORDER BY li.raw_index
+"""
+
+# Choices of match ``m`` as a JSON array in rank order. Aggregates follow the
+# order of an ordered subquery; a scan of the table promises no order at all
+# (and ORDER BY inside the aggregate needs SQLite 3.44).
+_CHOICES_JSON_SQL = (
+    "(SELECT json_group_array(json_object('name', mc.name, 'score', mc.score)) "
+    "FROM (SELECT name, score FROM match_choices "
+    "WHERE match_id = m.id ORDER BY rank) mc)"
+)
+
+
+def stream_csv(db_path: str, header: Sequence[str],
+               query: Union[str, Callable[[sqlite3.Connection], Iterable[Sequence[Any]]]],
+               params: Sequence[Any] = ()) -> Generator[str, None, None]:
+    """Yield CSV text for ``query`` while its rows are read from SQLite.
+
+    ``query`` is SQL run with ``params``, or a callable producing the rows
+    from the connection. Rows are read lazily on a dedicated connection (the
+    request's connection is closed before a streamed body finishes), and
+    output is flushed every EXPORT_FLUSH_BYTES, so memory stays constant
+    regardless of how many rows are exported, provided the query needs no
+    sort (no ``USE TEMP B-TREE`` in its plan).
+    """
+    conn = _open_connection(db_path)
+    started = time.perf_counter()
+    rows = 0
+    try:
+        yield ",".join(header) + "\n"
+        buf = io.StringIO()
+        writer = csv.writer(buf, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        rows_iter = query(conn) if callable(query) else conn.execute(query, params)
+        for row in rows_iter:
+            writer.writerow(row)
+            rows += 1
+            if buf.tell() >= EXPORT_FLUSH_BYTES:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        if buf.tell():
+            yield buf.getvalue()
+    finally:
+        conn.close()
+        METRICS.observe("csv_export_duration_seconds", time.perf_counter() - started)
+        METRICS.inc("csv_export_rows_total", value=rows)
+
+
+def _gzip_stream(chunks) -> Generator[bytes, None, None]:
+    """Gzip-compress a stream of text chunks on the fly."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def csv_response(chunks, filename: str) -> Response:
+    """Streaming CSV download, gzip-encoded when the client accepts it."""
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    if "gzip" in request.accept_encodings:
+        chunks = _gzip_stream(chunks)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return Response(chunks, mimetype="text/csv", headers=headers)
+
+
+def _default_catalog_path() -> str:
+    """CATALOG_PATH, else the bundled sample catalog, else ./unique_fastener_catalog.csv."""
+    if CATALOG_PATH:
+        return CATALOG_PATH
+    # Try to load from uploads directory first
+    catalog_path = os.path.join(UPLOAD_FOLDER, 'sample_docs', 'unique_fastener_catalog.csv')
+    if not os.path.exists(catalog_path):
+        # Fallback to current directory
+        catalog_path = 'unique_fastener_catalog.csv'
+    return catalog_path
+
+
+# Header names (lower-cased) used as the match name when present; otherwise
+# all columns of a row are joined, e.g. "Bolt Steel 1in".
+_NAME_COLUMNS = ("name", "product", "product name", "description", "item")
+
+
+class Catalog:
+    """Immutable, column-oriented snapshot of the catalog CSV.
+
+    Every column is kept. Attribute columns (type, material, size, ...)
+    repeat a small set of values, so they are dictionary-encoded: one list
+    of distinct values plus an ``array`` of per-row codes. ``names`` holds
+    the string each row is matched and exported by. ``version`` is a
+    content hash of the source file.
+    """
+
+    def __init__(self, header: List[str], rows: List[List[str]], version: str,
+                 path: str = "", mtime: float = 0.0, size: int = 0):
+        self.header = header
+        self.version = version
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.loaded_at = time.time()
+        self._values: List[List[str]] = []
+        self._codes: List[array] = []
+        for col in range(len(header)):
+            lookup: Dict[str, int] = {}
+            codes = array("I")
+            for row in rows:
+                value = row[col] if col < len(row) else ""
+                code = lookup.get(value)
+                if code is None:
+                    code = lookup[value] = len(lookup)
+                codes.append(code)
+            self._values.append(list(lookup))
+            self._codes.append(codes)
+
+        lowered = [h.strip().lower() for h in header]
+        name_col = next((lowered.index(c) for c in _NAME_COLUMNS if c in lowered), None)
+        if name_col is not None:
+            self.names = [self.value(i, name_col) for i in range(len(rows))]
+        else:
+            self.names = [" ".join(v for v in row if v) for row in rows]
+
+    @classmethod
+    def from_columns(cls, header: List[str], values: List[Sequence[str]],
+                     codes: List[Sequence[int]], names: Sequence[str], version: str,
+                     path: str = "", mtime: float = 0.0, size: int = 0) -> "Catalog":
+        """A catalog over already-encoded columns (e.g. views into a snapshot)."""
+        catalog = cls(header, [], version, path, mtime, size)
+        catalog._values, catalog._codes, catalog.names = values, codes, names
+        return catalog
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def value(self, row_id: int, col: int) -> str:
+        return self._values[col][self._codes[col][row_id]]
+
+    def row(self, row_id: int) -> Dict[str, str]:
+        """All columns of one catalog row."""
+        return {h: self.value(row_id, col) for col, h in enumerate(self.header)}
+
+
+def _file_version(path: str) -> str:
+    """Short SHA-256 of a file's bytes."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def load_catalog(path: Optional[str] = None) -> Catalog:
+    """Load the product catalog for custom matching"""
+    catalog_path = path or _default_catalog_path()
+    header: List[str] = []
+    rows: List[List[str]] = []
+    version, mtime, size = "empty", 0.0, 0
+    try:
+        if os.path.exists(catalog_path):
+            stat = os.stat(catalog_path)
+            mtime, size = stat.st_mtime, stat.st_size
+            version = _file_version(catalog_path)
+            with open(catalog_path, 'r', encoding='utf-8') as f:
+                reader = csv.reader(f)
+                header = next(reader, [])
+                rows = [row for row in reader if row]  # Skip empty rows
+    except Exception as e:
+        LOG.error(f"Failed to load catalog: {e}")
+    return Catalog(header, rows, version, catalog_path, mtime, size)
+
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _tokenize(text: str) -> List[str]:
+    """Lower-case alphanumeric tokens, mirroring fuzzywuzzy's full_process."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _index_features(text: str) -> set:
+    """Blocking keys for a string: whole tokens plus padded character trigrams.
+
+    Tokens give precise candidates; trigrams keep typos and run-together
+    tokens (``M8x30`` vs ``M8 x 30``) reachable.
+    """
+    features = set()
+    for token in _tokenize(text):
+        features.add("w:" + token)
+        padded = f" {token} "
+        for i in range(len(padded) - 2):
+            features.add("g:" + padded[i:i + 3])
+    return features
+
+
+class CatalogIndex:
+    """Inverted index over catalog names for fast top-k fuzzy matching.
+
+    Instead of scoring every catalog row, a query is blocked down to the rows
+    sharing the most (IDF-weighted) tokens/trigrams with it, and only those
+    candidates are scored with ``fuzz.token_sort_ratio``.  Features whose
+    posting lists are very long carry little signal: they are never scanned
+    once rarer features have produced candidates, only probed to break ties
+    among the current leaders, so query cost depends on the selectivity of
+    the query rather than on the catalog size.
+    """
+
+    # Posting lists longer than this fraction of the catalog are probed for
+    # the leading candidates instead of being scanned.
+    COMMON_FEATURE_RATIO = 0.05
+    # Upper bound on posting entries scanned per query after the rarest list
+    SCAN_BUDGET = 20000
+
+    def __init__(self, names: Sequence[str], max_candidates: int = MATCH_MAX_CANDIDATES,
+                 postings: Optional[Any] = None):
+        """Index ``names``, or wrap prebuilt ``postings`` (anything with a
+        dict-like ``get(feature)`` returning row ids, e.g. a snapshot)."""
+        self.names = names
+        self.max_candidates = max_candidates
+        if postings is None:
+            postings = {}
+            for row_id, name in enumerate(names):
+                for feature in _index_features(name):
+                    bucket = postings.get(feature)
+                    if bucket is None:
+                        bucket = postings[feature] = array("I")
+                    bucket.append(row_id)
+        self._postings = postings
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def candidates(self, query: str) -> List[int]:
+        """Return row ids worth scoring for ``query``, best blocked first.
+
+        Rare features are counted in full.  Once the scan budget is spent,
+        the remaining common features only re-rank the current leaders by
+        membership tests against their (row-id sorted) posting lists, so a
+        row's chance of being scored never depends on where its id falls.
+        """
+        size = len(self.names)
+        if not size:
+            return []
+        lists = [
+            posting for posting in map(self._postings.get, _index_features(query))
+            if posting is not None
+        ]
+        if not lists:
+            return []
+        # All trigrams of a rare token share one posting list; visit it once
+        lists.sort(key=lambda posting: (len(posting), posting[0]))
+        groups: List[list] = []
+        for posting in lists:
+            if groups and len(groups[-1][0]) == len(posting) and groups[-1][0] == posting:
+                groups[-1][1] += 1
+            else:
+                groups.append([posting, 1])
+        common_limit = max(self.max_candidates, int(size * self.COMMON_FEATURE_RATIO))
+
+        # The rarest list always seeds the candidates whole, however long it
+        # is; rarer lists are then counted while they fit the budget.
+        seed, repeats = groups[0]
+        level = repeats * math.log(1 + size / len(seed))
+        budget = self.SCAN_BUDGET - len(seed)
+        scanned = 1
+        while scanned < len(groups):
+            posting, repeats = groups[scanned]
+            if len(posting) > common_limit or len(posting) > budget:
+                break
+            if scanned == 1:
+                weights = Counter(dict.fromkeys(seed, level))
+            weight = repeats * math.log(1 + size / len(posting))
+            budget -= len(posting)
+            for row_id in posting:
+                weights[row_id] += weight
+            scanned += 1
+
+        # While only the seed is counted every leader weighs ``level``, and if
+        # enough leaders share the next list they alone are the new leaders:
+        # a huge seed is narrowed without ranking or weighing it row by row.
+        tied = scanned == 1
+        leaders = list(seed) if tied else self._leaders(weights, list(weights))
+        for posting, repeats in groups[scanned:]:
+            weight = repeats * math.log(1 + size / len(posting))
+            members = self._members(posting, leaders)
+            if len(members) == len(leaders):
+                continue  # shared by every leader: cannot change their order
+            if tied and len(members) >= self.max_candidates:
+                leaders, level = members, level + weight
+                continue
+            if tied:
+                tied = False
+                weights = Counter(dict.fromkeys(leaders, level))
+            for row_id in members:
+                weights[row_id] += weight
+            leaders = self._leaders(weights, leaders)
+        if tied:
+            weights = Counter(dict.fromkeys(leaders, level))
+        # Remaining ties go to the names closest in length to the query,
+        # which is what token_sort_ratio rewards among equal token overlap.
+        width = len(query)
+        leaders.sort(key=lambda r: (-weights[r], abs(len(self.names[r]) - width), r))
+        return leaders[:self.max_candidates]
+
+    def _leaders(self, weights: Counter, rows: List[int]) -> List[int]:
+        """``rows`` weighing at least the ``max_candidates``-th best, ties kept."""
+        if len(rows) <= self.max_candidates:
+            return rows
+        floor = heapq.nlargest(self.max_candidates, map(weights.__getitem__, rows))[-1]
+        return [row_id for row_id in rows if weights[row_id] >= floor]
+
+    @staticmethod
+    def _members(posting: Sequence[int], rows: List[int]) -> List[int]:
+        """The ``rows`` present in the sorted ``posting`` list."""
+        n = len(posting)
+        if len(rows) * n.bit_length() > n:
+            return list(set(rows).intersection(posting))
+        found = []
+        for row_id in rows:
+            i = bisect_left(posting, row_id)
+            if i < n and posting[i] == row_id:
+                found.append(row_id)
+        return found
+
+    def search(self, query: str, limit: int = 10, score_cutoff: int = 0) -> List[Dict[str, Any]]:
+        """Top ``limit`` catalog names for ``query`` scored 0-100."""
+        scored = []
+        for row_id in self.candidates(query):
+            name = self.names[row_id]
+            score = fuzz.token_sort_ratio(query, name)
+            if score >= score_cutoff:
+                scored.append((score, row_id, name))
+        scored.sort(key=lambda s: (-s[0], s[1]))
+        return [{"name": name, "score": score} for score, _, name in scored[:limit]]
+
+
+class CatalogState:
+    """A catalog together with the match index built from it."""
+
+    def __init__(self, catalog: Catalog, index: Optional[CatalogIndex] = None):
+        self.catalog = catalog
+        self.index = index or CatalogIndex(catalog.names)
+        self.version = catalog.version
+
+
+# ---- Catalog snapshots ----
+#
+# A snapshot is one binary file holding a catalog and its match index as flat
+# arrays: every string table is a UTF-8 blob plus uint32 end offsets, every
+# code/posting list a uint32 array. Workers mmap it read-only and decode
+# strings on access, so opening takes milliseconds and the pages are shared
+# through the OS page cache instead of being rebuilt in every process.
+
+_SNAPSHOT_MAGIC = b"ECS1"
+_SNAPSHOT_ALIGN = 8
+
+
+class _StringTable(Sequence):
+    """Read-only sequence of strings stored as a UTF-8 blob and end offsets."""
+
+    def __init__(self, blob: memoryview, offsets: memoryview):
+        self._blob = blob
+        self._offsets = offsets  # len(self) + 1 entries, starting at 0
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return str(self._blob[self._offsets[i]:self._offsets[i + 1]], "utf-8")
+
+    def raw(self, i: int) -> bytes:
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]])
+
+
+class _PostingTable:
+    """Feature -> row id lookup over a snapshot, by binary search over the
+    byte-sorted feature keys."""
+
+    def __init__(self, keys: _StringTable, starts: memoryview, postings: memoryview):
+        self._keys = keys
+        self._starts = starts
+        self._postings = postings
+
+    def get(self, feature: str) -> Optional[memoryview]:
+        key = feature.encode("utf-8")
+        lo, hi = 0, len(self._keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._keys.raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._keys) and self._keys.raw(lo) == key:
+            return self._postings[self._starts[lo]:self._starts[lo + 1]]
+        return None
+
+
+def _pack_strings(strings: Sequence[str]) -> List[Any]:
+    blob = bytearray()
+    offsets = array("I", [0])
+    for text in strings:
+        blob += text.encode("utf-8")
+        offsets.append(len(blob))
+    return [bytes(blob), offsets]
+
+
+def write_catalog_snapshot(state: CatalogState, path: str) -> None:
+    """Serialize a catalog and its index to ``path`` (written atomically)."""
+    catalog, postings = state.catalog, state.index._postings
+    meta = {
+        "version": catalog.version, "header": catalog.header, "path": catalog.path,
+        "mtime": catalog.mtime, "size": catalog.size, "byteorder": sys.byteorder,
+    }
+    sections: List[Any] = [json.dumps(meta).encode("utf-8")]
+    sections += _pack_strings(catalog.names)
+    for col in range(len(catalog.header)):
+        sections += _pack_strings(catalog._values[col])
+        sections.append(array("I", catalog._codes[col]))
+    keys = sorted(postings, key=lambda f: f.encode("utf-8"))
+    starts, flat = array("I", [0]), array("I")
+    for feature in keys:
+        flat.extend(postings[feature])
+        starts.append(len(flat))
+    sections += _pack_strings(keys) + [starts, flat]
+
+    header_size = 8 + 16 * len(sections)
+    table, offset = [], header_size
+    for section in sections:
+        offset += -offset % _SNAPSHOT_ALIGN
+        length = len(section) * getattr(section, "itemsize", 1)
+        table += [offset, length]
+        offset += length
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_SNAPSHOT_MAGIC + struct.pack(f"<I{len(table)}Q", len(sections), *table))
+        for section, section_offset in zip(sections, table[::2]):
+            f.write(b"\0" * (section_offset - f.tell()))
+            f.write(section if isinstance(section, bytes) else section.tobytes())
+    os.replace(tmp, path)
+
+
+def open_catalog_snapshot(path: str) -> CatalogState:
+    """Map a snapshot read-only and wrap it as a CatalogState."""
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:4] != _SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a catalog snapshot")
+    (count,) = struct.unpack_from("<I", buf, 4)
+    table = struct.unpack_from(f"<{2 * count}Q", buf, 8)
+    view = memoryview(buf)
+    sections = iter(view[o:o + n] for o, n in zip(table[::2], table[1::2]))
+    meta = json.loads(bytes(next(sections)))
+    if meta["byteorder"] != sys.byteorder:
+        raise ValueError(f"{path} was written on a {meta['byteorder']}-endian machine")
+
+    def strings() -> _StringTable:
+        blob = next(sections)
+        return _StringTable(blob, next(sections).cast("I"))
+
+    names = strings()
+    values, codes = [], []
+    for _ in meta["header"]:
+        values.append(strings())
+        codes.append(next(sections).cast("I"))
+    keys = strings()
+    postings = _PostingTable(keys, next(sections).cast("I"), next(sections).cast("I"))
+    catalog = Catalog.from_columns(
+        meta["header"], values, codes, names, meta["version"],
+        meta["path"], meta["mtime"], meta["size"],
+    )
+    return CatalogState(catalog, CatalogIndex(names, postings=postings))
+
+
+def _snapshot_path(path: str, stat: os.stat_result) -> str:
+    """Snapshot file for one state of a catalog file, keyed without hashing it."""
+    key = hashlib.sha256(
+        f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}:{_SNAPSHOT_MAGIC!r}".encode()
+    ).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(CATALOG_SNAPSHOT_DIR, f"{stem}-{key}.snap")
+
+
+def _load_catalog_state(path: str, rebuild: bool = False) -> CatalogState:
+    """CatalogState for the file at ``path``, through its snapshot if enabled.
+
+    The first process to need a snapshot builds it under a file lock; the
+    others wait and then map the finished file instead of parsing the CSV.
+    """
+    if not CATALOG_SNAPSHOT_DIR or not os.path.exists(path):
+        return CatalogState(load_catalog(path))
+    snapshot = _snapshot_path(path, os.stat(path))
+    try:
+        os.makedirs(CATALOG_SNAPSHOT_DIR, exist_ok=True)
+        with open(snapshot + ".lock", "w") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if not rebuild and os.path.exists(snapshot):
+                try:
+                    return open_catalog_snapshot(snapshot)
+                except (OSError, ValueError) as e:
+                    LOG.warning("Ignoring unreadable catalog snapshot %s: %s", snapshot, e)
+            state = CatalogState(load_catalog(path))
+            write_catalog_snapshot(state, snapshot)
+        stem = os.path.basename(snapshot).rsplit("-", 1)[0]
+        for name in os.listdir(CATALOG_SNAPSHOT_DIR):
+            stale = os.path.join(CATALOG_SNAPSHOT_DIR, name)
+            if name.rsplit("-", 1)[0] == stem and not stale.startswith(snapshot):
+                os.remove(stale)  # mapped copies stay valid until unmapped
+        return open_catalog_snapshot(snapshot)
+    except OSError as e:
+        LOG.warning("Catalog snapshot unavailable (%s); keeping the catalog in memory", e)
+        return CatalogState(load_catalog(path))
+
+
+_catalog_state: Optional[CatalogState] = None
+_catalog_reload_lock = threading.Lock()
+_catalog_watcher: Optional[threading.Thread] = None
+
+
+def current_catalog() -> CatalogState:
+    """The live catalog. Callers should read it once per operation, since a
+    reload swaps in a new state at any time (a single reference assignment,
+    so readers always see a complete catalog and index).
+
+    The catalog is loaded, and the file watcher started, on first use.
+    """
+    global _catalog_watcher
+    state = _catalog_state
+    if state is None:
+        reload_catalog()
+        with _catalog_reload_lock:
+            if _catalog_watcher is None and CATALOG_POLL_SECONDS > 0:
+                _catalog_watcher = threading.Thread(
+                    target=_watch_catalog, name="catalog-watcher", daemon=True
+                )
+                _catalog_watcher.start()
+        state = _catalog_state
+    return state
+
+
+def reload_catalog(force: bool = False) -> bool:
+    """Rebuild catalog and index if the file changed; returns True on swap.
+
+    Change detection is cheap (mtime/size) and confirmed by content hash,
+    so touching the file without changing it does not trigger a rebuild.
+    The new index is built before the swap; in-flight matches keep using
+    the state they started with.
+    """
+    global _catalog_state
+    with _catalog_reload_lock:
+        state = _catalog_state
+        path = _default_catalog_path()
+        if state is not None and not force:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if (path, stat.st_mtime, stat.st_size) == (
+                state.catalog.path, state.catalog.mtime, state.catalog.size
+            ):
+                return False
+            if _file_version(path) == state.version:
+                state.catalog.mtime, state.catalog.size = stat.st_mtime, stat.st_size
+                return False
+        started = time.monotonic()
+        new_state = _load_catalog_state(path, rebuild=force)
+        _catalog_state = new_state
+    LOG.info(
+        "Loaded %d products into catalog (version %s) in %.2fs",
+        len(new_state.catalog), new_state.version, time.monotonic() - started,
+    )
+    return True
+
+
+def _watch_catalog() -> None:
+    """Background loop that hot-reloads the catalog when its file changes."""
+    while True:
+        time.sleep(CATALOG_POLL_SECONDS)
+        try:
+            if reload_catalog():
+                # Rebuild the search index now rather than on the next keystroke
+                ensure_catalog_fts(db_conn())
+        except Exception:
+            LOG.exception("Catalog reload failed; keeping version %s", current_catalog().version)
+
+
+@app.cli.command("build-catalog-snapshot")
+def build_catalog_snapshot_command() -> None:
+    """Prebuild the catalog snapshot so workers start by mapping it."""
+    state = _load_catalog_state(_default_catalog_path(), rebuild=True)
+    print(f"Catalog version {state.version}: {len(state.catalog)} rows")
+
+
+# Quantity suffix parse_and_store appends to descriptions; it never changes
+# which catalog item matches, so it is dropped from cache keys.
+_QTY_SUFFIX_RE = re.compile(r"\s*\(Qty:[^)]*\)\s*$", re.IGNORECASE)
+
+
+def normalize_description(description: str) -> str:
+    """Canonical form of a line item description for lookups and cache keys."""
+    return " ".join(_tokenize(_QTY_SUFFIX_RE.sub("", description)))
+
+
+class MatchCache:
+    """Two-tier cache of match choices keyed by normalized description.
+
+    The first tier is an in-process LRU; the second is the ``match_cache``
+    SQLite table, shared by every worker process and bounded by a TTL and a
+    maximum row count (least recently accessed rows are evicted first).
+    Keys include the catalog version so a catalog change never serves
+    choices computed against a previous catalog.
+    """
+
+    EVICT_EVERY = 256  # puts between SQLite size checks
+
+    def __init__(self, max_memory: int = MATCH_CACHE_SIZE, max_rows: int = MATCH_CACHE_MAX_ROWS,
+                 ttl: int = MATCH_CACHE_TTL):
+        self.max_memory = max_memory
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self._lru: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.counts = Counter(memory_hits=0, sqlite_hits=0, misses=0)
+
+    @staticmethod
+    def key(description: str, version: Optional[str] = None) -> str:
+        return f"{version or current_catalog().version}:{normalize_description(description)}"
+
+    def clear(self) -> None:
+        """Drop the in-process tier and reset counters."""
+        with self._lock:
+            self._lru.clear()
+            self.counts = Counter(memory_hits=0, sqlite_hits=0, misses=0)
+
+    def _remember(self, key: str, choices: List[Dict[str, Any]], expires_at: float) -> None:
+        with self._lock:
+            self._lru[key] = (expires_at, choices)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_memory:
+                self._lru.popitem(last=False)
+
+    def get_many(self, conn: sqlite3.Connection, descriptions: Sequence[str],
+                 version: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """Return cached choices for the given descriptions (misses are omitted)."""
+        version = version or current_catalog().version
+        now = time.time()
+        found: Dict[str, List[Dict[str, Any]]] = {}
+        pending: Dict[str, List[str]] = {}
+        with self._lock:
+            for description in descriptions:
+                key = self.key(description, version)
+                entry = self._lru.get(key)
+                if entry and entry[0] > now:
+                    self._lru.move_to_end(key)
+                    self.counts["memory_hits"] += 1
+                    found[description] = entry[1]
+                else:
+                    pending.setdefault(key, []).append(description)
+
+        sqlite_hits = 0
+        keys = list(pending)
+        for start in range(0, len(keys), 500):  # stay under SQLite's variable limit
+            chunk = keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT cache_key, choice_json, created_at FROM match_cache "
+                f"WHERE cache_key IN ({','.join('?' * len(chunk))}) AND created_at > ?",
+                (*chunk, now - self.ttl),
+            ).fetchall()
+            hit_keys = []
+            for row in rows:
+                choices = json.loads(row["choice_json"])
+                self._remember(row["cache_key"], choices, row["created_at"] + self.ttl)
+                hit_keys.append(row["cache_key"])
+                for description in pending.pop(row["cache_key"]):
+                    found[description] = choices
+                    sqlite_hits += 1
+            if hit_keys:
+                with conn:
+                    conn.execute(
+                        f"UPDATE match_cache SET accessed_at=? "
+                        f"WHERE cache_key IN ({','.join('?' * len(hit_keys))})",
+                        (now, *hit_keys),
+                    )
+
+        with self._lock:
+            self.counts["sqlite_hits"] += sqlite_hits
+            self.counts["misses"] += sum(len(misses) for misses in pending.values())
+        return found
+
+    def put_many(self, conn: sqlite3.Connection, results: Dict[str, List[Dict[str, Any]]],
+                 version: Optional[str] = None) -> None:
+        """Store non-empty match results in both tiers."""
+        version = version or current_catalog().version
+        now = time.time()
+        rows = {}
+        for description, choices in results.items():
+            if not choices:
+                continue  # never cache failures
+            key = self.key(description, version)
+            self._remember(key, choices, now + self.ttl)
+            rows[key] = (key, json.dumps(choices), now, now)
+        if not rows:
+            return
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO match_cache(cache_key, choice_json, created_at, accessed_at) "
+                "VALUES(?,?,?,?)",
+                rows.values(),
+            )
+        self._puts += len(rows)
+        if self._puts >= self.EVICT_EVERY:
+            self._puts = 0
+            self.evict(conn)
+
+    def evict(self, conn: sqlite3.Connection) -> int:
+        """Drop expired rows and trim the SQLite tier to ``max_rows``."""
+        with conn:
+            removed = conn.execute(
+                "DELETE FROM match_cache WHERE created_at <= ?", (time.time() - self.ttl,)
+            ).rowcount
+            excess = conn.execute("SELECT COUNT(*) FROM match_cache").fetchone()[0] - self.max_rows
+            if excess > 0:
+                removed += conn.execute(
+                    "DELETE FROM match_cache WHERE cache_key IN "
+                    "(SELECT cache_key FROM match_cache ORDER BY accessed_at LIMIT ?)",
+                    (excess,),
+                ).rowcount
+        return removed
+
+    def stats(self, conn: sqlite3.Connection) -> Dict[str, Any]:
+        """Hit/miss counters and tier sizes, for sizing the cache."""
+        with self._lock:
+            counts = dict(self.counts)
+            memory_entries = len(self._lru)
+        lookups = sum(counts.values())
+        hits = counts["memory_hits"] + counts["sqlite_hits"]
+        return {
+            **counts,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": memory_entries,
+            "memory_capacity": self.max_memory,
+            "sqlite_rows": conn.execute("SELECT COUNT(*) FROM match_cache").fetchone()[0],
+            "sqlite_capacity": self.max_rows,
+            "ttl_seconds": self.ttl,
+            "catalog_version": current_catalog().version,
+        }
+
+
+MATCH_CACHE = MatchCache()
+
+
+def custom_match(description: str, use_custom: bool = False) -> List[Dict[str, Any]]:
+    """
+    Custom matching algorithm using fuzzy string matching
+    Returns matches in the same format as the production API
+    """
+    index = current_catalog().index
+    if not use_custom or not len(index):
+        return []
+    
+    try:
+        # Only the blocked candidate set is scored, not the whole catalog.
+        # The "(Qty: n)" suffix is ours, not the customer's: its digits would
+        # block on unrelated sizes (612 -> M12), and cached results are shared
+        # across quantities anyway.
+        with METRICS.timed("custom_match_duration_seconds"):
+            matches = index.search(_QTY_SUFFIX_RE.sub("", description), limit=10,
+                                   score_cutoff=MATCH_SCORE_CUTOFF)
+        
+        # Convert to expected format
+        results = []
+        for match in matches:
+            results.append({
+                "name": match["name"],
+                "score": match["score"] / 100.0  # Convert to 0-1 scale
+            })
+        
+        return results
+    except Exception as e:
+        LOG.error(f"Custom matching failed: {e}")
+        return []
+
+# ---- CATALOG SEARCH ----
+
+# Prefix hits fetched per requested result and re-ranked by similarity
+SEARCH_RANK_POOL = 10
+
+_fts_versions: Dict[str, str] = {}  # db path -> catalog version indexed there
+_fts_lock = threading.Lock()
+
+
+def ensure_catalog_fts(conn: sqlite3.Connection, state: Optional[CatalogState] = None) -> None:
+    """Make ``catalog_fts`` reflect the live catalog, rebuilding it if stale.
+
+    The rebuild runs in one transaction, so with WAL concurrent searches
+    keep reading the previous index until the new one commits.
+    """
+    state = state or current_catalog()
+    db_path = _current_db_path()
+    if _fts_versions.get(db_path) == state.version:
+        return
+    with _fts_lock:
+        row = conn.execute("SELECT value FROM catalog_meta WHERE key='fts_version'").fetchone()
+        if row is None or row["value"] != state.version:
+            started = time.monotonic()
+            names = state.catalog.names
+            with conn:
+                conn.execute("DELETE FROM catalog_fts")
+                conn.executemany(
+                    "INSERT INTO catalog_fts(name, row_id) VALUES(?,?)",
+                    ((name, row_id) for row_id, name in enumerate(names)),
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO catalog_meta(key, value) VALUES('fts_version', ?)",
+                    (state.version,),
+                )
+            LOG.info("Indexed %d catalog names for search in %.2fs",
+                     len(names), time.monotonic() - started)
+        _fts_versions[db_path] = state.version
+
+
+def search_catalog(conn: sqlite3.Connection, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+    """Typeahead search over the whole catalog.
+
+    Every query token is matched as a prefix through the FTS5 index. When
+    that yields fewer than ``limit`` hits, e.g. because of a
+    typo, the fuzzy ``CatalogIndex`` fills the remaining slots.
+    """
+    state = current_catalog()
+    tokens = _tokenize(query)
+    if not tokens or not len(state.catalog):
+        return []
+    ensure_catalog_fts(conn, state)
+
+    # bm25 ranking would score every row matching a short prefix ("ste*"),
+    # so take a bounded slice of the matches and rank that by similarity.
+    fts_query = " ".join(f'"{t}"*' for t in tokens)
+    rows = conn.execute(
+        "SELECT row_id FROM catalog_fts WHERE catalog_fts MATCH ? LIMIT ?",
+        (fts_query, limit * SEARCH_RANK_POOL),
+    ).fetchall()
+    ranked = sorted(
+        (row["row_id"] for row in rows),
+        key=lambda row_id: -fuzz.token_sort_ratio(query, state.catalog.names[row_id]),
+    )
+    hits = [(row_id, "prefix") for row_id in ranked[:limit]]
+
+    if len(hits) < limit and len(query.strip()) >= 3:
+        seen = {row_id for row_id, _ in hits}
+        for row_id in state.index.candidates(query):
+            if len(hits) >= limit:
+                break
+            if row_id not in seen:
+                hits.append((row_id, "fuzzy"))
+        # Keep the FTS order, but rank the fuzzy tail by actual similarity
+        head = [h for h in hits if h[1] == "prefix"]
+        tail = sorted(
+            (h for h in hits if h[1] == "fuzzy"),
+            key=lambda h: -fuzz.token_sort_ratio(query, state.catalog.names[h[0]]),
+        )
+        hits = head + tail
+
+    return [
+        {
+            "name": state.catalog.names[row_id],
+            "attributes": state.catalog.row(row_id),
+            "source": source,
+        }
+        for row_id, source in hits
+    ]
+
+
+# ---- MATCHING ----
+
+class Choices(list):
+    """Match choices tagged with the source that produced them: "remote"
+    (match API), "local" (catalog matcher), "cache" or "alias"."""
+
+    def __init__(self, choices: Sequence[Dict[str, Any]] = (), source: Optional[str] = None):
+        super().__init__(choices)
+        self.source = source
+
+
+def _upsert_aliases(conn: sqlite3.Connection, confirmed: Sequence[tuple]) -> None:
+    """Record ``(description, confirmed name)`` pairs in ``match_aliases``."""
+    now = time.time()
+    conn.executemany(
+        """
+        INSERT INTO match_aliases(description_key, name, confirmations, updated_at)
+        VALUES(?, ?, 1, ?)
+        ON CONFLICT(description_key) DO UPDATE SET
+            confirmations = CASE WHEN name = excluded.name THEN confirmations + 1 ELSE 1 END,
+            name = excluded.name,
+            updated_at = excluded.updated_at
+        """,
+        [(key, name, now) for key, name in
+         ((normalize_description(d), name) for d, name in confirmed) if key],
+    )
+
+
+def remember_confirmations(conn: sqlite3.Connection, match_ids: Sequence[int]) -> None:
+    """Teach the alias index the confirmed choices of the given matches.
+
+    The latest confirmation of a description wins. Runs in the caller's
+    transaction.
+    """
+    confirmed = []
+    for start in range(0, len(match_ids), 500):  # stay under SQLite's variable limit
+        chunk = match_ids[start:start + 500]
+        confirmed += conn.execute(
+            f"""
+            SELECT li.description, mc.name
+            FROM matches m
+            JOIN line_items li ON li.id = m.line_item_id
+            JOIN match_choices mc ON mc.match_id = m.id AND mc.rank = m.confirmed_id
+            WHERE m.id IN ({','.join('?' * len(chunk))})
+            """,
+            chunk,
+        ).fetchall()
+    _upsert_aliases(conn, [(r["description"], r["name"]) for r in confirmed])
+
+
+def lookup_aliases(conn: sqlite3.Connection,
+                   descriptions: Sequence[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """Choices for descriptions a user has confirmed before (misses are omitted).
+
+    The confirmed item is returned as a single full-score choice; callers
+    append the matcher's alternatives after it.
+    """
+    by_key: Dict[str, List[str]] = {}
+    for description in descriptions:
+        by_key.setdefault(normalize_description(description), []).append(description)
+    found: Dict[str, List[Dict[str, Any]]] = {}
+    keys = list(by_key)
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        for row in conn.execute(
+            f"SELECT description_key, name FROM match_aliases "
+            f"WHERE description_key IN ({','.join('?' * len(chunk))})",
+            chunk,
+        ):
+            for description in by_key[row["description_key"]]:
+                found[description] = Choices([{"name": row["name"], "score": 1.0}], "alias")
+    if found:
+        METRICS.inc("match_alias_hits_total", value=len(found))
+    return found
+
+
+def remote_choices(description: str) -> List[Dict[str, Any]]:
+    """Choices from the production match API; [] if it fails or is unavailable."""
+    try:
+        resp = match_api.call(params={"query": description, "limit": 5})
+        return [{"name": m["match"], "score": m["score"]} for m in resp.json()]
+    except CircuitOpenError:
+        return []  # fail fast straight to the local matcher
+    except Exception as e:
+        LOG.error(f"API matching failed: {e}")
+        return []
+
+
+def hedged_choices(description: str) -> Choices:
+    """Race the match API against the local matcher.
+
+    The API call starts on ``hedge_executor`` while the local matcher runs
+    on this thread; the API result is used if it is non-empty and arrives
+    within HEDGE_DEADLINE_MS, the local one otherwise. A late API call is
+    left to finish in the background and its result is dropped.
+    """
+    deadline = time.monotonic() + HEDGE_DEADLINE_MS / 1000
+    remote = hedge_executor.submit(remote_choices, description)
+    local = custom_match(description, use_custom=True)
+    try:
+        choices = remote.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        choices = []
+    winner = "remote" if choices else "local"
+    METRICS.inc("match_hedge_total", {"winner": winner})
+    return Choices(choices or local, winner)
+
+
+def fetch_choices(description: str) -> Choices:
+    """Match one description via the production API, falling back to custom matching."""
+    if HEDGE_DEADLINE_MS > 0:
+        return hedged_choices(description)
+    # Try production API first
+    choices = remote_choices(description)
+    if choices:
+        return Choices(choices, "remote")
+
+    # If API failed or returned no matches, use custom matching
+    LOG.info(f"Using custom matching for: {description}")
+    METRICS.inc("match_fallbacks_total")
+    return Choices(custom_match(description, use_custom=True), "local")
+
+
+def fill_missing_matches(conn: sqlite3.Connection, doc_id: int) -> int:
+    """Create matches for every line item of a document that has none yet.
+
+    Descriptions a user confirmed before get that item from the alias index
+    as their first choice, followed by the cached or local matcher's choices
+    (never an API call). Ones in ``MATCH_CACHE`` are not looked up again; the
+    rest run concurrently on ``match_executor`` (bounded by
+    MATCH_CONCURRENCY) and all results are written in a single transaction,
+    so latency tracks the slowest call rather than the sum of all calls.
+    Returns the number of matches created.
+    """
+    missing = conn.execute(
+        """
+        SELECT li.id, li.description
+        FROM line_items li LEFT JOIN matches m ON m.line_item_id = li.id
+        WHERE li.document_id=? AND m.id IS NULL
+        """,
+        (doc_id,),
+    ).fetchall()
+    if not missing:
+        return 0
+
+    # Pin the catalog version for the whole document
+    version = current_catalog().version
+
+    # Identical descriptions are looked up once; known or cached ones not at all
+    descriptions = list(dict.fromkeys(itm["description"] for itm in missing))
+    aliases = lookup_aliases(conn, descriptions)
+    cached = MATCH_CACHE.get_many(conn, descriptions, version)
+    resolved = {d: Choices(choices, "cache") for d, choices in cached.items()}
+    # The confirmed item goes first; the alternatives stay selectable after it
+    uncached = [d for d in aliases if d not in cached]
+    local = dict(zip(uncached, match_executor.map(
+        lambda d: custom_match(d, use_custom=True), uncached)))
+    for d, alias in aliases.items():
+        others = cached[d] if d in cached else local[d]
+        resolved[d] = Choices(
+            alias + [c for c in others if c["name"] != alias[0]["name"]], "alias"
+        )
+    by_key: Dict[str, List[str]] = {}
+    for d in descriptions:
+        if d not in resolved:
+            by_key.setdefault(MATCH_CACHE.key(d, version), []).append(d)
+    todo = [same[0] for same in by_key.values()]
+    fetched = dict(zip(todo, match_executor.map(fetch_choices, todo)))
+    # Local fallbacks (API down or past the hedge deadline) are not cached,
+    # so a brief outage does not pin them for MATCH_CACHE_TTL
+    MATCH_CACHE.put_many(
+        conn,
+        {d: c for d, c in fetched.items() if getattr(c, "source", None) != "local"},
+        version,
+    )
+    for same in by_key.values():
+        for d in same:
+            resolved[d] = fetched[same[0]]
+
+    stored = store_matches(
+        conn, [(itm["id"], resolved[itm["description"]]) for itm in missing], version
+    )
+    LOG.info("Matched %d items for doc %s", stored, doc_id)
+    return stored
+
+
+def store_matches(conn: sqlite3.Connection, results: Sequence[tuple],
+                  catalog_version: Optional[str] = None) -> int:
+    """Insert ``(line_item_id, choices)`` pairs as matches in one transaction,
+    tagged with the catalog version they were computed against and, for
+    ``Choices``, their source.
+
+    Line items matched meanwhile (jobs are delivered at least once, so two
+    match stages of a document can overlap) are skipped. Returns the number
+    of matches inserted.
+    """
+    catalog_version = catalog_version or current_catalog().version
+    stored = 0
+    with conn:
+        for line_item_id, choices in results:
+            row = conn.execute(
+                """
+                INSERT INTO matches(line_item_id, catalog_version, match_source) VALUES(?,?,?)
+                ON CONFLICT(line_item_id) DO NOTHING
+                RETURNING id
+                """,
+                (line_item_id, catalog_version, getattr(choices, "source", None)),
+            ).fetchone()
+            if row is None:
+                continue
+            match_id = row[0]
+            stored += 1
+            conn.executemany(
+                "INSERT INTO match_choices(match_id, rank, name, score) VALUES(?,?,?,?)",
+                [(match_id, rank, c["name"], c["score"]) for rank, c in enumerate(choices)],
+            )
+    return stored
+
+
+# ---- ROUTES ----
+@app.route("/")
+def home():
+    """Landing page with upload form or review table."""
+    return render_template("index.html")
+
+
+def register_upload(conn: sqlite3.Connection, filename: str, content_hash: str) -> int:
+    """Create or refresh the document row of a stored upload; returns its id."""
+    c = conn.cursor()
+    c.execute("INSERT OR IGNORE INTO documents(name) VALUES(?)", (filename,))
+    c.execute("UPDATE documents SET content_hash=? WHERE name=?", (content_hash, filename))
+    conn.commit()
+
+    doc_id = c.execute("SELECT id FROM documents WHERE name=?", (filename,)).fetchone()["id"]
+    set_status(conn, doc_id, "queued")
+    return doc_id
+
+
+@app.route("/upload", methods=["POST"])
+def upload():
+    """Handle PDF upload, save file, create document record, and queue parsing."""
+    if STREAM_EXTRACT:
+        return streaming_upload()
+    uploaded_file = request.files["file"]
+    filename = upload_filename(uploaded_file.filename)
+    if not filename:
+        return jsonify({"error": "uploaded file has no usable name"}), 400
+    content_hash = save_upload(uploaded_file.stream, os.path.join(UPLOAD_FOLDER, filename))
+
+    conn = db_conn()
+    doc_id = register_upload(conn, filename, content_hash)
+
+    # Run the extract -> match pipeline either synchronously or as a job
+    submit_document(conn, doc_id, filename)
+
+    return redirect(url_for("review", doc_id=doc_id))
+
+
+def streaming_upload():
+    """``/upload`` under STREAM_EXTRACT: extraction starts with the first bytes.
+
+    The regular extract job is still enqueued, but delayed by EXTRACT_TIMEOUT:
+    the streamed result wakes it early and it then reuses that result from
+    the extraction cache, while a crash of this process leaves it to extract
+    the stored file later.
+    """
+    boundary = request.mimetype_params.get("boundary", "")
+    if request.mimetype != "multipart/form-data" or not boundary:
+        return jsonify({"error": "expected a multipart/form-data upload"}), 400
+    received = tee_upload(request.stream, boundary.encode())
+    if received is None:
+        return jsonify({"error": "no named file in request"}), 400
+    filename, content_hash, extraction = received
+
+    conn = db_conn()
+    doc_id = register_upload(conn, filename, content_hash)
+    if extraction is None:  # empty file: nothing was streamed
+        submit_document(conn, doc_id, filename)
+    elif SYNC_PARSE:
+        store_streamed_extraction(extraction, content_hash)
+        run_pipeline(doc_id, filename)
+    else:
+        set_status(conn, doc_id, "extracting")
+        job_id = JOBS.enqueue(conn, "extract", {"doc_id": doc_id, "filename": filename},
+                              document_id=doc_id, delay=EXTRACT_TIMEOUT)
+        extraction.add_done_callback(
+            lambda f: store_streamed_extraction(f, content_hash, job_id)
+        )
+    return redirect(url_for("review", doc_id=doc_id))
+
+
+def _iter_batch_files(files) -> Generator[tuple, None, None]:
+    """Yield ``(filename, stream)`` for every PDF in an upload, expanding zips."""
+    for f in files:
+        name = upload_filename(f.filename)
+        if name.lower().endswith(".zip"):
+            with zipfile.ZipFile(f.stream) as archive:
+                for member in archive.infolist():
+                    member_name = upload_filename(member.filename)
+                    if member.is_dir() or not member_name.lower().endswith(".pdf"):
+                        continue
+                    with archive.open(member) as stream:
+                        yield member_name, stream
+        elif name:
+            yield name, f.stream
+
+
+@app.route("/api/batches", methods=["POST"])
+def create_batch():
+    """Accept many PDFs (or zip archives of PDFs) and process them as one batch."""
+    files = request.files.getlist("files") + request.files.getlist("file")
+    max_concurrency = max(1, min(
+        request.form.get("concurrency", BATCH_CONCURRENCY, type=int), MAX_WORKERS
+    ))
+
+    conn = db_conn()
+    c = conn.cursor()
+    c.execute("INSERT INTO batches(max_concurrency) VALUES(?)", (max_concurrency,))
+    batch_id = c.lastrowid
+
+    # Every file is stored under the batch with its position, and becomes a
+    # document of its own: equal basenames (acme/PO.pdf, globex/PO.pdf) never
+    # share a row or overwrite each other, nor an earlier single upload.
+    batch_dir = f"batch-{batch_id}"
+    os.makedirs(os.path.join(UPLOAD_FOLDER, batch_dir), exist_ok=True)
+    documents = []
+    try:
+        for seq, (basename, stream) in enumerate(_iter_batch_files(files), 1):
+            filename = f"{batch_dir}/{seq:04d}-{basename}"
+            content_hash = save_upload(stream, os.path.join(UPLOAD_FOLDER, filename))
+            doc_id = c.execute(
+                """
+                INSERT INTO documents(name, content_hash, batch_id, status, updated_at)
+                VALUES(?, ?, ?, 'queued', CURRENT_TIMESTAMP)
+                """,
+                (filename, content_hash, batch_id),
+            ).lastrowid
+            documents.append((doc_id, filename))
+    except zipfile.BadZipFile:
+        conn.rollback()
+        return jsonify({"error": "invalid zip archive"}), 400
+    if not documents:
+        conn.rollback()
+        return jsonify({"error": "no PDF files in request"}), 400
+    conn.commit()
+
+    LOG.info("Batch %s: queued %d documents", batch_id, len(documents))
+    for doc_id, filename in documents:
+        submit_document(conn, doc_id, filename, batch_id)
+    return jsonify(batch_progress(conn, batch_id)), 202
+
+
+def batch_progress(conn: sqlite3.Connection, batch_id: int) -> Optional[Dict[str, Any]]:
+    """Aggregate pipeline status for every document of a batch."""
+    batch = conn.execute("SELECT * FROM batches WHERE id=?", (batch_id,)).fetchone()
+    if batch is None:
+        return None
+    docs = conn.execute(
+        "SELECT id, name, status, error FROM documents WHERE batch_id=? ORDER BY id",
+        (batch_id,),
+    ).fetchall()
+    counts = {status: 0 for status in DOCUMENT_STATUSES}
+    for d in docs:
+        counts[d["status"]] = counts.get(d["status"], 0) + 1
+    return {
+        "batch_id": batch_id,
+        "max_concurrency": batch["max_concurrency"],
+        "created_at": batch["created_at"],
+        "total": len(docs),
+        "counts": counts,
+        "finished": counts["done"] + counts["failed"] == len(docs),
+        "documents": [
+            {"doc_id": d["id"], "name": d["name"], "status": d["status"], "error": d["error"]}
+            for d in docs
+        ],
+    }
+
+
+@app.route("/api/batches/<int:batch_id>")
+def batch_status(batch_id: int):
+    """JSON progress of a bulk upload."""
+    progress = batch_progress(db_conn(), batch_id)
+    if progress is None:
+        return jsonify({"error": "batch not found"}), 404
+    return jsonify(progress)
+
+
+@app.route("/api/documents/<int:doc_id>/status")
+def document_status(doc_id: int):
+    """JSON processing status of a document, polled by the review UI."""
+    conn = db_conn()
+    doc = conn.execute(
+        """
+        SELECT d.id, d.name, d.status, d.error, d.updated_at,
+               COUNT(li.id) AS items, COUNT(m.id) AS matched
+        FROM documents d
+        LEFT JOIN line_items li ON li.document_id = d.id
+        LEFT JOIN matches m ON m.line_item_id = li.id
+        WHERE d.id=?
+        GROUP BY d.id
+        """,
+        (doc_id,),
+    ).fetchone()
+    if doc is None:
+        return jsonify({"error": "document not found"}), 404
+    return jsonify(
+        {
+            "doc_id": doc["id"],
+            "name": doc["name"],
+            "status": doc["status"],
+            "error": doc["error"],
+            "items": doc["items"],
+            "matched": doc["matched"],
+            "updated_at": doc["updated_at"],
+        }
+    )
+
+
+# ---- INTERNAL TASKS ----
+
+# Pipeline states a document moves through; "failed" records the error.
+DOCUMENT_STATUSES = ("queued", "extracting", "matching", "done", "failed")
+
+
+_SET_STATUS_SQL = (
+    "UPDATE documents SET status=?, error=?, updated_at=CURRENT_TIMESTAMP WHERE id=?"
+)
+
+
+def set_status(conn: sqlite3.Connection, doc_id: int, status: str, error: str = None) -> None:
+    """Persist the pipeline status of a document."""
+    with conn:
+        conn.execute(_SET_STATUS_SQL, (status, error, doc_id))
+
+
+def extract_stage(doc_id: int, filename: str) -> None:
+    """Pipeline stage 1: extract and store a document's line items."""
+    conn = db_conn()
+    set_status(conn, doc_id, "extracting")
+    with METRICS.timed("pipeline_stage_duration_seconds", stage="extract"):
+        parse_and_store(doc_id, filename)
+    set_status(conn, doc_id, "matching")
+
+
+def match_stage(doc_id: int) -> None:
+    """Pipeline stage 2: precompute matches so /review only reads them."""
+    conn = db_conn()
+    set_status(conn, doc_id, "matching")
+    with METRICS.timed("pipeline_stage_duration_seconds", stage="match"):
+        fill_missing_matches(conn, doc_id)
+    set_status(conn, doc_id, "done")
+
+
+def run_pipeline(doc_id: int, filename: str) -> None:
+    """Run both stages inline (SYNC_PARSE), recording a failure on the document."""
+    try:
+        extract_stage(doc_id, filename)
+        match_stage(doc_id)
+    except Exception as e:
+        LOG.exception("Pipeline failed for doc %s", doc_id)
+        set_status(db_conn(), doc_id, "failed", str(e))
+
+
+def _worker_id() -> str:
+    """Name of this process (computed per call, so it is right after a fork)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _lease_owner() -> str:
+    """A fresh owner token for one lease attempt, unique across threads."""
+    return f"{_worker_id()}:{next(_lease_seq)}"
+
+
+_lease_seq = itertools.count(1)
+
+
+class JobQueue:
+    """Durable job queue in the ``jobs`` table, shared by every process.
+
+    Consumers lease one job at a time under an owner token of their own; a
+    lease is renewed while its handler runs (up to JOB_MAX_RUNTIME), and a
+    job whose lease expires (its worker died or hung) becomes leasable
+    again. Failed jobs are retried with exponential backoff until
+    ``max_attempts``, then kept as 'dead' for inspection and manual retry.
+    Jobs of a batch are only leased while fewer than the batch's
+    ``max_concurrency`` of them are running, wherever the workers are, and
+    only after runnable jobs of single uploads, which someone is waiting on.
+    Delivery is at-least-once, so handlers must be idempotent.
+    """
+
+    def __init__(self, lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, backoff: float = JOB_RETRY_BACKOFF):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._wakeup = threading.Condition()
+
+    def enqueue(self, conn: sqlite3.Connection, kind: str, payload: Dict[str, Any],
+                document_id: Optional[int] = None, batch_id: Optional[int] = None,
+                delay: float = 0) -> int:
+        now = time.time()
+        with conn:
+            job_id = conn.execute(
+                """
+                INSERT INTO jobs(kind, payload, document_id, batch_id, max_attempts, run_at, created_at)
+                VALUES(?,?,?,?,?,?,?)
+                """,
+                (kind, json.dumps(payload), document_id, batch_id, self.max_attempts,
+                 now + delay, now),
+            ).lastrowid
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def wait(self, timeout: float) -> None:
+        """Sleep until a job is enqueued in this process or ``timeout`` passes."""
+        with self._wakeup:
+            self._wakeup.wait(timeout)
+
+    def lease(self, conn: sqlite3.Connection, owner: str) -> Optional[sqlite3.Row]:
+        """Claim the next runnable job for ``owner``, or None."""
+        now = time.time()
+        with conn:
+            # Jobs whose worker died on their last attempt go to the dead letters
+            dead = conn.execute(
+                """
+                UPDATE jobs SET state='dead', lease_owner=NULL,
+                       last_error=COALESCE(last_error || '; ', '') || 'lease expired'
+                WHERE state='leased' AND lease_expires <= ? AND attempts >= max_attempts
+                RETURNING document_id, last_error
+                """,
+                (now,),
+            ).fetchall()
+            # Inline, not set_status: its own ``with conn`` would commit midway
+            conn.executemany(
+                _SET_STATUS_SQL,
+                [("failed", row["last_error"], row["document_id"])
+                 for row in dead if row["document_id"] is not None],
+            )
+            return conn.execute(
+                """
+                UPDATE jobs
+                SET state='leased', lease_owner=:owner, lease_expires=:expires,
+                    attempts=attempts + 1
+                WHERE id = (
+                    SELECT j.id FROM jobs j LEFT JOIN batches b ON b.id = j.batch_id
+                    WHERE ((j.state='queued' AND j.run_at <= :now)
+                           OR (j.state='leased' AND j.lease_expires <= :now))
+                      AND (b.id IS NULL OR b.max_concurrency > (
+                          SELECT COUNT(*) FROM jobs r
+                          WHERE r.batch_id = j.batch_id AND r.state='leased'
+                            AND r.lease_expires > :now))
+                    ORDER BY j.batch_id IS NOT NULL, j.run_at, j.id
+                    LIMIT 1
+                )
+                RETURNING *
+                """,
+                {"owner": owner, "expires": now + self.lease_seconds, "now": now},
+            ).fetchone()
+
+    def complete(self, conn: sqlite3.Connection, job: sqlite3.Row, owner: str) -> None:
+        with conn:
+            conn.execute("DELETE FROM jobs WHERE id=? AND lease_owner=?", (job["id"], owner))
+
+    def fail(self, conn: sqlite3.Connection, job: sqlite3.Row, owner: str, error: str) -> str:
+        """Schedule a retry, or dead-letter the job; returns the new state, or
+        "lost" if ``owner`` no longer holds the lease."""
+        state = "dead" if job["attempts"] >= job["max_attempts"] else "queued"
+        delay = random.uniform(0, self.backoff * 2 ** (job["attempts"] - 1))
+        with conn:
+            updated = conn.execute(
+                """
+                UPDATE jobs SET state=?, run_at=?, lease_owner=NULL, lease_expires=NULL,
+                       last_error=?
+                WHERE id=? AND lease_owner=?
+                """,
+                (state, time.time() + delay, error, job["id"], owner),
+            ).rowcount
+        return state if updated else "lost"
+
+    def heartbeat(self, conn: sqlite3.Connection, owners: Sequence[str]) -> int:
+        """Extend the leases held by ``owners``; returns how many."""
+        expires = time.time() + self.lease_seconds
+        with conn:
+            return conn.executemany(
+                "UPDATE jobs SET lease_expires=? WHERE state='leased' AND lease_owner=?",
+                [(expires, owner) for owner in owners],
+            ).rowcount
+
+    def wake(self, conn: sqlite3.Connection, job_id: int) -> None:
+        """Make a delayed job runnable now."""
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET run_at=MIN(run_at, ?) WHERE id=? AND state='queued'",
+                (time.time(), job_id),
+            )
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def retry(self, conn: sqlite3.Connection, job_id: int) -> bool:
+        """Requeue a dead job with a fresh set of attempts."""
+        with conn:
+            job = conn.execute(
+                """
+                UPDATE jobs SET state='queued', attempts=0, run_at=?
+                WHERE id=? AND state='dead'
+                RETURNING document_id
+                """,
+                (time.time(), job_id),
+            ).fetchone()
+            if job and job["document_id"] is not None:
+                conn.execute(_SET_STATUS_SQL, ("queued", None, job["document_id"]))
+        return job is not None
+
+    def counts(self, conn: sqlite3.Connection) -> Dict[str, int]:
+        counts = {"queued": 0, "leased": 0, "dead": 0}
+        for row in conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state"):
+            counts[row["state"]] = row["n"]
+        return counts
+
+
+JOBS = JobQueue()
+
+
+def _extract_job(job: sqlite3.Row) -> None:
+    payload = json.loads(job["payload"])
+    extract_stage(payload["doc_id"], payload["filename"])
+    JOBS.enqueue(db_conn(), "match", {"doc_id": payload["doc_id"]},
+                 document_id=payload["doc_id"], batch_id=job["batch_id"])
+
+
+def _match_job(job: sqlite3.Row) -> None:
+    match_stage(json.loads(job["payload"])["doc_id"])
+
+
+JOB_HANDLERS: Dict[str, Callable[[sqlite3.Row], None]] = {
+    "extract": _extract_job,
+    "match": _match_job,
+}
+
+
+def submit_document(conn: sqlite3.Connection, doc_id: int, filename: str,
+                    batch_id: Optional[int] = None) -> None:
+    """Process a stored upload: inline under SYNC_PARSE, else as a durable job."""
+    if SYNC_PARSE:
+        run_pipeline(doc_id, filename)
+        return
+    JOBS.enqueue(conn, "extract", {"doc_id": doc_id, "filename": filename},
+                 document_id=doc_id, batch_id=batch_id)
+
+
+class JobWorker:
+    """``threads`` consumer threads plus a lease heartbeat for one process."""
+
+    def __init__(self, threads: int, poll_seconds: float = JOB_POLL_SECONDS,
+                 max_runtime: float = JOB_MAX_RUNTIME):
+        self.threads = threads
+        self.poll_seconds = poll_seconds
+        self.max_runtime = max_runtime
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._running: Dict[str, float] = {}  # lease owner -> handler start
+        self._running_lock = threading.Lock()
+
+    def run_once(self) -> bool:
+        """Lease and run one job; returns False when none was runnable."""
+        conn, owner = db_conn(), _lease_owner()
+        job = JOBS.lease(conn, owner)
+        if job is None:
+            return False
+        with self._running_lock:
+            self._running[owner] = time.monotonic()
+        try:
+            return self._run_job(conn, job, owner)
+        finally:
+            with self._running_lock:
+                self._running.pop(owner, None)
+
+    def live_leases(self) -> List[str]:
+        """Owners of the handlers still running within ``max_runtime``; an
+        overdue one is dropped, so its lease expires and the job is retried."""
+        now = time.monotonic()
+        with self._running_lock:
+            for owner, started in list(self._running.items()):
+                if now - started >= self.max_runtime:
+                    LOG.warning("Job lease %s ran past %gs; no longer renewing it",
+                                owner, self.max_runtime)
+                    del self._running[owner]
+            return list(self._running)
+
+    def _run_job(self, conn: sqlite3.Connection, job: sqlite3.Row, owner: str) -> bool:
+        kind = job["kind"]
+        METRICS.observe("job_queue_wait_seconds", max(0.0, time.time() - job["run_at"]),
+                        {"kind": kind})
+        started = time.perf_counter()
+        priority = API_PRIORITY.set("batch" if job["batch_id"] is not None else "interactive")
+        try:
+            JOB_HANDLERS[kind](job)
+        except Exception as e:
+            LOG.exception("Job %s (%s, attempt %d) failed", job["id"], kind, job["attempts"])
+            outcome = JOBS.fail(conn, job, owner, f"{type(e).__name__}: {e}")
+            # A lost lease belongs to another run now, and so does the status
+            if job["document_id"] is not None and outcome != "lost":
+                status = "failed" if outcome == "dead" else "queued"
+                set_status(conn, job["document_id"], status, str(e))
+        else:
+            JOBS.complete(conn, job, owner)
+            outcome = "done"
+        finally:
+            API_PRIORITY.reset(priority)
+        METRICS.observe("job_duration_seconds", time.perf_counter() - started, {"kind": kind})
+        METRICS.inc("jobs_total", {"kind": kind, "outcome": outcome})
+        return True
+
+    def _consume(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                LOG.exception("Job consumer error")
+            JOBS.wait(self.poll_seconds)
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(JOBS.lease_seconds / 3):
+            try:
+                JOBS.heartbeat(db_conn(), self.live_leases())
+            except Exception:
+                LOG.exception("Lease heartbeat failed")
+
+    @staticmethod
+    def _run(target) -> None:
+        try:
+            target()
+        finally:
+            close_thread_connections()  # the thread's pooled db_conn()s
+
+    def start(self) -> "JobWorker":
+        targets = [self._heartbeat] + [self._consume] * self.threads
+        for i, target in enumerate(targets):
+            thread = threading.Thread(target=self._run, args=(target,),
+                                      name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self) -> None:
+        """Stop leasing; running jobs finish first."""
+        self._stop.set()
+
+    def join(self) -> None:
+        # Short joins keep the main thread responsive to signals
+        while any(t.is_alive() for t in self._threads):
+            for thread in self._threads:
+                thread.join(0.5)
+
+
+_embedded_worker: Optional[JobWorker] = None
+_embedded_worker_pid: Optional[int] = None
+_embedded_worker_lock = threading.Lock()
+
+
+def start_embedded_workers() -> None:
+    """Start EMBEDDED_WORKERS consumers in this process, once per process."""
+    global _embedded_worker, _embedded_worker_pid
+    if EMBEDDED_WORKERS <= 0 or _embedded_worker_pid == os.getpid():
+        return
+    with _embedded_worker_lock:
+        if _embedded_worker_pid != os.getpid():
+            _embedded_worker = JobWorker(EMBEDDED_WORKERS).start()
+            _embedded_worker_pid = os.getpid()
+
+
+def _run_worker_process(threads: int) -> None:
+    worker = JobWorker(threads).start()
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    LOG.info("Job worker %s consuming with %d threads", _worker_id(), threads)
+    try:
+        worker.join()
+    except KeyboardInterrupt:
+        worker.stop()
+        worker.join()
+
+
+@app.cli.command("worker")
+@click.option("--processes", "-p", default=1, show_default=True, help="Worker processes.")
+@click.option("--threads", "-t", default=MAX_WORKERS, show_default=True,
+              help="Consumer threads per process.")
+def worker_command(processes: int, threads: int) -> None:
+    """Consume pipeline jobs from the database in standalone processes."""
+    if processes <= 1:
+        _run_worker_process(threads)
+        return
+    # Nothing has started threads or opened connections yet, so forking is safe
+    ctx = multiprocessing.get_context("fork" if hasattr(os, "fork") else "spawn")
+    procs = [ctx.Process(target=_run_worker_process, args=(threads,), name=f"worker-{i}")
+             for i in range(processes)]
+    for proc in procs:
+        proc.start()
+
+    def shutdown(*_):
+        for proc in procs:
+            proc.terminate()  # SIGTERM: each finishes its running jobs
+
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        for proc in procs:
+            proc.join()
+    except KeyboardInterrupt:
+        shutdown()
+        for proc in procs:
+            proc.join()
+
+
+def extract_items(filename: str) -> List[Dict[str, Any]]:
+    """Post a stored upload to the extraction API and normalise its line items."""
+    # Upload file to extraction API using multipart form data
+    file_path = os.path.join(UPLOAD_FOLDER, filename)
+    with open(file_path, 'rb') as f:
+        files = {'file': (filename, f, 'application/pdf')}
+        resp = extract_api.call(files=files)
+    return format_extraction(resp.json())
+
+
+def format_extraction(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Normalise extraction API items to ``{"description": ...}`` dicts."""
+    # Convert the extraction API format to expected format
+    if items and isinstance(items[0], dict) and 'description' not in items[0]:
+        # API returns objects like {"Request Item": "...", "Amount": ..., ...}
+        # Convert to our expected format
+        formatted_items = []
+        for item in items:
+            request_item = item.get("Request Item", "")
+            amount = item.get("Amount", "")
+            # Create a description combining the key info
+            description = f"{request_item} (Qty: {amount})" if amount else request_item
+            formatted_items.append({"description": description})
+        items = formatted_items
+    return items
+
+
+class UploadAbandonedError(Exception):
+    """Raised inside a streamed request body once its ``ChunkPipe`` is
+    abandoned. Deliberately not an ``OSError``: requests would wrap that in
+    a ``ConnectionError`` and the abort would count against the upstream."""
+
+
+class ChunkPipe:
+    """Bounded hand-off of upload chunks from the request thread to the
+    thread posting them to the extraction API.
+
+    A full buffer blocks the producer, which slows the client down to the
+    API's pace. If the consumer takes nothing for ``stall_seconds`` (or has
+    gone away) the pipe is abandoned: ``put`` returns False from then on and
+    the consumer's iteration raises ``UploadAbandonedError``, aborting its
+    request.
+    """
+
+    _END = object()
+
+    def __init__(self, maxsize: int = STREAM_EXTRACT_BUFFER,
+                 stall_seconds: float = STREAM_EXTRACT_STALL_SECONDS):
+        self._queue: queue.Queue = queue.Queue(maxsize)
+        self.stall_seconds = stall_seconds
+        self.abandoned = threading.Event()
+
+    def put(self, chunk: Any) -> bool:
+        if self.abandoned.is_set():
+            return False
+        try:
+            self._queue.put(chunk, timeout=self.stall_seconds)
+            return True
+        except queue.Full:
+            LOG.warning("Extraction stream stalled; finishing the upload without it")
+            self.abandon()
+            return False
+
+    def close(self) -> None:
+        self.put(self._END)
+
+    def abandon(self) -> None:
+        self.abandoned.set()
+
+    def __iter__(self) -> Generator[bytes, None, None]:
+        while True:
+            # Chunks still buffered after an abandon are an incomplete file
+            if self.abandoned.is_set():
+                raise UploadAbandonedError("upload stream abandoned")
+            try:
+                chunk = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if chunk is self._END:
+                return
+            yield chunk
+
+
+def stream_extraction(filename: str, pipe: ChunkPipe) -> List[Dict[str, Any]]:
+    """Post the chunks arriving through ``pipe`` to the extraction API as a
+    chunked multipart upload, as if the file had been sent whole."""
+    boundary = os.urandom(16).hex()
+    encoder = MultipartEncoder(boundary.encode())
+
+    def body() -> Generator[bytes, None, None]:
+        yield encoder.send_event(
+            File("file", filename, Headers({"Content-Type": "application/pdf"}))
+        )
+        for chunk in pipe:
+            yield encoder.send_event(Data(chunk, more_data=True))
+        yield encoder.send_event(Epilogue(b""))
+
+    try:
+        resp = extract_api.call(
+            retry=False, data=body(),
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+    finally:
+        pipe.abandon()  # unblocks the upload if we never got to read it all
+    return format_extraction(resp.json())
+
+
+def tee_upload(stream, boundary: bytes) -> Optional[tuple]:
+    """Parse a multipart request body as it arrives, writing its ``file``
+    part to UPLOAD_FOLDER and streaming it to the extraction API at once.
+
+    Returns ``(filename, content_hash, extraction future)`` (the future is
+    None for an empty file), or None when the body has no ``file`` part with
+    a usable filename.
+    """
+    decoder = MultipartDecoder(boundary)
+    digest = hashlib.sha256()
+    filename = path = out = pipe = extraction = None
+
+    def handle_events() -> None:
+        nonlocal filename, path, out, pipe, extraction
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if (isinstance(event, File) and event.name == "file" and filename is None
+                    and upload_filename(event.filename)):
+                filename = upload_filename(event.filename)
+                path = os.path.join(UPLOAD_FOLDER, filename)
+                out = _upload_part(path)
+            elif isinstance(event, Data) and out is not None and not out.closed:
+                if event.data:
+                    digest.update(event.data)
+                    out.write(event.data)
+                    if pipe is None:
+                        pipe = ChunkPipe()
+                        extraction = stream_executor.submit(stream_extraction, filename, pipe)
+                    pipe.put(event.data)
+                if not event.more_data:
+                    out.close()
+                    if pipe is not None:
+                        pipe.close()
+            event = decoder.next_event()
+
+    try:
+        for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+            decoder.receive_data(chunk)
+            handle_events()
+        decoder.receive_data(None)
+        handle_events()
+        if filename is None:
+            return None
+        if not out.closed:
+            raise ValueError("upload ended inside the file part")
+    except BaseException:
+        if pipe is not None:
+            pipe.abandon()
+        if out is not None:
+            out.close()
+            os.remove(out.name)
+        raise
+    os.replace(out.name, path)
+    return filename, digest.hexdigest(), extraction
+
+
+def store_streamed_extraction(extraction, content_hash: str,
+                              job_id: Optional[int] = None) -> None:
+    """Cache a streamed extraction's items under the upload's content hash
+    (so the extract stage reuses them), then wake the document's job."""
+    conn = db_conn()
+    try:
+        items = extraction.result()
+    except Exception as e:
+        LOG.warning("Streamed extraction failed (%s); the job will extract the stored file", e)
+    else:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO extractions(content_hash, items_json) VALUES(?,?)",
+                (content_hash, json.dumps(items)),
+            )
+    if job_id is not None:
+        JOBS.wake(conn, job_id)
+
+
+def parse_and_store(doc_id: int, filename: str) -> None:
+    """Extract line items (reusing results for identical bytes), then persist them."""
+    LOG.info("Parsing doc %s", doc_id)
+
+    conn = db_conn()
+    doc = conn.execute("SELECT content_hash FROM documents WHERE id=?", (doc_id,)).fetchone()
+    content_hash = doc["content_hash"] if doc else None
+    cached = None
+    if content_hash:
+        cached = conn.execute(
+            "SELECT items_json FROM extractions WHERE content_hash=?", (content_hash,)
+        ).fetchone()
+
+    if cached:
+        LOG.info("Reusing extraction %s for doc %s", content_hash[:12], doc_id)
+        items = json.loads(cached["items_json"])
+    else:
+        items = extract_items(filename)
+        if content_hash:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO extractions(content_hash, items_json) VALUES(?,?)",
+                    (content_hash, json.dumps(items)),
+                )
+
+    store_line_items(conn, doc_id, [itm["description"] for itm in items])
+
+
+def store_line_items(conn: sqlite3.Connection, doc_id: int, descriptions: List[str]) -> None:
+    """Reconcile a document's line items with a fresh extraction.
+
+    Old and new lines are aligned by normalized description with difflib.
+    Lines that survive keep their row, match and confirmation (only their
+    position and exact text are updated); removed lines are deleted and
+    added or changed lines are inserted without a match, so the match
+    stage only looks up what is new.
+    """
+    old = conn.execute(
+        "SELECT id, description FROM line_items WHERE document_id=? ORDER BY raw_index",
+        (doc_id,),
+    ).fetchall()
+    matcher = difflib.SequenceMatcher(
+        None,
+        [normalize_description(r["description"]) for r in old],
+        [normalize_description(d) for d in descriptions],
+        autojunk=False,
+    )
+    kept, removed, added = [], [], []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            kept += [(-1 - j, descriptions[j], old[i]["id"])
+                     for i, j in zip(range(i1, i2), range(j1, j2))]
+        else:
+            removed += [(old[i]["id"],) for i in range(i1, i2)]
+            added += [(doc_id, descriptions[j], j) for j in range(j1, j2)]
+
+    with conn:  # ensures atomic commit / rollback
+        conn.executemany("DELETE FROM matches WHERE line_item_id=?", removed)
+        conn.executemany("DELETE FROM line_items WHERE id=?", removed)
+        # Park kept rows on negative positions so moving them never collides
+        # with idx_line_unique, then flip them into place.
+        conn.executemany(
+            "UPDATE line_items SET raw_index=?, description=? WHERE id=?", kept
+        )
+        conn.executemany(
+            "INSERT INTO line_items(document_id, description, raw_index) VALUES(?,?,?)", added
+        )
+        conn.execute(
+            "UPDATE line_items SET raw_index = -1 - raw_index WHERE document_id=? AND raw_index < 0",
+            (doc_id,),
+        )
+
+    LOG.info("Stored %d items for doc %s (%d kept, %d added, %d removed)",
+             len(descriptions), doc_id, len(kept), len(added), len(removed))
+
+
+@app.route("/api/health")
+def health():
+    """Liveness plus circuit breaker and scheduler state of each upstream API."""
+    upstreams = {
+        api.name: {**api.breaker.snapshot(), "scheduler": api.scheduler.snapshot()}
+        for api in (extract_api, match_api)
+    }
+    degraded = any(u["state"] != "closed" for u in upstreams.values())
+    return jsonify({"status": "degraded" if degraded else "ok", "upstreams": upstreams})
+
+
+_BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+def _live_gauges() -> None:
+    """Register gauges sampled from live state when /metrics is rendered."""
+    METRICS.describe(
+        "circuit_breaker_state", "gauge", "Upstream circuit state (0 closed, 1 half-open, 2 open).",
+        lambda: {(("api", api.name),): _BREAKER_STATES[api.breaker.state]
+                 for api in (extract_api, match_api)},
+    )
+    METRICS.describe(
+        "api_queue_waiting", "gauge", "Upstream calls waiting for admission, by priority.",
+        lambda: {(("api", api.name), ("priority", p)): n
+                 for api in (extract_api, match_api)
+                 for p, n in api.scheduler.snapshot()["waiting"].items()},
+    )
+    METRICS.describe(
+        "match_cache_lookups_total", "counter", "Match cache lookups by outcome.",
+        lambda: {(("outcome", k),): v for k, v in dict(MATCH_CACHE.counts).items()},
+    )
+    METRICS.describe(
+        "match_cache_memory_entries", "gauge", "Entries in the in-memory match cache tier.",
+        lambda: {(): len(MATCH_CACHE._lru)},
+    )
+    METRICS.describe(
+        "jobs", "gauge", "Pipeline jobs by state, across all workers.",
+        lambda: {(("state", k),): v for k, v in JOBS.counts(db_conn()).items()},
+    )
+    METRICS.describe(
+        "catalog_rows", "gauge", "Rows in the live catalog.",
+        lambda: {(("version", current_catalog().version),): len(current_catalog().catalog.names)},
+    )
+
+
+_live_gauges()
+
+
+@app.before_request
+def _start_job_consumers() -> None:
+    start_embedded_workers()
+
+
+@app.before_request
+def _start_request_timer() -> None:
+    g.request_started = time.perf_counter()
+    if PROFILE_SLOW_MS > 0:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def _record_request(response: Response) -> Response:
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or "unmatched"
+    METRICS.observe("http_request_duration_seconds", elapsed, {"endpoint": endpoint})
+    METRICS.inc("http_requests_total", {"endpoint": endpoint, "status": str(response.status_code)})
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        if elapsed * 1000 >= PROFILE_SLOW_MS:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(
+                PROFILE_DIR, f"{endpoint}-{time.strftime('%Y%m%d-%H%M%S')}-{int(elapsed * 1000)}ms.prof"
+            )
+            profiler.dump_stats(path)
+            LOG.info("Slow request %s took %.0f ms; profile written to %s",
+                     request.path, elapsed * 1000, path)
+    return response
+
+
+@app.route("/api/jobs")
+def jobs_overview():
+    """Job counts by state and the dead-lettered jobs."""
+    conn = db_conn()
+    dead = conn.execute(
+        """
+        SELECT id, kind, document_id, batch_id, attempts, last_error, created_at
+        FROM jobs WHERE state='dead' ORDER BY id DESC LIMIT 100
+        """
+    ).fetchall()
+    return jsonify({"counts": JOBS.counts(conn), "dead": [dict(r) for r in dead]})
+
+
+@app.route("/api/jobs/<int:job_id>/retry", methods=["POST"])
+def retry_job(job_id: int):
+    """Requeue a dead-lettered job."""
+    if not JOBS.retry(db_conn(), job_id):
+        return jsonify({"error": "no dead job with that id"}), 404
+    return jsonify({"job_id": job_id, "state": "queued"})
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus text exposition of latency histograms, counters and gauges."""
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/dashboard")
+def dashboard():
+    """Confirmation rates and most-confirmed catalog items.
+
+    Reads the incrementally maintained summary tables only, so the cost
+    does not grow with the number of processed documents.
+    """
+    conn = db_conn()
+    stats = conn.execute("SELECT * FROM confirmation_stats WHERE id = 1").fetchone()
+    top = conn.execute(
+        """
+        SELECT name, confirmations FROM sku_confirmations
+        WHERE confirmations > 0
+        ORDER BY confirmations DESC LIMIT ?
+        """,
+        (request.args.get("top", 10, type=int),),
+    ).fetchall()
+    matches_total = stats["matches_total"] if stats else 0
+    confirmed = stats["confirmed_total"] if stats else 0
+    top_choice = stats["top_choice_confirmed"] if stats else 0
+    return jsonify(
+        {
+            "matches_total": matches_total,
+            "confirmed_total": confirmed,
+            "top_choice_confirmed": top_choice,
+            "confirmation_rate": round(confirmed / matches_total, 4) if matches_total else 0.0,
+            "top_choice_rate": round(top_choice / confirmed, 4) if confirmed else 0.0,
+            "top_skus": [{"name": r["name"], "confirmations": r["confirmations"]} for r in top],
         }
-        for r in c.execute(
-            """
-        SELECT li.description, m.confirmed_id, m.choice_json
-        FROM matches m JOIN line_items li ON li.id=m.line_item_id
-        WHERE li.document_id=?
+    )
+
+
+@app.route("/api/catalog")
+def catalog_info():
+    """Version and shape of the live catalog."""
+    catalog = current_catalog().catalog
+    return jsonify(
+        {
+            "version": catalog.version,
+            "rows": len(catalog),
+            "columns": catalog.header,
+            "path": catalog.path,
+            "loaded_at": catalog.loaded_at,
+        }
+    )
+
+
+@app.route("/api/catalog/reload", methods=["POST"])
+def catalog_reload():
+    """Re-check the catalog file now instead of waiting for the watcher."""
+    force = request.args.get("force") == "1"
+    swapped = reload_catalog(force=force)
+    return jsonify({"reloaded": swapped, "version": current_catalog().version})
+
+
+@app.route("/api/catalog/search")
+def catalog_search():
+    """Typeahead search: ``?q=<text>&limit=<n>``."""
+    query = request.args.get("q", "")
+    limit = max(1, min(request.args.get("limit", 10, type=int), 50))
+    started = time.perf_counter()
+    results = search_catalog(db_conn(), query, limit)
+    return jsonify(
+        {
+            "query": query,
+            "version": current_catalog().version,
+            "results": results,
+            "took_ms": round((time.perf_counter() - started) * 1000, 2),
+        }
+    )
+
+
+@app.route("/api/matches/<int:match_id>/choices", methods=["POST"])
+def add_choice(match_id: int):
+    """Append a catalog item picked via search to a match's choices.
+
+    Returns the choice's rank (the value to confirm), reusing the existing
+    rank when the item is already a choice.
+    """
+    name = (request.get_json(silent=True) or {}).get("name", "").strip()
+    if not name:
+        return jsonify({"error": "name is required"}), 400
+    conn = db_conn()
+    with conn:
+        if conn.execute("SELECT 1 FROM matches WHERE id=?", (match_id,)).fetchone() is None:
+            return jsonify({"error": "match not found"}), 404
+        existing = conn.execute(
+            "SELECT rank FROM match_choices WHERE match_id=? AND name=?", (match_id, name)
+        ).fetchone()
+        if existing:
+            rank = existing["rank"]
+        else:
+            rank = conn.execute(
+                "SELECT COALESCE(MAX(rank) + 1, 0) FROM match_choices WHERE match_id=?",
+                (match_id,),
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO match_choices(match_id, rank, name, score) VALUES(?,?,?,NULL)",
+                (match_id, rank, name),
+            )
+    return jsonify({"match_id": match_id, "rank": rank, "name": name})
+
+
+@app.route("/api/match-cache/stats")
+def match_cache_stats():
+    """Hit/miss counters and occupancy of the match cache."""
+    return jsonify(MATCH_CACHE.stats(db_conn()))
+
+
+def fetch_review_rows(conn: sqlite3.Connection, doc_id: int, after: int = -1,
+                      limit: int = REVIEW_PAGE_SIZE) -> Dict[str, Any]:
+    """One page of matched review rows, keyset-paginated on ``raw_index``.
+
+    A single JOIN served by the (document_id, raw_index) unique index, so
+    the cost of a page does not depend on how far into the document it is.
+    ``next_after`` is the cursor for the following page (None at the end).
+    """
+    rows = conn.execute(
+        f"""
+        SELECT m.id AS match_id, li.raw_index, li.description,
+               {_CHOICES_JSON_SQL} AS choice_json, m.confirmed_id, m.catalog_version
+        FROM line_items li JOIN matches m ON m.line_item_id = li.id
+        WHERE li.document_id=? AND li.raw_index > ?
+        ORDER BY li.raw_index
+        LIMIT ?
+        """,
+        (doc_id, after, limit + 1),
+    ).fetchall()
+    page = rows[:limit]
+    return {
+        "rows": [
+            {
+                "match_id": r["match_id"],
+                "index": r["raw_index"],
+                "description": r["description"],
+                "choices": json.loads(r["choice_json"]),
+                "confirmed": r["confirmed_id"],
+                "catalog_version": r["catalog_version"],
+            }
+            for r in page
+        ],
+        "next_after": page[-1]["raw_index"] if len(rows) > limit else None,
+    }
+
+
+@app.route("/api/documents/<int:doc_id>/rows")
+def document_rows(doc_id: int):
+    """JSON page of review rows: ``?after=<cursor>&limit=<n>``."""
+    after = request.args.get("after", -1, type=int)
+    limit = max(1, min(request.args.get("limit", REVIEW_PAGE_SIZE, type=int), REVIEW_PAGE_MAX))
+    return jsonify(fetch_review_rows(db_conn(), doc_id, after, limit))
+
+
+@app.route("/review/<int:doc_id>")
+def review(doc_id: int):
+    """Display review UI for a specific document.
+
+    Matching happens in the background pipeline; this only reads what has
+    been computed so far. The first page of rows is rendered inline and the
+    browser pulls the rest from ``/api/documents/<id>/rows``.
+    """
+    conn = db_conn()
+    doc = conn.execute(
+        """
+        SELECT d.status, COUNT(li.id) AS items, COUNT(m.id) AS matched
+        FROM documents d
+        LEFT JOIN line_items li ON li.document_id = d.id
+        LEFT JOIN matches m ON m.line_item_id = li.id
+        WHERE d.id=?
+        GROUP BY d.id
         """,
+        (doc_id,),
+    ).fetchone()
+    status = doc["status"] if doc else None
+
+    # Rows left unmatched by an earlier run (e.g. documents from before the
+    # pipeline existed) get a fresh match stage instead of matching inline.
+    if status == "done" and doc["matched"] < doc["items"]:
+        set_status(conn, doc_id, "matching")
+        JOBS.enqueue(conn, "match", {"doc_id": doc_id}, document_id=doc_id)
+        status = "matching"
+
+    page = fetch_review_rows(conn, doc_id)
+    return render_template(
+        "index.html",
+        REVIEW_DATA={
+            "doc_id": doc_id,
+            "status": status,
+            "total": doc["matched"] if doc else 0,
+            "page_size": REVIEW_PAGE_SIZE,
+            **page,
+        },
+    )
+
+
+@app.route("/confirm/<int:doc_id>", methods=["POST"])
+def confirm(doc_id: int):
+    """Persist confirmed matches and return a CSV download.
+
+    The browser only posts the rows the reviewer picked a choice for; these
+    are confirmed and taught to the alias index. Every other unconfirmed row
+    of the document takes the choice the review page preselects (the top
+    one), flagged ``confirmed_by_default`` so neither the dashboard nor the
+    alias index treats it as reviewed.
+    """
+    conn = db_conn()
+    c = conn.cursor()
+
+    # Update confirmed IDs ("" means no match was chosen)
+    selections = [(int(sel) if sel != "" else None, int(mid)) for mid, sel in request.form.items()]
+    with conn:
+        c.execute(
+            """
+            UPDATE matches SET confirmed_id=0, confirmed_by_default=1
+            WHERE confirmed_id IS NULL
+              AND line_item_id IN (SELECT id FROM line_items WHERE document_id=?)
+              AND EXISTS (SELECT 1 FROM match_choices mc WHERE mc.match_id=matches.id AND mc.rank=0)
+            """,
             (doc_id,),
         )
-    ]
+        c.executemany(
+            "UPDATE matches SET confirmed_id=?, confirmed_by_default=0 WHERE id=?", selections
+        )
+        remember_confirmations(conn, [mid for sel, mid in selections if sel is not None])
 
-    return Response(
-        stream_csv(rows),
-        mimetype="text/csv",
-        headers={"Content-Disposition": f"attachment; filename=doc_{doc_id}.csv"},
+    return csv_response(
+        stream_csv(
+            _current_db_path(), ("description", "confirmed_choice"), _DOCUMENT_ROWS_SQL, (doc_id,)
+        ),
+        f"doc_{doc_id}.csv",
     )
 
 
+@app.route("/export")
+def export():
+    """Stream confirmed matches across documents as CSV.
+
+    Filters: ``doc_id`` (repeatable) and ``since`` / ``until`` upload dates
+    (YYYY-MM-DD, inclusive). Without filters every document is exported.
+
+    Documents are walked in id order and each one's rows are read through
+    idx_line_unique, so nothing is sorted beyond the list of document ids.
+    """
+    where, params = [], []
+    doc_ids = request.args.getlist("doc_id", type=int)
+    if doc_ids:
+        where.append(f"d.id IN ({','.join('?' * len(doc_ids))})")
+        params += doc_ids
+    try:
+        since, until = (
+            date.fromisoformat(request.args[k]) if request.args.get(k) else None
+            for k in ("since", "until")
+        )
+    except ValueError:
+        return jsonify({"error": "since/until must be YYYY-MM-DD"}), 400
+    if since:
+        where.append("d.uploaded_at >= ?")
+        params.append(since.isoformat())
+    if until:
+        where.append("d.uploaded_at < date(?, '+1 day')")
+        params.append(until.isoformat())
+
+    def rows(conn: sqlite3.Connection) -> Generator[tuple, None, None]:
+        documents = conn.execute(
+            f"SELECT d.id, d.name FROM documents d "
+            f"{'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY d.id",
+            params,
+        )
+        for doc_id, name in documents:
+            for description, choice in conn.execute(_DOCUMENT_ROWS_SQL, (doc_id,)):
+                yield name, description, choice
+
+    return csv_response(
+        stream_csv(_current_db_path(), ("document", "description", "confirmed_choice"), rows),
+        "export.csv",
+    )
+
 if __name__ == "__main__":
     app.run(debug=True, threaded=True) 
\ No newline at end of file
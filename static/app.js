@@ -1,35 +1,307 @@
+// Virtualized review rows: the server renders the first page and the rest is
+// fetched page by page (keyset cursor) as the reviewer scrolls. Only the rows
+// near the viewport exist in the DOM; a fixed pool of <tr> nodes is rebound
+// as the window moves, with spacer rows standing in for the others. Choices
+// live in `selections`, so rows scrolled out of the DOM are still submitted.
+// Only rows the reviewer changed are posted: the server confirms the others
+// with their preselected top choice by default, and learns no alias from them.
 document.addEventListener("DOMContentLoaded", () => {
   const data = window.REVIEW_DATA;
-  const wrapper = document.getElementById("review-section");
-  if (!data || !wrapper || wrapper.childElementCount > 0) return; // already rendered
-
-  // Build a form dynamically so the user can confirm matches
-  const form = document.createElement("form");
-  form.method = "POST";
-  form.action = `/confirm/${data.doc_id}`;
-  form.classList.add("mt-4");
-
-  const table = document.createElement("table");
-  table.classList.add("table", "table-striped");
-  table.innerHTML = "<tr><th>Description</th><th>Your Match</th></tr>";
-
-  data.rows.forEach((r) => {
-    const opts = r.choices
-      .map(
-        (c, i) =>
-          `<option value=\"${i}\" ${r.confirmed === i ? "selected" : ""}>${c}</option>`
-      )
-      .join("");
-
-    table.innerHTML += `
-      <tr>
-        <td>${r.description}</td>
-        <td><select name="${r.match_id}" class="form-select">${opts}</select></td>
-      </tr>`;
+  const tbody = document.getElementById("review-rows");
+  const form = document.getElementById("review-form");
+  if (!data || !tbody || !form) return;
+
+  const OVERSCAN = 10; // rows rendered above and below the viewport
+  const sentinel = document.getElementById("review-rows-sentinel");
+  const rows = data.rows.slice();
+  const selections = new Map(rows.map((row) => [row.match_id, String(row.confirmed ?? 0)]));
+  const pool = [];
+  const touched = new Set(); // match ids the reviewer picked a choice for
+  let after = data.next_after;
+  let loading = false;
+  let rowHeight = 88;
+  let scheduled = false;
+
+  const spacer = () => {
+    const tr = document.createElement("tr");
+    tr.className = "review-spacer";
+    tr.setAttribute("aria-hidden", "true");
+    const td = document.createElement("td");
+    td.colSpan = 2;
+    tr.appendChild(td);
+    return tr;
+  };
+  const top = spacer();
+  const bottom = spacer();
+
+  const createRow = () => {
+    const tr = document.createElement("tr");
+    const descCell = document.createElement("td");
+    const desc = document.createElement("div");
+    desc.className = "fw-semibold text-primary";
+    const label = document.createElement("div");
+    label.className = "text-muted small mt-1";
+    descCell.append(desc, label);
+
+    const selectCell = document.createElement("td");
+    const select = document.createElement("select");
+    select.className = "modern-select";
+    select.required = true;
+    selectCell.appendChild(select);
+    tr.append(descCell, selectCell);
+    return tr;
+  };
+
+  const bindRow = (tr, row) => {
+    const bound = tr.dataset.matchId === String(row.match_id);
+    if (bound && tr.dataset.choices === String(row.choices.length)) return;
+    tr.dataset.matchId = row.match_id;
+    tr.dataset.choices = row.choices.length;
+    const [descCell, selectCell] = tr.children;
+    descCell.children[0].textContent = row.description;
+    descCell.children[1].textContent = `Item ${row.index + 1}`;
+    const select = selectCell.firstChild;
+    select.name = row.match_id;
+    select.replaceChildren(new Option("Choose a match...", ""));
+    row.choices.forEach((c, i) => {
+      if (!c) return;
+      const label = c.score === null
+        ? `${c.name} (catalog search)`
+        : `${c.name} (${(c.score * 100).toFixed(1)}% match)`;
+      select.add(new Option(label, i));
+    });
+    select.value = selections.get(row.match_id);
+  };
+
+  const render = () => {
+    scheduled = false;
+    const offset = -tbody.getBoundingClientRect().top;
+    const visible = Math.ceil(window.innerHeight / rowHeight) + 2 * OVERSCAN;
+    const first = Math.max(0, Math.min(Math.floor(offset / rowHeight) - OVERSCAN, rows.length - visible));
+    const last = Math.min(rows.length, first + visible);
+
+    // Rows still in the window keep their node (and focus); the rest of the
+    // pool is rebound to the rows scrolling in.
+    const wanted = rows.slice(first, last);
+    const ids = new Set(wanted.map((row) => String(row.match_id)));
+    const byId = new Map(pool.map((tr) => [tr.dataset.matchId, tr]));
+    const free = pool.filter((tr) => !ids.has(tr.dataset.matchId));
+    const nodes = wanted.map((row) => {
+      let tr = byId.get(String(row.match_id)) || free.pop();
+      if (!tr) pool.push((tr = createRow()));
+      bindRow(tr, row);
+      return tr;
+    });
+
+    const keep = new Set(nodes);
+    for (const tr of [...tbody.children]) {
+      if (tr !== top && tr !== bottom && !keep.has(tr)) tr.remove();
+    }
+    let cursor = top.nextSibling;
+    for (const tr of nodes) {
+      if (tr === cursor) cursor = cursor.nextSibling;
+      else tbody.insertBefore(tr, cursor);
+    }
+    top.firstChild.style.height = `${first * rowHeight}px`;
+    bottom.firstChild.style.height = `${(rows.length - last) * rowHeight}px`;
+    if (nodes.length) {
+      rowHeight = nodes.reduce((sum, tr) => sum + tr.offsetHeight, 0) / nodes.length;
+    }
+    if (last >= rows.length - OVERSCAN) loadMore();
+  };
+
+  const schedule = () => {
+    if (!scheduled) {
+      scheduled = true;
+      requestAnimationFrame(render);
+    }
+  };
+
+  const loadMore = async () => {
+    if (loading || after === null) return;
+    loading = true;
+    try {
+      const params = new URLSearchParams({ after, limit: data.page_size });
+      const resp = await fetch(`/api/documents/${data.doc_id}/rows?${params}`);
+      if (!resp.ok) throw new Error(`HTTP ${resp.status}`);
+      const page = await resp.json();
+      page.rows.forEach((row) => {
+        rows.push(row);
+        selections.set(row.match_id, String(row.confirmed ?? 0));
+      });
+      after = page.next_after;
+      if (sentinel) sentinel.textContent = "Loading more items…";
+      schedule(); // may need the next page too if this one was short
+    } catch (err) {
+      // Retried by the next scroll rather than in a loop
+      if (sentinel) sentinel.textContent = "Could not load more items. Scroll to retry.";
+    } finally {
+      loading = false;
+    }
+    if (after === null && sentinel) sentinel.remove();
+  };
+
+  tbody.addEventListener("change", (e) => {
+    if (!e.target.matches("select")) return;
+    selections.set(Number(e.target.name), e.target.value);
+    touched.add(Number(e.target.name));
+  });
+
+  // A choice added from the catalog search belongs to the row, not the node
+  tbody.addEventListener("choiceadded", (e) => {
+    const row = rows.find((r) => r.match_id === Number(e.target.name));
+    if (!row) return;
+    row.choices[e.detail.rank] = { name: e.detail.name, score: null };
+    selections.set(row.match_id, String(e.detail.rank));
+    touched.add(row.match_id);
+    bindRow(e.target.closest("tr"), row);
+  });
+
+  // Rows outside the window have no <select>: post their choices as hidden
+  // fields (replaced on every submit, as the page stays open for the CSV).
+  // Untouched rendered rows are left out by dropping their select's name
+  // while the form is serialized.
+  let hidden = [];
+  form.addEventListener("submit", () => {
+    hidden.forEach((input) => input.remove());
+    const rendered = new Set(pool.map((tr) => tr.isConnected && tr.dataset.matchId));
+    const unnamed = [];
+    pool.forEach((tr) => {
+      const select = tr.querySelector("select");
+      if (select.name && !touched.has(Number(select.name))) {
+        unnamed.push([select, select.name]);
+        select.removeAttribute("name");
+      }
+    });
+    setTimeout(() => unnamed.forEach(([select, name]) => (select.name = name)));
+    hidden = [];
+    selections.forEach((value, matchId) => {
+      if (rendered.has(String(matchId)) || !touched.has(matchId)) return;
+      const input = document.createElement("input");
+      input.type = "hidden";
+      input.name = matchId;
+      input.value = value;
+      hidden.push(input);
+    });
+    form.append(...hidden);
+  });
+
+  window.addEventListener("scroll", schedule, { passive: true });
+  window.addEventListener("resize", schedule);
+  tbody.replaceChildren(top, bottom); // the server-rendered first page
+  render();
+});
+
+// Poll the document status while the extract/match pipeline is running and
+// reload once the precomputed matches are ready.
+document.addEventListener("DOMContentLoaded", () => {
+  const banner = document.getElementById("processing-status");
+  if (!banner) return;
+
+  const label = banner.querySelector(".status-text");
+  const url = `/api/documents/${banner.dataset.docId}/status`;
+
+  const poll = async () => {
+    try {
+      const resp = await fetch(url, { cache: "no-store" });
+      if (resp.ok) {
+        const status = await resp.json();
+        if (status.status === "done" || status.status === "failed") {
+          window.location.reload();
+          return;
+        }
+        label.textContent = `${status.status} (${status.matched}/${status.items} matched)`;
+      }
+    } catch (err) {
+      // Transient network errors: keep polling
+    }
+    setTimeout(poll, 1000);
+  };
+  setTimeout(poll, 1000);
+});
+
+// Catalog typeahead: debounced search over the whole catalog. Picking a
+// result adds it as a choice to the row whose select was focused last.
+document.addEventListener("DOMContentLoaded", () => {
+  const input = document.getElementById("catalog-search-input");
+  const results = document.getElementById("catalog-search-results");
+  const rows = document.getElementById("review-rows");
+  if (!input || !results || !rows) return;
+
+  const DEBOUNCE_MS = 150;
+  const cache = new Map(); // query -> results, avoids refetching on backspace
+  let timer = null;
+  let inflight = null;
+  let activeSelect = null;
+
+  rows.addEventListener("focusin", (e) => {
+    if (e.target.matches("select")) activeSelect = e.target;
+  });
+
+  const show = (items) => {
+    results.replaceChildren(
+      ...items.map((item) => {
+        const btn = document.createElement("button");
+        btn.type = "button";
+        btn.className = "list-group-item list-group-item-action";
+        btn.textContent = item.name;
+        btn.addEventListener("click", () => pick(item.name));
+        return btn;
+      })
+    );
+  };
+
+  const search = async (q) => {
+    if (cache.has(q)) return show(cache.get(q));
+    if (inflight) inflight.abort(); // only the latest keystroke matters
+    inflight = new AbortController();
+    try {
+      const resp = await fetch(`/api/catalog/search?${new URLSearchParams({ q })}`, {
+        signal: inflight.signal,
+      });
+      if (!resp.ok) return;
+      const body = await resp.json();
+      cache.set(q, body.results);
+      if (input.value.trim() === q) show(body.results);
+    } catch (err) {
+      if (err.name !== "AbortError") results.replaceChildren();
+    }
+  };
+
+  input.addEventListener("input", () => {
+    clearTimeout(timer);
+    const q = input.value.trim();
+    if (q.length < 2) {
+      results.replaceChildren();
+      return;
+    }
+    timer = setTimeout(() => search(q), DEBOUNCE_MS);
   });
 
-  form.appendChild(table);
-  form.innerHTML +=
-    '<button class="btn btn-success">Confirm &amp; Download CSV</button>';
-  wrapper.appendChild(form);
-}); 
\ No newline at end of file
+  const pick = async (name) => {
+    if (!activeSelect) {
+      input.setCustomValidity("Select a row's match first");
+      input.reportValidity();
+      input.setCustomValidity("");
+      return;
+    }
+    const resp = await fetch(`/api/matches/${activeSelect.name}/choices`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ name }),
+    });
+    if (!resp.ok) return;
+    const { rank } = await resp.json();
+    let option = [...activeSelect.options].find((o) => o.value === String(rank));
+    if (!option) {
+      option = new Option(`${name} (catalog search)`, rank);
+      activeSelect.add(option);
+    }
+    activeSelect.value = String(rank);
+    activeSelect.dispatchEvent(
+      new CustomEvent("choiceadded", { bubbles: true, detail: { rank, name } })
+    );
+    results.replaceChildren();
+    input.value = "";
+  };
+});
@@ -0,0 +1,249 @@
+"""
+Load test and latency benchmark for the upload -> review -> confirm flow.
+
+Starts ``tests/stub_api.py`` (with simulated latency, jitter, errors and
+document size) and the app against a synthetic catalog, drives concurrent
+users through the full workflow, and writes a JSON report with p50/p95/p99
+latency and throughput per operation, suitable for diffing between commits:
+
+    python tests/bench_load.py --catalog-rows 100000 --items 500 \\
+        --documents 40 --concurrency 8 --latency-ms 80 --jitter-ms 40 \\
+        --output bench.json --baseline bench-main.json
+
+Must be run from the repository root (like ``test_e2e.sh``).
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from synthetic import write_catalog  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class Recorder:
+    """Thread-safe collection of per-operation latencies and errors."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def timed(self, op: str, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            resp = fn(*args, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.errors[op] += 1
+            raise
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies[op].append(elapsed)
+            if resp.status_code >= 400:
+                self.errors[op] += 1
+        return resp
+
+    def record(self, op: str, seconds: float) -> None:
+        with self._lock:
+            self.latencies[op].append(seconds)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(recorder: Recorder, wall_seconds: float) -> Dict[str, dict]:
+    ops = {}
+    for op in sorted(set(recorder.latencies) | set(recorder.errors)):
+        values = sorted(recorder.latencies[op])
+        ops[op] = {
+            "count": len(values),
+            "errors": recorder.errors[op],
+            "rps": round(len(values) / wall_seconds, 2) if wall_seconds else 0.0,
+            "mean_ms": round(1000 * sum(values) / len(values), 2) if values else 0.0,
+            "p50_ms": round(1000 * percentile(values, 50), 2),
+            "p95_ms": round(1000 * percentile(values, 95), 2),
+            "p99_ms": round(1000 * percentile(values, 99), 2),
+            "max_ms": round(1000 * values[-1], 2) if values else 0.0,
+        }
+    return ops
+
+
+def run_user(base: str, doc_no: int, args, recorder: Recorder) -> None:
+    """One simulated user: upload a PDF, wait for the pipeline, review, confirm."""
+    session = requests.Session()
+    # Unique bytes per document so the extraction cache does not short-circuit
+    pdf = b"%PDF-1.4\n%" + os.urandom(16).hex().encode() + b"\n%%EOF"
+    started = time.perf_counter()
+    resp = recorder.timed(
+        "upload", session.post, f"{base}/upload",
+        files={"file": (f"bench-{doc_no:05d}.pdf", pdf, "application/pdf")},
+        allow_redirects=False,
+    )
+    doc_id = int(re.search(r"/review/(\d+)", resp.headers["Location"]).group(1))
+
+    deadline = time.monotonic() + args.pipeline_timeout
+    while time.monotonic() < deadline:
+        status = recorder.timed(
+            "status", session.get, f"{base}/api/documents/{doc_id}/status"
+        ).json()["status"]
+        if status in ("done", "failed"):
+            break
+        time.sleep(0.05)
+    # Upload to done/failed as seen by the user, extraction and matching included
+    recorder.record("pipeline" if status == "done" else f"pipeline_{status}",
+                    time.perf_counter() - started)
+
+    recorder.timed("review", session.get, f"{base}/review/{doc_id}")
+    selections, after = {}, -1
+    while after is not None:
+        page = recorder.timed(
+            "rows", session.get, f"{base}/api/documents/{doc_id}/rows",
+            params={"after": after, "limit": 200},
+        ).json()
+        for row in page["rows"]:
+            selections[str(row["match_id"])] = "0" if row["choices"] else ""
+        after = page["next_after"]
+    recorder.timed("confirm", session.post, f"{base}/confirm/{doc_id}", data=selections)
+
+
+def wait_until_up(url: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(report: dict, baseline: dict) -> None:
+    """Print p95/p99 and throughput deltas against an earlier report."""
+    print(f"\nvs {baseline.get('revision', '?')}:")
+    for op, cur in report["operations"].items():
+        old = baseline.get("operations", {}).get(op)
+        if not old:
+            continue
+        deltas = []
+        for key in ("p95_ms", "p99_ms", "rps"):
+            change = (cur[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            deltas.append(f"{key} {old[key]} -> {cur[key]} ({change:+.1f}%)")
+        print(f"  {op:<10} " + ", ".join(deltas))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--catalog-rows", type=int, default=10_000)
+    parser.add_argument("--items", type=int, default=200, help="line items per document")
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--local-match", action="store_true",
+                        help="stub returns no matches, exercising the local catalog matcher")
+    parser.add_argument("--app-port", type=int, default=5050)
+    parser.add_argument("--stub-port", type=int, default=5051)
+    parser.add_argument("--pipeline-timeout", type=float, default=300)
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="endeavor-bench-"))
+    (workdir / "uploads").mkdir()
+    catalog = workdir / "catalog.csv"
+    print(f"Generating {args.catalog_rows} catalog rows in {catalog}")
+    write_catalog(str(catalog), args.catalog_rows)
+
+    stub_env = {
+        **os.environ,
+        "STUB_PORT": str(args.stub_port),
+        "STUB_LATENCY_MS": str(args.latency_ms),
+        "STUB_JITTER_MS": str(args.jitter_ms),
+        "STUB_ERROR_RATE": str(args.error_rate),
+        "STUB_ITEMS": str(args.items),
+        "STUB_NO_MATCHES": "1" if args.local_match else "0",
+    }
+    app_env = {
+        **os.environ,
+        "ENDEAVOR_API": f"http://127.0.0.1:{args.stub_port}",
+        "DB_PATH": str(workdir / "bench.db"),
+        "CATALOG_PATH": str(catalog),
+        "SYNC_PARSE": "0",
+    }
+    # The app writes uploads relative to its working directory
+    procs = [
+        subprocess.Popen([sys.executable, str(ROOT / "tests" / "stub_api.py")], env=stub_env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, "-m", "flask", "--app", str(ROOT / "app.py"), "run",
+                          "--no-reload", "--with-threads", "--port", str(args.app_port)],
+                         env=app_env, cwd=workdir,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+    ]
+    base = f"http://127.0.0.1:{args.app_port}"
+    try:
+        wait_until_up(f"http://127.0.0.1:{args.stub_port}/match")
+        wait_until_up(f"{base}/api/health", timeout=120 + args.catalog_rows / 10_000)
+
+        recorder = Recorder()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(run_user, base, n, args, recorder)
+                       for n in range(args.documents)]
+            failures = sum(1 for f in futures if f.exception() is not None)
+        wall = time.perf_counter() - started
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait(timeout=10)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "wall_seconds": round(wall, 3),
+        "failed_users": failures,
+        "documents_per_second": round((args.documents - failures) / wall, 3),
+        "line_items_per_second": round((args.documents - failures) * args.items / wall, 1),
+        "operations": summarize(recorder, wall),
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+    print(json.dumps(report["operations"], indent=2))
+    print(f"Report written to {args.output}")
+    if args.baseline:
+        compare(report, json.loads(Path(args.baseline).read_text()))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
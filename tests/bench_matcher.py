@@ -0,0 +1,222 @@
+"""
+Micro-benchmark and accuracy regression check for the local catalog matcher.
+
+Runs ``custom_match`` over the sample PO line items recorded in
+``test_results.json`` against catalogs of increasing size, and reports per
+query latency percentiles, throughput, load time, peak RSS and top-1 /
+top-5 accuracy against the golden mapping (each line item's expected
+catalog name). Exits non-zero when accuracy falls below the thresholds or,
+given ``--baseline``, when latency or accuracy regressed past the allowed
+margin:
+
+    python tests/bench_matcher.py --sizes 1000,10000,100000,1000000 \\
+        --output bench-matcher.json --baseline bench-matcher-main.json
+
+Each catalog holds every catalog name seen in ``test_results.json`` (the
+golden targets and their nearest neighbours) plus filler drawn from the same
+vocabulary: near-duplicates of those names with one or two attributes
+(material, type, size, length, finish, thread) swapped, shuffled together.
+The filler therefore competes for every golden query, so a matcher that
+blocks the right row out of its candidates loses accuracy as the catalog
+grows.
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import importlib.util
+import json
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_load import git_revision, percentile  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+GOLDEN_PATH = ROOT / "test_results.json"
+
+DEFAULT_SIZES = "1000,10000,100000,1000000"
+# Accuracy floors: every golden item must rank its recorded match first,
+# however many near-duplicates the catalog holds.
+MIN_TOP1 = 1.0
+MIN_TOP5 = 1.0
+
+
+def load_golden(path: Path = GOLDEN_PATH) -> tuple:
+    """``({description: expected catalog name}, all catalog names seen)``.
+
+    The expected name is the top choice recorded for each line item.
+    """
+    golden: Dict[str, str] = {}
+    names = set()
+    for doc in json.loads(path.read_text()):
+        for item in doc.get("items", []):
+            if item["choices"]:
+                golden[item["description"]] = item["choices"][0]["name"]
+                names.update(c["name"] for c in item["choices"])
+    return golden, sorted(names)
+
+
+# "<material> <type> <size> <length> <finish> <thread>", e.g.
+# 'Stainless Steel Anchor M5 100mm Black Oxide Fine'
+_NAME_RE = re.compile(r'^(.+?) (\w+) (M\d+|\d+/\d+") (\d+mm) (.+) (\w+)$')
+
+
+def near_duplicates(real_names: List[str], count: int, seed: int = 0) -> List[List[str]]:
+    """``count`` catalog rows that each differ from a real name in one or two
+    attributes, drawn from the attribute values the real names use."""
+    parsed = [m.groups() for m in map(_NAME_RE.match, real_names) if m]
+    vocab = [sorted(set(slot)) for slot in zip(*parsed)]
+    taken = set(real_names)
+    rng = random.Random(seed)
+    rows = []
+    while len(rows) < count:
+        attrs = list(rng.choice(parsed))
+        for slot in rng.sample(range(len(vocab)), rng.choice((1, 2))):
+            attrs[slot] = rng.choice(vocab[slot])
+        name = " ".join(attrs)
+        if name not in taken:
+            material, kind, size, length, finish, _ = attrs
+            rows.append([name, kind, material, size, length, finish])
+    return rows
+
+
+def write_catalog(path: str, rows: int, real_names: List[str], seed: int = 0) -> None:
+    """Catalog CSV of ``rows`` rows: ``real_names`` plus near-duplicate filler."""
+    rng = random.Random(seed)
+    all_rows = [[name, "", "", "", "", ""] for name in real_names]
+    all_rows += near_duplicates(real_names, max(0, rows - len(real_names)), seed)
+    rng.shuffle(all_rows)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Name", "Type", "Material", "Size", "Length", "Finish"])
+        writer.writerows(all_rows)
+
+
+def run_size(app_module, rows: int, golden: Dict[str, str], real_names: List[str],
+             workdir: str, repeat: int = 3) -> dict:
+    """Load a ``rows``-row catalog into the app and time/score ``custom_match``."""
+    path = os.path.join(workdir, f"catalog-{rows}.csv")
+    write_catalog(path, rows, real_names)
+    app_module.CATALOG_PATH = path
+
+    started = time.perf_counter()
+    app_module.reload_catalog(force=True)
+    load_seconds = time.perf_counter() - started
+
+    latencies, top1, top5 = [], 0, 0
+    for description, expected in golden.items():
+        for _ in range(repeat):
+            started = time.perf_counter()
+            choices = app_module.custom_match(description, use_custom=True)
+            latencies.append(time.perf_counter() - started)
+        ranked = [c["name"] for c in choices]
+        top1 += ranked[:1] == [expected]
+        top5 += expected in ranked[:5]
+    latencies.sort()
+    os.remove(path)
+    return {
+        "rows": len(app_module.current_catalog().catalog),
+        "queries": len(latencies),
+        "load_seconds": round(load_seconds, 3),
+        # Peak of the whole process so far; sizes run in increasing order
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "qps": round(len(latencies) / sum(latencies), 1) if latencies else 0.0,
+        "p50_ms": round(1000 * percentile(latencies, 50), 3),
+        "p95_ms": round(1000 * percentile(latencies, 95), 3),
+        "p99_ms": round(1000 * percentile(latencies, 99), 3),
+        "top1": round(top1 / len(golden), 4),
+        "top5": round(top5 / len(golden), 4),
+    }
+
+
+def check(report: dict, args, baseline: dict = None) -> List[str]:
+    """Threshold and baseline violations of ``report``, as messages."""
+    failures = []
+    for size, cur in report["sizes"].items():
+        if cur["top1"] < args.min_top1:
+            failures.append(f"{size} rows: top-1 {cur['top1']} < {args.min_top1}")
+        if cur["top5"] < args.min_top5:
+            failures.append(f"{size} rows: top-5 {cur['top5']} < {args.min_top5}")
+        if args.max_p95_ms and cur["p95_ms"] > args.max_p95_ms:
+            failures.append(f"{size} rows: p95 {cur['p95_ms']} ms > {args.max_p95_ms} ms")
+        old = (baseline or {}).get("sizes", {}).get(size)
+        if not old:
+            continue
+        print(f"  {size:>8} rows vs {baseline.get('revision', '?')}: "
+              f"p95 {old['p95_ms']} -> {cur['p95_ms']} ms, "
+              f"top-1 {old['top1']} -> {cur['top1']}, top-5 {old['top5']} -> {cur['top5']}")
+        if cur["p95_ms"] > old["p95_ms"] * (1 + args.max_slowdown):
+            failures.append(f"{size} rows: p95 {cur['p95_ms']} ms is more than "
+                            f"{args.max_slowdown:.0%} slower than {old['p95_ms']} ms")
+        for key in ("top1", "top5"):
+            if cur[key] < old[key] - args.max_accuracy_drop:
+                failures.append(f"{size} rows: {key} fell from {old[key]} to {cur[key]}")
+    return failures
+
+
+def load_app():
+    """Import app.py the way the tests do, without a catalog watcher or snapshots."""
+    os.environ.setdefault("CATALOG_POLL_SECONDS", "0")
+    os.environ.setdefault("CATALOG_SNAPSHOT_DIR", "")
+    spec = importlib.util.spec_from_file_location("endeavor_app", ROOT / "app.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated catalog sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per query")
+    parser.add_argument("--min-top1", type=float, default=MIN_TOP1)
+    parser.add_argument("--min-top5", type=float, default=MIN_TOP5)
+    parser.add_argument("--max-p95-ms", type=float, default=0, help="absolute p95 cap (0 = none)")
+    parser.add_argument("--max-slowdown", type=float, default=0.25,
+                        help="allowed p95 increase over --baseline (fraction)")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.0,
+                        help="allowed top-1/top-5 drop below --baseline")
+    parser.add_argument("--output", default="bench-matcher.json")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    args = parser.parse_args()
+
+    app_module = load_app()
+    golden, real_names = load_golden()
+    print(f"{len(golden)} golden line items, {len(real_names)} real catalog names")
+    sizes = {}
+    with tempfile.TemporaryDirectory(prefix="endeavor-matcher-") as workdir:
+        for rows in (int(s) for s in args.sizes.split(",")):
+            result = sizes[str(rows)] = run_size(
+                app_module, rows, golden, real_names, workdir, args.repeat
+            )
+            print(f"  {rows:>8} rows: load {result['load_seconds']}s, "
+                  f"peak RSS {result['max_rss_mb']} MB, p50 {result['p50_ms']} ms, "
+                  f"p95 {result['p95_ms']} ms, {result['qps']} q/s, "
+                  f"top-1 {result['top1']}, top-5 {result['top5']}")
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {"repeat": args.repeat,
+                   "max_candidates": app_module.MATCH_MAX_CANDIDATES,
+                   "score_cutoff": app_module.MATCH_SCORE_CUTOFF},
+        "sizes": sizes,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+    print(f"Report written to {args.output}")
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    failures = check(report, args, baseline)
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,55 @@
 """
 Lightweight stub of the Endeavor extract & match APIs
+
+By default it returns two fixed items instantly. For load tests it can
+simulate a slow, flaky upstream with large documents:
+
+    STUB_LATENCY_MS   mean added latency per request (default 0)
+    STUB_JITTER_MS    uniform +/- jitter around the mean (default 0)
+    STUB_ERROR_RATE   fraction of requests answered with 503 (default 0)
+    STUB_ITEMS        line items per extracted document (default: the 2 fixed items)
+    STUB_NO_MATCHES   answer /match with [] so the app's local catalog matcher runs
+    STUB_PORT         port to listen on (default 5001)
 """
+import os
+import random
+import time
+import zlib
+
 from flask import Flask, request, jsonify
 
+from synthetic import line_items
+
 app = Flask("stub_api")
 
+LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "0"))
+JITTER_MS = float(os.getenv("STUB_JITTER_MS", "0"))
+ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+ITEMS = int(os.getenv("STUB_ITEMS", "0"))
+NO_MATCHES = os.getenv("STUB_NO_MATCHES", "0") == "1"
+
+
+@app.before_request
+def simulate_upstream():
+    """Sleep for the configured latency and fail a fraction of requests."""
+    delay = LATENCY_MS + random.uniform(-JITTER_MS, JITTER_MS)
+    if delay > 0:
+        time.sleep(delay / 1000)
+    if ERROR_RATE and random.random() < ERROR_RATE:
+        return jsonify({"error": "simulated upstream failure"}), 503
+    return None
+
 
 @app.route("/extraction_api", methods=["POST"])
 def extract():
     """Return dummy extraction results in the production API format."""
     # Production API returns array of objects like:
     # [{"Request Item": "...", "Amount": ..., "Unit Price": null, "Total": null}, ...]
+    if ITEMS:
+        # Seeded by the upload so the same file always yields the same items
+        upload = request.files.get("file")
+        seed = zlib.crc32(upload.read()) if upload else 0
+        return jsonify(line_items(ITEMS, seed))
     return jsonify([
         {
             "Request Item": "Easy-1: Widget A",
@@ -19,7 +58,7 @@ def extract():
             "Total": None
         },
         {
-            "Request Item": "Easy-1: Widget B", 
+            "Request Item": "Easy-1: Widget B",
             "Amount": 50,
             "Unit Price": None,
             "Total": None
@@ -34,16 +73,18 @@ def match():
     # [{"match": "...", "score": ...}, ...]
     query = request.args.get("query", "")
     limit = int(request.args.get("limit", 5))
-    
+    if NO_MATCHES:
+        return jsonify([])
+
     # Return dummy matches
     matches = [
         {"match": "CAT-1000 – Widget A", "score": 0.95},
         {"match": "CAT-2000 – Widget B", "score": 0.87},
     ]
-    
+
     return jsonify(matches[:limit])
 
 
 if __name__ == "__main__":
     # Run stub on port 5001 so it won't conflict with the main app
-    app.run(port=5001) 
\ No newline at end of file
+    app.run(port=int(os.getenv("STUB_PORT", "5001")), threaded=True)
@@ -0,0 +1,66 @@
+"""
+Synthetic fastener data for load tests: catalogs of any size and RFQ line
+items drawn from the same vocabulary, so matches are realistic.
+
+    python tests/synthetic.py catalog.csv --rows 100000
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import random
+from typing import List
+
+MATERIALS = ["Steel", "Stainless", "Brass", "Nylon", "Aluminum", "Titanium", "Zinc"]
+KINDS = ["Bolt", "Hex Cap Screw", "Nut", "Washer", "Stud", "Rivet", "Anchor", "Pin"]
+SIZES = ['1/4"', '3/8"', '1/2"', "M3", "M4", "M5", "M6", "M8", "M10", "M12"]
+LENGTHS = [f"{n}mm" for n in range(5, 205, 5)]
+FINISHES = ["Plain", "Zinc Plated", "Nickel Plated", "Black Oxide", "Galvanized"]
+
+
+def catalog_row(rng: random.Random, sku: int) -> List[str]:
+    material, kind = rng.choice(MATERIALS), rng.choice(KINDS)
+    size, length, finish = rng.choice(SIZES), rng.choice(LENGTHS), rng.choice(FINISHES)
+    name = f"{material} {kind} {size} x {length} {finish} SKU{sku:07d}"
+    return [name, kind, material, size, length, finish]
+
+
+def write_catalog(path: str, rows: int, seed: int = 0) -> None:
+    """Write a catalog CSV with a ``Name`` column plus attribute columns."""
+    rng = random.Random(seed)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Name", "Type", "Material", "Size", "Length", "Finish"])
+        for sku in range(rows):
+            writer.writerow(catalog_row(rng, sku))
+
+
+def line_items(count: int, seed: int = 0) -> List[dict]:
+    """RFQ line items in the extraction API's response format.
+
+    Descriptions are catalog-like but noisy (dropped finish, quantity
+    suffixes, lower case) so the matcher has real work to do.
+    """
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        name, kind, material, size, length, finish = catalog_row(rng, i)
+        words = [material, kind, size, length] + ([finish] if rng.random() < 0.5 else [])
+        description = " ".join(words)
+        if rng.random() < 0.3:
+            description = description.lower()
+        amount = rng.randint(1, 500)
+        if rng.random() < 0.3:
+            description += f" (Qty: {amount})"
+        items.append({"Request Item": description, "Amount": amount,
+                      "Unit Price": None, "Total": None})
+    return items
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic catalog CSV.")
+    parser.add_argument("path")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_catalog(args.path, args.rows, args.seed)
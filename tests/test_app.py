@@ -1,4 +1,7 @@
+import io
+import json
 import os
+import time
 import pytest
 
 import importlib.util
@@ -22,7 +25,10 @@ def _setup_db(tmp_path, monkeypatch):
     monkeypatch.setenv("DB_PATH", str(db_path))
     # Update the module-level DB_PATH used by the app module
     monkeypatch.setattr(app_module, "DB_PATH", str(db_path), raising=False)
+    monkeypatch.setattr(app_module, "CATALOG_SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    monkeypatch.setattr(app_module, "EMBEDDED_WORKERS", 0)
     init_db()
+    app_module.MATCH_CACHE.clear()
 
 
 @pytest.fixture()
@@ -34,4 +40,1193 @@ def client():
 def test_home_page_loads(client):
     resp = client.get("/")
     assert resp.status_code == 200
-    assert b"Endeavor FDE MVP" in resp.data 
\ No newline at end of file
+    assert b"Endeavor FDE MVP" in resp.data 
+
+def test_catalog_index_matches_full_scan():
+    from fuzzywuzzy import fuzz, process
+
+    names = [
+        f"{material} {kind} {size} {finish}"
+        for material in ("Steel", "Brass", "Nylon")
+        for kind in ("Bolt", "Nut", "Washer", "Stud")
+        for size in ('1/4"', '1/2"', "M8", "M10")
+        for finish in ("Zinc Plated", "Nickel Plated", "Plain")
+    ]
+    index = app_module.CatalogIndex(names)
+    query = 'Brass Stud 1/2" Zinc Plated (Qty: 40)'
+
+    expected = process.extract(query, names, scorer=fuzz.token_sort_ratio, limit=5)
+    got = index.search(query, limit=5)
+    assert [m["score"] for m in got] == [score for _, score in expected]
+    assert 'Brass Stud 1/2" Zinc Plated' in {m["name"] for m in got}
+
+
+def test_catalog_index_blocks_candidates():
+    names = [f"Widget {i:05d}" for i in range(5000)] + ["Hex Cap Screw M8x30"]
+    index = app_module.CatalogIndex(names, max_candidates=50)
+    assert len(index.candidates("hex cap screw m8x30")) <= 50
+    assert index.search("hex cap scerw m8x30", limit=1)[0]["name"] == "Hex Cap Screw M8x30"
+    assert index.search("zzzz", limit=3) == []
+
+
+def test_catalog_index_finds_rows_past_scan_budget(monkeypatch):
+    monkeypatch.setattr(app_module.CatalogIndex, "SCAN_BUDGET", 500)
+    target = "Brass Washer M8 x 160mm Plain"
+    names = [
+        name for name in (
+            f"{material} {kind} M{size} x {length}mm Plain"
+            for length in range(10, 210, 10)
+            for size in (4, 5, 6, 8)
+            for material in ("Steel", "Brass", "Nylon")
+            for kind in ("Bolt", "Washer", "Stud", "Nut", "Pin")
+        )
+        if name != target
+    ] * 5 + [target]
+    index = app_module.CatalogIndex(names, max_candidates=20)
+    assert len(names) > 10 * index.SCAN_BUDGET
+    assert len(names) - 1 in index.candidates(target.lower())
+    assert index.search(target, limit=1) == [{"name": target, "score": 100}]
+
+
+def test_fill_missing_matches_runs_concurrently(monkeypatch):
+    import threading
+    import time
+
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.executemany(
+        "INSERT INTO line_items(document_id, description, raw_index) VALUES(1,?,?)",
+        [(f"item {i}", i) for i in range(8)],
+    )
+    conn.commit()
+
+    threads = set()
+
+    def slow_fetch(description):
+        threads.add(threading.get_ident())
+        time.sleep(0.1)
+        return [{"name": description.upper(), "score": 1.0}]
+
+    monkeypatch.setattr(app_module, "fetch_choices", slow_fetch)
+    started = time.monotonic()
+    assert app_module.fill_missing_matches(conn, 1) == 8
+    assert time.monotonic() - started < 0.5
+    assert len(threads) > 1
+    # Second pass finds nothing left to match
+    assert app_module.fill_missing_matches(conn, 1) == 0
+    assert conn.execute("SELECT COUNT(*) FROM matches").fetchone()[0] == 8
+
+
+def test_overlapping_match_stages_store_each_line_once(monkeypatch):
+    import threading
+
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.executemany(
+        "INSERT INTO line_items(document_id, description, raw_index) VALUES(1,?,?)",
+        [(f"item {i}", i) for i in range(3)],
+    )
+    conn.commit()
+    # Both runs read the unmatched lines before either stores its results
+    barrier = threading.Barrier(2)
+
+    def no_aliases(conn, descriptions):
+        barrier.wait()
+        return {}
+
+    monkeypatch.setattr(app_module, "lookup_aliases", no_aliases)
+    monkeypatch.setattr(app_module, "fetch_choices",
+                        lambda d: [{"name": d.upper(), "score": 1.0}])
+    stored = []
+    runs = [threading.Thread(target=lambda: stored.append(
+        app_module.fill_missing_matches(app_module.db_conn(), 1))) for _ in range(2)]
+    for run in runs:
+        run.start()
+    for run in runs:
+        run.join()
+    assert sorted(stored) == [0, 3]
+    assert conn.execute("SELECT COUNT(*) FROM matches").fetchone()[0] == 3
+    assert conn.execute("SELECT COUNT(*) FROM match_choices").fetchone()[0] == 3
+    assert len(app_module.fetch_review_rows(conn, 1)["rows"]) == 3
+
+
+def test_pipeline_records_status_and_precomputes_matches(client, monkeypatch):
+    monkeypatch.setattr(app_module, "SYNC_PARSE", True)
+
+    def fake_parse(doc_id, filename):
+        conn = app_module.db_conn()
+        with conn:
+            conn.execute(
+                "INSERT INTO line_items(document_id, description, raw_index) VALUES(?,?,0)",
+                (doc_id, "Hex Bolt M8"),
+            )
+
+    monkeypatch.setattr(app_module, "parse_and_store", fake_parse)
+    monkeypatch.setattr(
+        app_module, "fetch_choices", lambda d: [{"name": "CAT-1 Hex Bolt M8", "score": 0.9}]
+    )
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.commit()
+
+    app_module.run_pipeline(1, "po.pdf")
+
+    status = client.get("/api/documents/1/status").get_json()
+    assert status["status"] == "done"
+    assert status["items"] == status["matched"] == 1
+    assert b"CAT-1 Hex Bolt M8" in client.get("/review/1").data
+
+
+def test_pipeline_failure_is_reported(client, monkeypatch):
+    def broken_parse(doc_id, filename):
+        raise RuntimeError("extraction API unavailable")
+
+    monkeypatch.setattr(app_module, "parse_and_store", broken_parse)
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.commit()
+
+    app_module.run_pipeline(1, "po.pdf")
+
+    status = client.get("/api/documents/1/status").get_json()
+    assert status["status"] == "failed"
+    assert "unavailable" in status["error"]
+    assert client.get("/api/documents/99/status").status_code == 404
+
+
+def test_match_cache_tiers_and_stats(client, monkeypatch):
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.executemany(
+        "INSERT INTO line_items(document_id, description, raw_index) VALUES(1,?,?)",
+        [("Hex Bolt M8 (Qty: 10)", 0), ("hex bolt m8 (Qty: 250)", 1), ("Nylon Washer", 2)],
+    )
+    conn.commit()
+    calls = []
+
+    def fetch(description):
+        calls.append(description)
+        return [{"name": "CAT " + description, "score": 0.9}]
+
+    monkeypatch.setattr(app_module, "fetch_choices", fetch)
+    app_module.fill_missing_matches(conn, 1)
+    # Quantity and case differences share one cache entry
+    assert len(calls) == 2
+    cache = app_module.MATCH_CACHE
+    assert cache.key("Hex Bolt M8 (Qty: 10)") == cache.key("hex  bolt, M8 (Qty: 250)")
+
+    calls.clear()
+    conn.execute("DELETE FROM matches")
+    conn.commit()
+    cache.clear()  # force the SQLite tier
+    app_module.fill_missing_matches(conn, 1)
+    conn.execute("DELETE FROM matches")
+    conn.commit()
+    app_module.fill_missing_matches(conn, 1)
+    assert calls == []
+
+    stats = client.get("/api/match-cache/stats").get_json()
+    assert stats["sqlite_hits"] == 3 and stats["memory_hits"] == 3
+    assert stats["misses"] == 0
+    assert stats["sqlite_rows"] == 2
+
+
+def test_match_cache_eviction():
+    conn = app_module.db_conn()
+    cache = app_module.MatchCache(max_memory=2, max_rows=3, ttl=60)
+    cache.put_many(conn, {f"item {i}": [{"name": str(i), "score": 1.0}] for i in range(5)})
+    assert len(cache.get_many(conn, ["item 4"])) == 1
+    assert cache.evict(conn) == 2
+    assert conn.execute("SELECT COUNT(*) FROM match_cache").fetchone()[0] == 3
+    assert cache.put_many(conn, {"empty": []}) is None
+    assert cache.get_many(conn, ["empty"]) == {}
+
+
+def test_local_fallback_matches_are_not_cached(monkeypatch):
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.execute("INSERT INTO line_items(document_id, description, raw_index) VALUES(1,'Hex Nut',0)")
+    conn.commit()
+    sources = ["local", "remote"]  # API down, then back
+
+    def fetch(description):
+        source = sources.pop(0)
+        return app_module.Choices([{"name": f"{source} nut", "score": 0.9}], source)
+
+    monkeypatch.setattr(app_module, "fetch_choices", fetch)
+    app_module.fill_missing_matches(conn, 1)
+    assert conn.execute("SELECT COUNT(*) FROM match_cache").fetchone()[0] == 0
+
+    conn.execute("DELETE FROM matches")
+    conn.commit()
+    app_module.fill_missing_matches(conn, 1)
+    assert sources == []  # asked the API again instead of reusing the fallback
+    assert app_module.MATCH_CACHE.get_many(conn, ["Hex Nut"])["Hex Nut"][0]["name"] == "remote nut"
+
+
+def test_duplicate_upload_reuses_extraction(client, monkeypatch, tmp_path):
+    import hashlib
+    import io
+
+    monkeypatch.setattr(app_module, "UPLOAD_FOLDER", str(tmp_path))
+    monkeypatch.setattr(app_module, "SYNC_PARSE", True)
+    monkeypatch.setattr(app_module, "fetch_choices", lambda d: [{"name": "CAT-1", "score": 0.9}])
+    posts = []
+
+    def fake_extract(filename):
+        posts.append(filename)
+        return [{"description": "Hex Bolt M8 (Qty: 10)"}]
+
+    monkeypatch.setattr(app_module, "extract_items", fake_extract)
+    pdf = b"%PDF-1.4 purchase order\n%EOF"
+    for name in ("po-monday.pdf", "po-tuesday.pdf"):
+        resp = client.post("/upload", data={"file": (io.BytesIO(pdf), name)})
+        assert resp.status_code == 302
+
+    assert posts == ["po-monday.pdf"]
+    conn = app_module.db_conn()
+    hashes = {r[0] for r in conn.execute("SELECT content_hash FROM documents")}
+    assert hashes == {hashlib.sha256(pdf).hexdigest()}
+    assert conn.execute("SELECT COUNT(*) FROM line_items").fetchone()[0] == 2
+    assert (tmp_path / "po-tuesday.pdf").read_bytes() == pdf
+
+
+def test_batch_upload_expands_zip_and_reports_progress(client, monkeypatch, tmp_path):
+    import io
+    import zipfile
+
+    monkeypatch.setattr(app_module, "UPLOAD_FOLDER", str(tmp_path))
+    monkeypatch.setattr(app_module, "SYNC_PARSE", True)
+    monkeypatch.setattr(app_module, "fetch_choices", lambda d: [{"name": "CAT-1", "score": 0.9}])
+
+    def fake_extract(filename):
+        if filename.endswith("broken.pdf"):
+            raise RuntimeError("unreadable PDF")
+        return [{"description": f"Item from {filename}"}]
+
+    monkeypatch.setattr(app_module, "extract_items", fake_extract)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("inbox/po-1.pdf", b"%PDF one")
+        zf.writestr("inbox/po-2.pdf", b"%PDF two")
+        zf.writestr("inbox/notes.txt", b"ignored")
+    archive.seek(0)
+
+    resp = client.post(
+        "/api/batches",
+        data={"files": [(archive, "mail.zip"), (io.BytesIO(b"%PDF bad"), "broken.pdf")]},
+    )
+    assert resp.status_code == 202
+    batch = client.get(f"/api/batches/{resp.get_json()['batch_id']}").get_json()
+    assert batch["total"] == 3
+    assert batch["counts"]["done"] == 2 and batch["counts"]["failed"] == 1
+    assert batch["finished"]
+
+    # Same basename in different folders, and an earlier single upload of it
+    client.post("/upload", data={"file": (io.BytesIO(b"%PDF single"), "po-1.pdf")})
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("acme/po-1.pdf", b"%PDF acme")
+        zf.writestr("globex/po-1.pdf", b"%PDF globex")
+    archive.seek(0)
+    resp = client.post("/api/batches", data={"files": [(archive, "suppliers.zip")]})
+    batch_id = resp.get_json()["batch_id"]
+    assert client.get(f"/api/batches/{batch_id}").get_json()["total"] == 2
+    names = [r[0] for r in app_module.db_conn().execute(
+        "SELECT name FROM documents WHERE name LIKE '%po-1.pdf' ORDER BY id"
+    )]
+    assert names[-2:] == [f"batch-{batch_id}/0001-po-1.pdf", f"batch-{batch_id}/0002-po-1.pdf"]
+    assert (tmp_path / "po-1.pdf").read_bytes() == b"%PDF single"
+    assert [(tmp_path / name).read_bytes() for name in names[-2:]] == [b"%PDF acme", b"%PDF globex"]
+    assert client.post("/api/batches", data={}).status_code == 400
+    assert client.get("/api/batches/999").status_code == 404
+
+    # A non-positive cap would never let a job of the batch be leased
+    resp = client.post("/api/batches", data={"files": [(io.BytesIO(b"%PDF neg"), "neg.pdf")],
+                                             "concurrency": "-2"})
+    batch = client.get(f"/api/batches/{resp.get_json()['batch_id']}").get_json()
+    assert batch["max_concurrency"] == 1 and batch["finished"]
+
+
+def test_job_queue_caps_batches_at_lease(client):
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO batches(max_concurrency) VALUES(2)")
+    conn.commit()
+    jobs = app_module.JOBS
+    for i in range(3):
+        jobs.enqueue(conn, "match", {"doc_id": i}, batch_id=1)
+    jobs.enqueue(conn, "match", {"doc_id": 9})  # not in a batch
+
+    leased = [jobs.lease(conn, "w1") for _ in range(4)]
+    # Single uploads go ahead of batch work
+    assert [json.loads(j["payload"])["doc_id"] for j in leased if j] == [9, 0, 1]
+    assert leased[-1] is None
+
+    jobs.complete(conn, leased[1], "w1")
+    assert json.loads(jobs.lease(conn, "w2")["payload"])["doc_id"] == 2
+    assert jobs.counts(conn) == {"queued": 0, "leased": 3, "dead": 0}
+
+
+def test_failed_jobs_retry_then_dead_letter(client, monkeypatch):
+    monkeypatch.setattr(app_module.JOBS, "backoff", 0)
+    monkeypatch.setattr(app_module.JOBS, "max_attempts", 2)
+    calls = []
+
+    def flaky_match(doc_id):
+        calls.append(doc_id)
+        raise RuntimeError("match API down")
+
+    monkeypatch.setattr(app_module, "match_stage", flaky_match)
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.commit()
+    app_module.JOBS.enqueue(conn, "match", {"doc_id": 1}, document_id=1)
+
+    worker = app_module.JobWorker(threads=0)
+    assert worker.run_once() and worker.run_once() and not worker.run_once()
+    assert calls == [1, 1]
+    status = client.get("/api/documents/1/status").get_json()
+    assert status["status"] == "failed" and "match API down" in status["error"]
+    overview = client.get("/api/jobs").get_json()
+    assert overview["counts"]["dead"] == 1
+    job_id = overview["dead"][0]["id"]
+
+    # Requeued by hand; a worker that dies mid-job loses its lease
+    assert client.post(f"/api/jobs/{job_id}/retry").status_code == 200
+    assert client.post(f"/api/jobs/{job_id}/retry").status_code == 404
+    assert app_module.JOBS.lease(conn, "crashed")["attempts"] == 1
+    conn.execute("UPDATE jobs SET lease_expires = 0")
+    conn.commit()
+    assert app_module.JOBS.lease(conn, "w2")["attempts"] == 2
+
+
+def test_job_lease_fails_expired_documents_in_one_transaction(client):
+    queue = app_module.JobQueue(max_attempts=1)
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.commit()
+    queue.enqueue(conn, "match", {"doc_id": 1}, document_id=1)
+    assert queue.lease(conn, "crashed") is not None
+    conn.execute("UPDATE jobs SET lease_expires = 0")
+    conn.commit()
+
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        assert queue.lease(conn, "w2") is None
+    finally:
+        conn.set_trace_callback(None)
+    assert [s for s in statements if s.startswith(("BEGIN", "COMMIT"))] == ["BEGIN ", "COMMIT"]
+    assert conn.execute("SELECT status FROM documents").fetchone()[0] == "failed"
+
+
+def test_job_worker_threads_close_their_connections(monkeypatch):
+    closed = []
+    monkeypatch.setattr(app_module, "close_thread_connections",
+                        lambda: closed.append(app_module.threading.current_thread().name))
+    monkeypatch.setattr(app_module.JOBS, "lease_seconds", 0.03)
+    worker = app_module.JobWorker(threads=1, poll_seconds=0.01).start()
+    time.sleep(0.05)
+    worker.stop()
+    worker.join()
+    assert sorted(closed) == ["job-worker-0", "job-worker-1"]
+
+
+def test_heartbeat_renews_only_running_handlers(client):
+    queue = app_module.JobQueue(lease_seconds=60)
+    conn = app_module.db_conn()
+    for doc_id in (1, 2):
+        queue.enqueue(conn, "match", {"doc_id": doc_id})
+    owners = [app_module._lease_owner() for _ in range(2)]
+    jobs = [queue.lease(conn, owner) for owner in owners]
+    assert owners[0] != owners[1]  # threads of one process hold distinct leases
+    conn.execute("UPDATE jobs SET lease_expires = 0")
+    conn.commit()
+
+    worker = app_module.JobWorker(threads=0, max_runtime=5)
+    worker._running = {owners[0]: time.monotonic(), owners[1]: time.monotonic() - 10}
+    assert worker.live_leases() == [owners[0]]  # the hung handler is let go
+    assert queue.heartbeat(conn, worker.live_leases()) == 1
+    expires = dict(conn.execute("SELECT id, lease_expires FROM jobs").fetchall())
+    assert expires[jobs[0]["id"]] > time.time() and expires[jobs[1]["id"]] == 0
+
+    # Once retried elsewhere, the hung handler can no longer fail (or finish) it
+    assert queue.lease(conn, "w2")["id"] == jobs[1]["id"]
+    assert queue.fail(conn, jobs[1], owners[1], "late") == "lost"
+
+
+def test_async_upload_is_processed_by_job_worker(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, "UPLOAD_FOLDER", str(tmp_path))
+    monkeypatch.setattr(app_module, "SYNC_PARSE", False)
+    monkeypatch.setattr(app_module, "extract_items", lambda f: [{"description": "Hex Nut M8"}])
+    monkeypatch.setattr(app_module, "fetch_choices", lambda d: [{"name": "CAT Nut", "score": 0.9}])
+    resp = client.post(
+        "/upload", data={"file": (io.BytesIO(b"%PDF-1.4 job"), "job.pdf")},
+        content_type="multipart/form-data",
+    )
+    doc_id = int(resp.headers["Location"].rsplit("/", 1)[1])
+    assert client.get(f"/api/documents/{doc_id}/status").get_json()["status"] == "queued"
+
+    worker = app_module.JobWorker(threads=0)
+    while worker.run_once():
+        pass
+    status = client.get(f"/api/documents/{doc_id}/status").get_json()
+    assert status["status"] == "done" and status["matched"] == 1
+
+
+def test_streaming_upload_extracts_while_receiving(client, monkeypatch, tmp_path):
+    import requests
+    from werkzeug.wrappers import Request
+
+    monkeypatch.setattr(app_module, "UPLOAD_FOLDER", str(tmp_path))
+    monkeypatch.setattr(app_module, "SYNC_PARSE", False)
+    monkeypatch.setattr(app_module, "STREAM_EXTRACT", True)
+    monkeypatch.setattr(app_module, "UPLOAD_CHUNK_SIZE", 1024)
+    monkeypatch.setattr(app_module, "fetch_choices", lambda d: [{"name": "CAT Nut", "score": 0.9}])
+    received = []
+
+    class StreamingSession:
+        def request(self, method, url, data=None, headers=None, **kwargs):
+            body = b"".join(data)  # consumes the generator chunk by chunk
+            form = Request.from_values(
+                input_stream=io.BytesIO(body), content_length=len(body),
+                content_type=headers["Content-Type"], method="POST",
+            )
+            received.append(form.files["file"].read())
+            resp = requests.Response()
+            resp.status_code = 200
+            resp._content = b'[{"Request Item": "Hex Nut M8", "Amount": 4}]'
+            return resp
+
+    monkeypatch.setattr(app_module.extract_api, "session", StreamingSession())
+    pdf = b"%PDF-1.4 " + os.urandom(10_000)
+    resp = client.post(
+        "/upload", data={"file": (io.BytesIO(pdf), "stream.pdf")},
+        content_type="multipart/form-data",
+    )
+    doc_id = int(resp.headers["Location"].rsplit("/", 1)[1])
+    assert (tmp_path / "stream.pdf").read_bytes() == pdf
+
+    # The streamed result wakes the (otherwise delayed) extract job
+    conn = app_module.db_conn()
+    deadline = time.monotonic() + 5
+    while conn.execute("SELECT run_at FROM jobs").fetchone()[0] > time.time():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    worker = app_module.JobWorker(threads=0)
+    while worker.run_once():
+        pass
+    assert received == [pdf]  # sent once, intact, and reused by the job
+    rows = client.get(f"/api/documents/{doc_id}/rows").get_json()["rows"]
+    assert [r["description"] for r in rows] == ["Hex Nut M8 (Qty: 4)"]
+    # A name that sanitizes to nothing is rejected, not written to uploads/.part
+    resp = client.post("/upload", data={"file": (io.BytesIO(pdf), "../")},
+                       content_type="multipart/form-data")
+    assert resp.status_code == 400
+    assert list(tmp_path.glob("*.part")) == []
+
+
+def test_concurrent_uploads_of_one_name_do_not_share_a_temp_file(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, "UPLOAD_FOLDER", str(tmp_path))
+    path = str(tmp_path / "po.pdf")
+
+    class Interleaved(io.BytesIO):
+        """Lets a second upload of the same name run while this one is open."""
+        def read(self, size=-1):
+            if self.tell() == 0:
+                app_module.save_upload(io.BytesIO(b"%PDF second"), path)
+            return super().read(size)
+
+    app_module.save_upload(Interleaved(b"%PDF first"), path)
+    assert (tmp_path / "po.pdf").read_bytes() == b"%PDF first"
+    assert list(tmp_path.glob("*.part")) == []
+    resp = client.post("/upload", data={"file": (io.BytesIO(b"%PDF"), "")},
+                       content_type="multipart/form-data")
+    assert resp.status_code == 400
+
+
+def test_abandoned_stream_does_not_count_against_extract_api(monkeypatch):
+    import socket
+    import threading
+
+    import requests
+
+    server = socket.create_server(("127.0.0.1", 0))
+    accepted = []
+
+    def accept():
+        while True:
+            try:
+                accepted.append(server.accept()[0])
+            except OSError:
+                return
+
+    threading.Thread(target=accept, daemon=True).start()
+    client = app_module.ApiClient(
+        "extract", "POST", "http://127.0.0.1:%d/extract" % server.getsockname()[1],
+        1.0, 0, app_module.RequestScheduler("extract", 0, 1, 1), requests.Session(),
+    )
+    client.breaker.failure_threshold = 2
+    monkeypatch.setattr(app_module, "extract_api", client)
+    try:
+        for _ in range(3):
+            pipe = app_module.ChunkPipe()
+            pipe.put(b"%PDF-1.4")
+            pipe.abandon()  # e.g. the uploading client disconnected
+            with pytest.raises(app_module.UploadAbandonedError):
+                app_module.stream_extraction("po.pdf", pipe)
+        assert client.breaker.snapshot()["state"] == "closed"
+        assert client.breaker.failures == 0
+
+        # An aborted half-open probe frees the probe slot for the next call
+        client.breaker.state = "half_open"
+        pipe = app_module.ChunkPipe()
+        pipe.abandon()
+        with pytest.raises(app_module.UploadAbandonedError):
+            client.call(retry=False, data=iter(pipe))
+        assert client.breaker.allow()
+    finally:
+        server.close()
+        for conn in accepted:
+            conn.close()
+
+
+def test_db_conn_is_pooled_and_tuned():
+    import threading
+
+    conn = app_module.db_conn()
+    assert conn is app_module.db_conn()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == app_module.SQLITE_BUSY_TIMEOUT_MS
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(app_module.db_conn()))
+    t.start()
+    t.join()
+    assert other[0] is not conn
+
+    with app.app_context():
+        request_conn = app_module.db_conn()
+        assert request_conn is not conn and request_conn is app_module.db_conn()
+    # Closed at app context teardown
+    with pytest.raises(Exception):
+        request_conn.execute("SELECT 1")
+
+
+def test_rows_api_keyset_pagination(client):
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name, status) VALUES('po.pdf', 'done')")
+    conn.executemany(
+        "INSERT INTO line_items(document_id, description, raw_index) VALUES(1,?,?)",
+        [(f"item {i}", i) for i in range(7)],
+    )
+    app_module.store_matches(conn, [(i, [{"name": "CAT", "score": 0.5}]) for i in range(1, 8)])
+
+    seen, after = [], -1
+    while after is not None:
+        page = client.get(f"/api/documents/1/rows?after={after}&limit=3").get_json()
+        assert len(page["rows"]) <= 3
+        seen += [r["description"] for r in page["rows"]]
+        after = page["next_after"]
+    assert seen == [f"item {i}" for i in range(7)]
+
+    html = client.get("/review/1").data.decode()
+    assert "7 items extracted" in html
+    assert 'id="review-rows-sentinel"' not in html
+
+
+def test_export_streams_filtered_csv_with_gzip(client):
+    import csv
+    import gzip
+    import io
+
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name, uploaded_at) VALUES('old.pdf', '2024-01-05 10:00:00')")
+    conn.execute("INSERT INTO documents(name, uploaded_at) VALUES('new.pdf', '2024-03-01 09:00:00')")
+    conn.executemany(
+        "INSERT INTO line_items(document_id, description, raw_index) VALUES(?,?,?)",
+        [(1, 'Bolt 1/2"', 0), (2, "Nut M8", 0), (2, "Washer", 1)],
+    )
+    app_module.store_matches(
+        conn,
+        [
+            (1, [{"name": 'CAT Bolt 1/2"', "score": 1}]),
+            (2, [{"name": "A", "score": 1}, {"name": "CAT Nut M8", "score": 0.9}]),
+            (3, [{"name": "CAT Washer", "score": 1}]),
+        ],
+    )
+    conn.executemany("UPDATE matches SET confirmed_id=? WHERE id=?", [(0, 1), (1, 2)])
+    conn.commit()
+
+    resp = client.get("/export", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    rows = list(csv.reader(io.StringIO(gzip.decompress(resp.data).decode())))
+    assert rows == [
+        ["document", "description", "confirmed_choice"],
+        ["old.pdf", 'Bolt 1/2"', 'CAT Bolt 1/2"'],
+        ["new.pdf", "Nut M8", "CAT Nut M8"],
+        ["new.pdf", "Washer", ""],
+    ]
+
+    resp = client.get("/export?since=2024-02-01&until=2024-03-01")
+    assert "Content-Encoding" not in resp.headers
+    assert [r[1] for r in csv.reader(io.StringIO(resp.data.decode()))][1:] == ["Nut M8", "Washer"]
+    assert len(client.get("/export?doc_id=1").data.decode().splitlines()) == 2
+    assert client.get("/export?since=yesterday").status_code == 400
+
+    # Rows are streamed in index order: no sort over line items
+    plan = " ".join(r[-1] for r in conn.execute(
+        "EXPLAIN QUERY PLAN " + app_module._DOCUMENT_ROWS_SQL, (1,)
+    ))
+    assert "idx_line_unique" in plan and "TEMP B-TREE" not in plan
+    plan = " ".join(r[-1] for r in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM documents d WHERE d.uploaded_at >= ?", ("2024-02-01",)
+    ))
+    assert "idx_documents_uploaded" in plan
+
+
+def test_init_db_migrates_choice_blobs(tmp_path, monkeypatch):
+    import sqlite3
+
+    legacy = tmp_path / "legacy.db"
+    conn = sqlite3.connect(legacy)
+    conn.executescript(
+        """
+        CREATE TABLE documents (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE,
+                                uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE line_items (id INTEGER PRIMARY KEY AUTOINCREMENT, document_id INTEGER,
+                                 description TEXT, raw_index INTEGER);
+        CREATE TABLE matches (id INTEGER PRIMARY KEY AUTOINCREMENT, line_item_id INTEGER,
+                              choice_json TEXT, confirmed_id INTEGER);
+        INSERT INTO documents(name) VALUES ('po.pdf');
+        INSERT INTO line_items(document_id, description, raw_index) VALUES (1, 'Nut', 0), (1, 'Bolt', 1);
+        INSERT INTO matches(line_item_id, choice_json, confirmed_id) VALUES
+            (1, '[{"name": "CAT Nut", "score": 0.9}, {"name": "CAT Nut 2", "score": 0.8}]', 1),
+            (2, '[{"name": "CAT Bolt", "score": 0.7}]', NULL),
+            (1, '[{"name": "CAT Nut", "score": 0.9}]', NULL);  -- stored twice
+        """
+    )
+    conn.commit()
+    conn.close()
+    monkeypatch.setenv("DB_PATH", str(legacy))
+    init_db()
+    init_db()  # idempotent
+
+    conn = app_module.db_conn()
+    assert conn.execute("SELECT COUNT(*) FROM match_choices").fetchone()[0] == 3
+    assert conn.execute("SELECT status FROM documents").fetchone()[0] == "done"
+    page = app_module.fetch_review_rows(conn, 1)
+    assert [c["name"] for c in page["rows"][0]["choices"]] == ["CAT Nut", "CAT Nut 2"]
+    stats = conn.execute("SELECT * FROM confirmation_stats").fetchone()
+    assert tuple(stats) == (1, 2, 1, 0)
+    assert app_module.lookup_aliases(conn, ["NUT"]) == {"NUT": [{"name": "CAT Nut 2", "score": 1.0}]}
+
+
+def test_dashboard_aggregates_follow_confirmations(client):
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.executemany(
+        "INSERT INTO line_items(document_id, description, raw_index) VALUES(1,?,?)",
+        [("Nut", 0), ("Bolt", 1), ("Washer", 2)],
+    )
+    conn.commit()
+    choices = [{"name": "CAT Nut", "score": 0.9}, {"name": "CAT Bolt", "score": 0.8}]
+    app_module.store_matches(conn, [(1, choices), (2, choices), (3, choices)])
+
+    client.post("/confirm/1", data={"1": "0", "2": "1", "3": "1"})
+    client.post("/confirm/1", data={"3": "0"})  # change of mind
+    stats = client.get("/api/dashboard").get_json()
+    assert stats["matches_total"] == 3 and stats["confirmed_total"] == 3
+    assert stats["top_choice_confirmed"] == 2
+    assert stats["top_skus"] == [
+        {"name": "CAT Nut", "confirmations": 2},
+        {"name": "CAT Bolt", "confirmations": 1},
+    ]
+
+    conn.execute("DELETE FROM matches WHERE id = 1")
+    conn.commit()
+    stats = client.get("/api/dashboard").get_json()
+    assert stats["matches_total"] == 2 and stats["top_choice_confirmed"] == 1
+    assert {s["name"]: s["confirmations"] for s in stats["top_skus"]} == {
+        "CAT Nut": 1,
+        "CAT Bolt": 1,
+    }
+
+
+def test_confirm_defaults_rows_the_browser_never_loaded(client):
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.executemany(
+        "INSERT INTO line_items(document_id, description, raw_index) VALUES(1,?,?)",
+        [(f"Item {i}", i) for i in range(4)],
+    )
+    conn.commit()
+    choices = [{"name": "CAT Nut", "score": 0.9}, {"name": "CAT Bolt", "score": 0.8}]
+    app_module.store_matches(conn, [(1, choices), (2, choices), (3, choices), (4, [])])
+
+    # Only the first page was loaded: row 2 picked, row 1 explicitly unmatched
+    resp = client.post("/confirm/1", data={"1": "", "2": "1"})
+    assert resp.get_data(as_text=True).splitlines()[1:] == [
+        '"Item 0",""', '"Item 1","CAT Bolt"', '"Item 2","CAT Nut"', '"Item 3",""',
+    ]
+    # Unsubmitted rows are not learned as reviewed aliases
+    assert conn.execute("SELECT COUNT(*) FROM match_aliases").fetchone()[0] == 1
+    # nor counted as confirmations: only row 2 was reviewed and matched
+    dashboard = client.get("/api/dashboard").get_json()
+    assert dashboard["confirmed_total"] == 1 and dashboard["top_choice_confirmed"] == 0
+    assert dashboard["top_skus"] == [{"name": "CAT Bolt", "confirmations": 1}]
+
+    # Confirming a defaulted row later makes it count
+    client.post("/confirm/1", data={"3": "0"})
+    dashboard = client.get("/api/dashboard").get_json()
+    assert dashboard["confirmed_total"] == 2 and dashboard["top_choice_confirmed"] == 1
+
+
+def test_catalog_hot_reload_swaps_version(client, monkeypatch, tmp_path):
+    import os
+
+    path = tmp_path / "catalog.csv"
+    path.write_text("Type,Material,Size\nBolt,Steel,1in\nNut,Brass,M8\n")
+    monkeypatch.setattr(app_module, "CATALOG_PATH", str(path))
+    original = app_module.current_catalog()
+    try:
+        assert app_module.reload_catalog()
+        state = app_module.current_catalog()
+        assert list(state.catalog.names) == ["Bolt Steel 1in", "Nut Brass M8"]
+        assert state.catalog.row(1) == {"Type": "Nut", "Material": "Brass", "Size": "M8"}
+        assert app_module.custom_match("brass nut m8", use_custom=True)[0]["name"] == "Nut Brass M8"
+
+        # Unchanged content: no rebuild, even if mtime moves
+        os.utime(path, (1, 1))
+        assert not app_module.reload_catalog()
+
+        path.write_text("Name,Type\nHex Cap Screw M8x30,Screw\n")
+        assert client.post("/api/catalog/reload").get_json()["reloaded"]
+        info = client.get("/api/catalog").get_json()
+        assert info["rows"] == 1 and info["columns"] == ["Name", "Type"]
+        assert info["version"] != state.version
+        assert list(app_module.current_catalog().catalog.names) == ["Hex Cap Screw M8x30"]
+
+        conn = app_module.db_conn()
+        conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+        conn.execute("INSERT INTO line_items(document_id, description, raw_index) VALUES(1,'x',0)")
+        app_module.store_matches(conn, [(1, [{"name": "Hex Cap Screw M8x30", "score": 1.0}])])
+        assert app_module.fetch_review_rows(conn, 1)["rows"][0]["catalog_version"] == info["version"]
+    finally:
+        app_module._catalog_state = original
+
+
+def test_catalog_search_prefix_and_typo_tolerant(client, monkeypatch, tmp_path):
+    path = tmp_path / "catalog.csv"
+    path.write_text(
+        "Name,Type\n"
+        "Hex Cap Screw M8x30,Screw\n"
+        "Hex Nut M8,Nut\n"
+        "Flat Washer M8,Washer\n"
+        "Carriage Bolt 1/2in,Bolt\n"
+    )
+    monkeypatch.setattr(app_module, "CATALOG_PATH", str(path))
+    original = app_module.current_catalog()
+    try:
+        app_module.reload_catalog()
+        body = client.get("/api/catalog/search?q=hex m8").get_json()
+        names = [r["name"] for r in body["results"]]
+        assert set(names[:2]) == {"Hex Cap Screw M8x30", "Hex Nut M8"}
+        assert body["results"][0]["source"] == "prefix"
+
+        # Prefix of a partially typed word
+        assert client.get("/api/catalog/search?q=carr").get_json()["results"][0]["name"] == (
+            "Carriage Bolt 1/2in"
+        )
+        # Typo: no FTS hit, fuzzy fallback still finds it
+        result = client.get("/api/catalog/search?q=wahser").get_json()["results"][0]
+        assert result == {
+            "name": "Flat Washer M8",
+            "attributes": {"Name": "Flat Washer M8", "Type": "Washer"},
+            "source": "fuzzy",
+        }
+        assert client.get("/api/catalog/search?q=").get_json()["results"] == []
+    finally:
+        app_module._catalog_state = original
+
+
+def test_review_rows_list_choices_in_rank_order(client):
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.execute("INSERT INTO line_items(document_id, description, raw_index) VALUES(1,'x',0)")
+    conn.execute("INSERT INTO matches(line_item_id) VALUES(1)")
+    conn.executemany(
+        "INSERT INTO match_choices(match_id, rank, name, score) VALUES(1,?,?,?)",
+        [(2, "C", 0.5), (0, "A", 0.9), (1, "B", 0.7)],
+    )
+    conn.commit()
+    rows = app_module.fetch_review_rows(conn, 1)["rows"]
+    assert [c["name"] for c in rows[0]["choices"]] == ["A", "B", "C"]
+
+
+def test_add_choice_from_search(client):
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.execute("INSERT INTO line_items(document_id, description, raw_index) VALUES(1,'x',0)")
+    conn.commit()
+    app_module.store_matches(conn, [(1, [{"name": "A", "score": 0.5}])])
+
+    resp = client.post("/api/matches/1/choices", json={"name": "Hex Nut M8"})
+    assert resp.get_json()["rank"] == 1
+    assert client.post("/api/matches/1/choices", json={"name": "A"}).get_json()["rank"] == 0
+    assert client.post("/api/matches/9/choices", json={"name": "A"}).status_code == 404
+
+    html = client.get("/review/1").data.decode()
+    assert "Hex Nut M8 (catalog search)" in html
+
+
+class _FakeSession:
+    """Stands in for requests.Session, replaying scripted outcomes."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        import requests
+
+        self.calls.append(kwargs)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        resp = requests.Response()
+        resp.status_code = outcome
+        resp._content = b"[]"
+        return resp
+
+
+def test_api_client_retries_then_opens_circuit(monkeypatch):
+    import requests
+
+    monkeypatch.setattr(app_module.time, "sleep", lambda s: None)
+    session = _FakeSession([503, 200])
+    scheduler = app_module.RequestScheduler("match", 0, 1, 4)
+    client = app_module.ApiClient(
+        "match", "GET", "http://upstream/match", 1.0, 1, scheduler, session
+    )
+    assert client.call(params={"query": "x"}).status_code == 200
+    assert session.calls[0]["timeout"] == (app_module.API_CONNECT_TIMEOUT, 1.0)
+
+    session.outcomes = [requests.ConnectTimeout("slow")] * 4
+    client.breaker.failure_threshold = 2
+    for _ in range(2):
+        with pytest.raises(requests.ConnectTimeout):
+            client.call()
+    assert client.breaker.snapshot()["state"] == "open"
+    calls = len(session.calls)
+    with pytest.raises(app_module.CircuitOpenError):
+        client.call()
+    assert len(session.calls) == calls  # failed fast, no network
+
+    # After the reset window a single probe closes the circuit again
+    client.breaker.opened_at -= client.breaker.reset_seconds
+    session.outcomes = [200]
+    client.call()
+    assert client.breaker.snapshot()["state"] == "closed"
+
+    # Client errors are not retried and do not count against the upstream
+    session.outcomes = [404]
+    with pytest.raises(requests.HTTPError):
+        client.call()
+    assert client.breaker.failures == 0
+
+
+def test_scheduler_admits_interactive_calls_first_and_rate_limits():
+    import threading
+
+    scheduler = app_module.RequestScheduler("match", rate=50, burst=1, concurrency=1, max_wait=5)
+    order = []
+
+    def call(priority):
+        with scheduler.slot(priority):
+            order.append(priority)
+
+    with scheduler.slot("batch"):  # occupy the only slot while others queue
+        threads = [threading.Thread(target=call, args=(p,))
+                   for p in ("batch", "batch", "interactive")]
+        for t in threads:
+            t.start()
+            time.sleep(0.05)
+        assert scheduler.snapshot()["waiting"] == {"interactive": 1, "batch": 2}
+    started = time.monotonic()
+    for t in threads:
+        t.join()
+    assert order == ["interactive", "batch", "batch"]
+    assert time.monotonic() - started >= 2 / 50  # one token per 20 ms
+
+    # An upstream 429 holds everyone back; nobody waits past max_wait
+    scheduler.max_wait = 0.05
+    scheduler.pause(1)
+    with pytest.raises(app_module.AdmissionTimeoutError):
+        call("interactive")
+    body = app_module.METRICS.render()
+    assert 'api_queue_wait_seconds_count{api="match",priority="batch"}' in body
+
+
+def test_shared_scheduler_rate_limits_across_processes():
+    # Two schedulers stand in for two worker processes on one database
+    schedulers = [app_module.RequestScheduler("match", rate=20, burst=1, concurrency=4,
+                                              max_wait=5, shared=True) for _ in range(2)]
+    started = time.monotonic()
+    for _ in range(3):
+        for scheduler in schedulers:
+            with scheduler.slot():
+                pass
+    assert time.monotonic() - started >= 5 / 20  # one token per 50 ms, not two
+
+    # A 429 seen by one process pauses the other
+    schedulers[0].pause(1)
+    schedulers[1].max_wait = 0.05
+    with pytest.raises(app_module.AdmissionTimeoutError):
+        with schedulers[1].slot():
+            pass
+    assert schedulers[1].snapshot()["paused_for_seconds"] > 0
+
+
+def test_admission_timeout_is_not_an_upstream_failure():
+    scheduler = app_module.RequestScheduler("match", 0, 1, 1, max_wait=0.05)
+    session = _FakeSession([200])
+    client = app_module.ApiClient(
+        "match", "GET", "http://upstream/match", 1.0, 2, scheduler, session
+    )
+    client.breaker.failure_threshold = 1
+    with scheduler.slot("batch"):  # our own backlog holds the only slot
+        with pytest.raises(app_module.AdmissionTimeoutError):
+            client.call()
+    assert session.calls == []  # not retried
+    assert client.breaker.state == "closed" and client.breaker.failures == 0
+    assert client.call().status_code == 200
+
+
+def test_shared_scheduler_keeps_database_out_of_the_lock(monkeypatch, tmp_path):
+    import sqlite3
+    import threading
+
+    # Without a rate there is nothing to share and no database access
+    assert not app_module.RequestScheduler("match", 0, 1, 1, shared=True).shared
+
+    monkeypatch.setattr(app_module, "SQLITE_BUSY_TIMEOUT_MS", 300)
+    scheduler = app_module.RequestScheduler("match", rate=20, burst=1, concurrency=2,
+                                            max_wait=5, shared=True)
+    with scheduler.slot():  # connects and creates the bucket row
+        pass
+    writer = sqlite3.connect(app_module._current_db_path(), isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")  # a long write, e.g. an FTS rebuild
+    admitted = threading.Event()
+
+    def call():
+        with scheduler.slot():
+            admitted.set()
+
+    try:
+        thread = threading.Thread(target=call)
+        thread.start()
+        time.sleep(0.1)
+        started = time.monotonic()
+        scheduler.snapshot()  # not stuck behind the database
+        assert time.monotonic() - started < 0.05
+        # The locked database falls back to the local bucket
+        assert admitted.wait(2)
+        thread.join()
+    finally:
+        writer.execute("ROLLBACK")
+        writer.close()
+
+
+def test_open_match_circuit_falls_back_to_local_matcher(client, monkeypatch):
+    breaker = app_module.match_api.breaker
+    monkeypatch.setattr(breaker, "state", "open")
+    monkeypatch.setattr(breaker, "opened_at", app_module.time.monotonic())
+    monkeypatch.setattr(
+        app_module, "custom_match", lambda d, use_custom=False: [{"name": "LOCAL", "score": 0.5}]
+    )
+    assert app_module.fetch_choices("Hex Bolt") == [{"name": "LOCAL", "score": 0.5}]
+    health = client.get("/api/health").get_json()
+    assert health["status"] == "degraded"
+    assert health["upstreams"]["match"]["state"] == "open"
+
+
+def test_hedged_matching_uses_local_result_past_deadline(client, monkeypatch):
+    monkeypatch.setattr(app_module, "HEDGE_DEADLINE_MS", 50)
+    monkeypatch.setattr(
+        app_module, "custom_match", lambda d, use_custom=False: [{"name": "LOCAL", "score": 0.5}]
+    )
+    remote = [{"name": "REMOTE", "score": 0.9}]
+    monkeypatch.setattr(app_module, "remote_choices", lambda d: remote)
+    choices = app_module.fetch_choices("Hex Bolt")
+    assert (choices, choices.source) == (remote, "remote")
+
+    def slow_remote(d):
+        time.sleep(0.3)
+        return remote
+
+    monkeypatch.setattr(app_module, "remote_choices", slow_remote)
+    started = time.monotonic()
+    choices = app_module.fetch_choices("Hex Bolt")
+    assert time.monotonic() - started < 0.25
+    assert (choices, choices.source) == ([{"name": "LOCAL", "score": 0.5}], "local")
+
+    # The winning source is stored with the match
+    with app.app_context():
+        conn = app_module.db_conn()
+        with conn:
+            doc_id = conn.execute("INSERT INTO documents(name) VALUES('h.pdf')").lastrowid
+            app_module.store_line_items(conn, doc_id, ["Hex Bolt"])
+        app_module.fill_missing_matches(conn, doc_id)
+        assert conn.execute("SELECT match_source FROM matches").fetchone()[0] == "local"
+    assert 'match_hedge_total{winner="local"}' in client.get("/metrics").get_data(as_text=True)
+
+
+def test_metrics_endpoint_exposes_latencies(client):
+    client.get("/api/dashboard")
+    with app.app_context():
+        app_module.db_conn().execute("SELECT 1").fetchone()
+    app_module.custom_match("Hex Bolt")
+
+    body = client.get("/metrics").get_data(as_text=True)
+    assert "# TYPE http_request_duration_seconds histogram" in body
+    assert 'http_request_duration_seconds_count{endpoint="dashboard"}' in body
+    assert 'sqlite_query_duration_seconds_count{op="SELECT"}' in body
+    assert "custom_match_duration_seconds_count" in body
+    assert 'circuit_breaker_state{api="match"} 0' in body
+
+
+def test_slow_requests_are_profiled(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, "PROFILE_SLOW_MS", 0.001)
+    monkeypatch.setattr(app_module, "PROFILE_DIR", str(tmp_path / "prof"))
+    client.get("/api/health")
+    assert [p.suffix for p in (tmp_path / "prof").iterdir()] == [".prof"]
+
+
+def test_migrations_are_tracked_and_lazy(tmp_path, monkeypatch):
+    db = str(tmp_path / "fresh.db")
+    assert app_module.pending_migrations(db) == [v for v, _, _ in app_module.MIGRATIONS]
+
+    monkeypatch.setattr(app_module, "AUTO_MIGRATE", False)
+    with pytest.raises(RuntimeError, match="flask --app app.py migrate"):
+        app_module.ensure_db(db)
+
+    assert app_module.migrate(db) == [v for v, _, _ in app_module.MIGRATIONS]
+    assert app_module.migrate(db) == []
+    app_module.ensure_db(db)  # up to date: no error even without AUTO_MIGRATE
+
+
+def test_catalog_snapshot_matches_in_memory_index(tmp_path, monkeypatch):
+    path = tmp_path / "catalog.csv"
+    path.write_text(
+        "Name,Type\n"
+        "Hex Cap Screw M8x30,Screw\n"
+        "Hex Nut M8,Nut\n"
+        "Flat Washer M8 Zinc,Washer\n"
+        "Carriage Bolt 1/2in,Bolt\n"
+    )
+    in_memory = app_module.CatalogState(app_module.load_catalog(str(path)))
+    state = app_module._load_catalog_state(str(path))
+    assert isinstance(state.index._postings, app_module._PostingTable)
+    assert list(state.catalog.names) == in_memory.catalog.names
+    assert state.catalog.row(2) == {"Name": "Flat Washer M8 Zinc", "Type": "Washer"}
+    assert state.version == in_memory.version
+    for query in ("hex m8", "washer zinc", "carriag bolt"):
+        assert state.index.search(query) == in_memory.index.search(query)
+
+    # Later workers map the existing snapshot instead of parsing the CSV
+    monkeypatch.setattr(app_module, "load_catalog", lambda p=None: 1 / 0)
+    assert app_module._load_catalog_state(str(path)).version == state.version
+
+
+def test_confirmed_matches_short_circuit_matching(client, monkeypatch):
+    calls = []
+
+    def fetch(description):
+        calls.append(description)
+        return [{"name": "CAT Guess", "score": 0.6}, {"name": "CAT Hex Nut M8", "score": 0.5}]
+
+    monkeypatch.setattr(app_module, "fetch_choices", fetch)
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po1.pdf')")
+    conn.execute("INSERT INTO documents(name) VALUES('po2.pdf')")
+    conn.execute(
+        "INSERT INTO line_items(document_id, description, raw_index) "
+        "VALUES(1, 'Hex Nut M8 (Qty: 10)', 0)"
+    )
+    conn.commit()
+    app_module.fill_missing_matches(conn, 1)
+    client.post("/confirm/1", data={"1": "1"})
+
+    # A repeat PO with the same line text is matched without any lookup
+    conn.execute(
+        "INSERT INTO line_items(document_id, description, raw_index) "
+        "VALUES(2, 'hex nut m8 (Qty: 500)', 0)"
+    )
+    conn.commit()
+    # and the local matcher's other choices are still offered after the alias
+    conn.execute("DELETE FROM match_cache")
+    conn.commit()
+    app_module.MATCH_CACHE.clear()
+    calls.clear()
+    monkeypatch.setattr(app_module, "custom_match", lambda d, use_custom=False: [
+        {"name": "CAT Hex Nut M8", "score": 0.9}, {"name": "CAT Hex Nut M10", "score": 0.8},
+    ])
+    app_module.fill_missing_matches(conn, 2)
+    assert calls == []
+    rows = app_module.fetch_review_rows(conn, 2)["rows"]
+    assert rows[0]["choices"] == [
+        {"name": "CAT Hex Nut M8", "score": 1.0}, {"name": "CAT Hex Nut M10", "score": 0.8},
+    ]
+
+    # The latest confirmation wins
+    client.post("/confirm/1", data={"1": "0"})
+    assert app_module.lookup_aliases(conn, ["Hex Nut M8"])["Hex Nut M8"][0]["name"] == "CAT Guess"
+
+
+def test_reparse_keeps_unchanged_lines_and_confirmations(client, monkeypatch):
+    calls = []
+
+    def fetch(description):
+        calls.append(description)
+        return [{"name": "CAT " + description, "score": 0.9}]
+
+    monkeypatch.setattr(app_module, "fetch_choices", fetch)
+    conn = app_module.db_conn()
+    conn.execute("INSERT INTO documents(name) VALUES('po.pdf')")
+    conn.commit()
+    app_module.store_line_items(conn, 1, ["Hex Nut M8", "Flat Washer M8", "Carriage Bolt"])
+    app_module.fill_missing_matches(conn, 1)
+    client.post("/confirm/1", data={"1": "0", "3": "0"})
+    before = {r["description"]: r for r in app_module.fetch_review_rows(conn, 1)["rows"]}
+
+    app_module.MATCH_CACHE.clear()
+    calls.clear()
+    app_module.store_line_items(
+        conn, 1, ["Lock Washer M8", "Hex Nut M8 (Qty: 5)", "Carriage Bolt", "Hex Cap Screw"]
+    )
+    assert app_module.fill_missing_matches(conn, 1) == 2
+    assert sorted(calls) == ["Hex Cap Screw", "Lock Washer M8"]
+
+    rows = app_module.fetch_review_rows(conn, 1)["rows"]
+    assert [r["description"] for r in rows] == [
+        "Lock Washer M8", "Hex Nut M8 (Qty: 5)", "Carriage Bolt", "Hex Cap Screw"
+    ]
+    assert rows[1]["match_id"] == before["Hex Nut M8"]["match_id"] and rows[1]["confirmed"] == 0
+    assert rows[2]["match_id"] == before["Carriage Bolt"]["match_id"] and rows[2]["confirmed"] == 0
+    stats = client.get("/api/dashboard").get_json()
+    assert stats["matches_total"] == 4 and stats["confirmed_total"] == 2
+
+
+def test_matcher_meets_golden_accuracy_floor(monkeypatch, tmp_path):
+    import bench_matcher
+
+    monkeypatch.setattr(app_module, "CATALOG_PATH", app_module.CATALOG_PATH)
+    monkeypatch.setattr(app_module, "_catalog_state", app_module._catalog_state)
+    golden, real_names = bench_matcher.load_golden()
+    # Larger than the scan budget, so blocking has to skip common features
+    rows = 3 * app_module.CatalogIndex.SCAN_BUDGET
+    result = bench_matcher.run_size(app_module, rows, golden, real_names, str(tmp_path), repeat=1)
+    assert result["rows"] == rows
+    assert result["top1"] >= bench_matcher.MIN_TOP1
+    assert result["top5"] >= bench_matcher.MIN_TOP5